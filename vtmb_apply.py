@@ -0,0 +1,135 @@
+#! python3
+# coding: utf-8
+
+# VtMB patch plan applier, needs no assembler or font tools
+# Copyright (C) 2022 Tring
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os, os.path
+import shutil
+
+from glbcfg import GLB_CFG
+
+from vtmb_pe import c_pe_file, hash_md5, hash_file, load_file, save_file, report, dll_paths, PLAN_FILE, unpack_plan, apply_plan, unpack_delta, apply_delta
+
+DELTA_DIR = 'delta'
+
+AP_CFG = {
+    'root': GLB_CFG.rdcfg('game'),
+    'work': GLB_CFG.rdcfg('work'),
+    'mmap': True,
+}
+
+def ensure_src(cfg, dinfo):
+    # verified backup of the original dll, or None
+    name = dinfo['name']
+    fn = os.path.join(cfg['root'], dinfo['path'], dinfo['file'])
+    if not os.path.exists(fn):
+        report(f'error: {fn} not exist')
+        return None
+    fn_src, fn_dst = dll_paths(fn)
+    if not os.path.exists(fn_src):
+        fmd5 = hash_file(fn)['md5']
+        if fmd5 != dinfo['md5']:
+            report(f'error: {name} md5 unmatch: cur:{fmd5} dst:{dinfo["md5"]}')
+            return None
+        shutil.copy2(fn, fn_src)
+    return fn, fn_src, fn_dst
+
+def apply_delta_file(cfg, delta_fn, overwrite = False):
+    try:
+        with open(delta_fn, 'rb') as fd:
+            dinfo, ops = unpack_delta(fd.read())
+    except:
+        report(f'error: invalid delta {delta_fn}')
+        return False
+    name = dinfo['name']
+    rs = ensure_src(cfg, dinfo)
+    if rs is None:
+        return False
+    fn, fn_src, fn_dst = rs
+    try:
+        hvs = apply_delta(fn_src, dinfo, ops, fn_dst)
+    except ValueError:
+        report(f'error: {name} apply delta failed')
+        return False
+    report(f'{name} patched md5: {hvs["md5"]}')
+    if overwrite:
+        shutil.copy2(fn_dst, fn)
+    return True
+
+class c_plan_applier:
+
+    def __init__(self, cfg, plan_fn):
+        self.cfg = cfg
+        with open(plan_fn, 'rb') as fd:
+            self.dlls = unpack_plan(fd.read())
+
+    def load_src(self, dinfo):
+        name = dinfo['name']
+        rs = ensure_src(self.cfg, dinfo)
+        if rs is None:
+            return None
+        fn, fn_src, fn_dst = rs
+        use_mmap = self.cfg.get('mmap', False)
+        # always work on the backup, the original is overwritten
+        raw = load_file(fn_src, use_mmap)
+        fmd5 = hash_md5(raw)
+        if fmd5 != dinfo['md5']:
+            report(f'error: {name} backup md5 unmatch: cur:{fmd5} dst:{dinfo["md5"]}')
+            return None
+        return fn, fn_dst, raw
+
+    def apply(self, dinfo, overwrite = False):
+        name = dinfo['name']
+        rs = self.load_src(dinfo)
+        if rs is None:
+            return False
+        fn, fn_dst, raw = rs
+        try:
+            pe = c_pe_file(raw)
+            apply_plan(pe, dinfo['ops'])
+            hvs = save_file(fn_dst, pe.repack_views())
+        except:
+            report(f'error: {name} apply failed')
+            return False
+        if hvs['md5'] != dinfo['dst_md5']:
+            report(f'error: {name} patched md5 unmatch: cur:{hvs["md5"]} dst:{dinfo["dst_md5"]}')
+            return False
+        report(f'{name} patched md5: {hvs["md5"]}')
+        if overwrite:
+            shutil.copy2(fn_dst, fn)
+        return True
+
+    def apply_all(self, overwrite = False):
+        for dinfo in self.dlls:
+            if not self.apply(dinfo, overwrite):
+                report(f'warning: apply {dinfo["name"]} failed')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'delta':
+        # python vtmb_apply.py delta [delta files]
+        fns = sys.argv[2:]
+        if not fns:
+            ddir = os.path.join(AP_CFG['work'], DELTA_DIR)
+            fns = [os.path.join(ddir, f) for f in sorted(os.listdir(ddir)) if f.endswith('.delta')]
+        for fn in fns:
+            if not apply_delta_file(AP_CFG, fn, True):
+                report(f'warning: apply {fn} failed')
+    else:
+        # python vtmb_apply.py [plan file]
+        ap = c_plan_applier(AP_CFG, sys.argv[1] if len(sys.argv) > 1 else
+            os.path.join(AP_CFG['work'], PLAN_FILE))
+        ap.apply_all(True)
@@ -35,6 +35,9 @@ FONT_NAME = 'font/XiaoDianZhen.ttf'
 
 FONT_CODEC = 'gbk'
 
+# 1 bit images keep white as 1, glyph bits are set for ink
+_INV_BITS = bytes(0xff - i for i in range(0x100))
+
 class c_font_bitmap:
 
     def __init__(self, font_name, font_size):
@@ -47,7 +50,7 @@ class c_font_bitmap:
         self.font = font
         self.img = Image.new("1", (font_size, font_size), color=0xff)
         self.idr = ImageDraw.Draw(self.img)
-        self.char_blank = self.get_char('\0')
+        self.char_blank = bytes(self.get_char('\0'))
 
     def _draw_char(self, c):
         self.idr.rectangle([(0, 0), self.img.size], fill=0xff)
@@ -62,30 +65,63 @@ class c_font_bitmap:
                 r[i//8] |= (1<<(7-(i%8)))
         return r
 
+    def get_chars(self, chars):
+        # glyphs drawn in one atlas, each in the middle of a 3x3 cells block
+        # so that overflowed ink is clipped like get_char. None for blank.
+        sz = self.size
+        if sz % 8:
+            return [self.char_blank if c is None else self._get_char_or_blank(c)
+                for c in chars]
+        cw = sz * 3
+        img = Image.new("1", (cw * len(chars), cw), color=0xff)
+        idr = ImageDraw.Draw(img)
+        blank = set()
+        for i, c in enumerate(chars):
+            if c is None:
+                blank.add(i)
+                continue
+            try:
+                idr.text((i * cw + sz, sz), c, fill=0, font=self.font, spacing=0)
+            except:
+                blank.add(i)
+        raw = img.tobytes().translate(_INV_BITS)
+        rlen = cw * len(chars) // 8
+        glen = sz // 8
+        rs = []
+        for i in range(len(chars)):
+            if i in blank:
+                rs.append(self.char_blank)
+                continue
+            st = sz * rlen + (i * cw + sz) // 8
+            if glen == 1:
+                rs.append(raw[st: st + sz * rlen: rlen])
+            else:
+                rs.append(b''.join(raw[p: p + glen] for p in range(st, st + sz * rlen, rlen)))
+        return rs
+
+    def _get_char_or_blank(self, c):
+        try:
+            return bytes(self.get_char(c))
+        except:
+            return self.char_blank
+
     def charset_empty(self, num):
         for i in range(num):
             yield self.char_blank
 
     def charset_ascii(self):
-        for i in range(0x80):
-            try:
-                yield self.get_char(chr(i))
-            except:
-                yield self.char_blank
+        yield from self.get_chars([chr(i) for i in range(0x80)])
 
     def charset_ansi(self, codec):
+        # an atlas for each lead byte
         for h in range(0x81, 0x100):
+            chars = []
             for l in range(0x100):
-                c = bytes.fromhex('{:04X}'.format((h<<8)+l))
                 try:
-                    s = c.decode(codec)
+                    chars.append(bytes((h, l)).decode(codec))
                 except:
-                    yield self.char_blank
-                else:
-                    try:
-                        yield self.get_char(s)
-                    except:
-                        yield self.char_blank
+                    chars.append(None)
+            yield from self.get_chars(chars)
 
 def vtmb_fbm_charset():
     try:
@@ -94,13 +130,10 @@ def vtmb_fbm_charset():
         raise RuntimeError(
             f'font {font_path} is not valid. please download it by yourself.')
     rs = []
-    for r in fbm.charset_empty(0x80):
-        rs.extend(r)
-    for r in fbm.charset_ascii():
-        rs.extend(r)
-    for r in fbm.charset_ansi(FONT_CODEC):
-        rs.extend(r)
-    return bytes(rs)
+    rs.extend(fbm.charset_empty(0x80))
+    rs.extend(fbm.charset_ascii())
+    rs.extend(fbm.charset_ansi(FONT_CODEC))
+    return b''.join(rs)
 
 if __name__ == '__main__':
     pass
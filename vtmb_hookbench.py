@@ -0,0 +1,464 @@
+#! python3
+# coding: utf-8
+
+# VtMB hook benchmark in a cpu emulator
+# Copyright (C) 2022 Tring
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import json
+import struct
+import random
+
+import vtmb_inject
+from vtmb_inject import (
+    PP_CFG, MOD_DLLS, ABC_CACHE_BITS, resolve_patch, load_iced, c_asm_block, c_pe_patcher,
+    report,
+)
+
+# unicorn is only needed here
+U = None
+
+def load_unicorn():
+    global U
+    if not U is None:
+        return
+    try:
+        import unicorn
+        import unicorn.x86_const
+    except:
+        print('''Install unicorn with
+pip3 install unicorn
+or
+pip install unicorn
+''')
+        sys.exit()
+    U = unicorn
+
+PAGE = 0x1000
+STACK_TOP = 0x00110000
+SCRATCH = 0x00200000
+# returns to here end a call, nothing is mapped
+RET_ADDR = 0x00f00000
+
+def _x():
+    return vtmb_inject.X
+
+def ins_cost(ins):
+    # rough cycles of an instruction, loads and microcoded ones cost more
+    X = _x()
+    M = X.Mnemonic
+    mn = ins.mnemonic
+    mem = any(ins.op_kind(i) == X.OpKind.MEMORY for i in range(ins.op_count))
+    if mn in (M.DIV, M.IDIV):
+        cost = 25
+    elif mn in (M.MUL, M.IMUL):
+        cost = 3
+    elif mn in (M.BT, M.BTS, M.BTR, M.BTC) and mem:
+        cost = 10
+    elif mn in (M.CALL, M.RET):
+        cost = 2
+    else:
+        cost = 1
+    if mem and mn != M.LEA:
+        cost += 3
+    return cost
+
+# hook blocks of a dll mapped at their addresses, jumps out of them end a call
+class c_hook_emu:
+
+    def __init__(self, name, cfg = PP_CFG):
+        load_iced()
+        load_unicorn()
+        uc = U
+        self.name = name
+        sinfo = MOD_DLLS[name]
+        self.base = sinfo['layout']['base']
+        self.bitness = cfg['bitness']
+        self.syms = {}
+        patch = resolve_patch(sinfo, self.bitness, self.syms)
+        labels = {saddr for saddr, _ in self.syms.values()}
+        pt = c_pe_patcher({**cfg, 'asm_listing': False}, {})
+        self.mu = uc.Uc(uc.UC_ARCH_X86, uc.UC_MODE_32)
+        self.pages = set()
+        self.costs = {}
+        self.stubs = set()
+        for addr, pinfo in pt.asm(patch, name, labels):
+            if not pinfo['type'] in ['asm', 'raw']:
+                continue
+            va = self.base + addr
+            self.write(va, pinfo['byte'])
+            if pinfo['type'] == 'asm':
+                self._add_code(va, pinfo['byte'], self.costs)
+        self.mu.hook_add(uc.UC_HOOK_CODE, self._on_code)
+        self.mu.hook_add(uc.UC_HOOK_MEM_READ_UNMAPPED | uc.UC_HOOK_MEM_WRITE_UNMAPPED, self._on_unmapped)
+        self.mu.hook_add(uc.UC_HOOK_MEM_FETCH_UNMAPPED, self._on_fetch)
+        self.map(STACK_TOP - 0x10000, 0x10000)
+        self.reset()
+
+    def reset(self):
+        self.n_ins = 0
+        self.n_cyc = 0
+
+    def _add_code(self, va, byt, tab):
+        X = _x()
+        for ins in X.Decoder(self.bitness, bytes(byt), ip = va):
+            tab[ins.ip] = ins_cost(ins)
+
+    def map(self, va, size):
+        for page in range(va // PAGE * PAGE, va + size, PAGE):
+            if not page in self.pages:
+                self.mu.mem_map(page, PAGE)
+                self.pages.add(page)
+
+    def write(self, va, byt):
+        self.map(va, len(byt))
+        self.mu.mem_write(va, bytes(byt))
+
+    def read(self, va, size):
+        return bytes(self.mu.mem_read(va, size))
+
+    def stub(self, addr, seg):
+        # instructions run in place of original code at rva addr, not counted
+        va = self.base + addr
+        byt = c_asm_block(self.bitness, seg, va).encode()[0]
+        self.write(va, byt)
+        self._add_code(va, byt, {})
+        for ins in _x().Decoder(self.bitness, byt, ip = va):
+            self.stubs.add(ins.ip)
+
+    def _on_code(self, mu, addr, size, _):
+        cost = self.costs.get(addr)
+        if not cost is None:
+            self.n_ins += 1
+            self.n_cyc += cost
+        elif not addr in self.stubs:
+            self.exit = addr
+            mu.emu_stop()
+
+    def _on_unmapped(self, mu, access, addr, size, value, _):
+        # stub memory, zero filled on first access
+        self.map(addr, size)
+        return True
+
+    def _on_fetch(self, mu, access, addr, size, value, _):
+        self.exit = addr
+        return False
+
+    def sym(self, name):
+        return self.base + self.syms[name][0]
+
+    def call(self, va, regs = None, args = ()):
+        # rva where the run left the hook code, or RET_ADDR
+        x86 = U.x86_const
+        mu = self.mu
+        esp = STACK_TOP - 0x100 - 4 * (len(args) + 1)
+        mu.mem_write(esp, struct.pack(f'<{len(args) + 1}I', RET_ADDR, *args))
+        mu.reg_write(x86.UC_X86_REG_ESP, esp)
+        for reg, val in (regs or {}).items():
+            mu.reg_write(getattr(x86, 'UC_X86_REG_' + reg.upper()), val)
+        self.exit = None
+        try:
+            mu.emu_start(va, 0)
+        except U.UcError:
+            if self.exit is None:
+                raise
+        if self.exit == RET_ADDR:
+            return RET_ADDR
+        return self.exit - self.base
+
+    def reg(self, reg):
+        return self.mu.reg_read(getattr(U.x86_const, 'UC_X86_REG_' + reg.upper()))
+
+def abc_cache_slot(font, ch, bits = ABC_CACHE_BITS):
+    return ((font >> 4) ^ ch) & ((1 << bits) - 1)
+
+# the abc_cache logic of get_char_abc_widths and create_font, to check emulated runs against
+class c_abc_cache_model:
+
+    def __init__(self, bits = ABC_CACHE_BITS):
+        self.bits = bits
+        self.mem = bytearray(0x10 << bits)
+
+    def lookup(self, font, ch):
+        offs = abc_cache_slot(font, ch, self.bits) << 4
+        if struct.unpack_from('<II', self.mem, offs) != (font, ch):
+            return None
+        return struct.unpack_from('<hhh', self.mem, offs + 0x8)
+
+    def fill(self, font, ch, abc):
+        offs = abc_cache_slot(font, ch, self.bits) << 4
+        # the hook keeps the low words
+        struct.pack_into('<IIHHH', self.mem, offs, font, ch, *(v & 0xffff for v in abc))
+
+    def get(self, font, ch, measure):
+        abc = self.lookup(font, ch)
+        if abc is None:
+            abc = measure(font, ch)
+            self.fill(font, ch, abc)
+        return abc
+
+    def clear(self):
+        self.mem[:] = bytes(len(self.mem))
+
+def _exit_check(emu, ext, allowed):
+    if not ext in allowed:
+        raise ValueError(report(f'error: {emu.name} left hook code at 0x{ext:08X}'))
+
+# each bench runs a hook over text bytes the way the game calls it,
+# and returns the number of chars
+
+def bench_draw_unicode_char(emu, text):
+    font = SCRATCH + 0x1000
+    ent = emu.sym('draw_unicode_char')
+    for b in text:
+        _exit_check(emu, emu.call(ent, {'ecx': font}, [b]), (RET_ADDR, 0xf1c5))
+    return len(text.decode('gbk'))
+
+# calls of the original GetCharABCWidths body are counted here
+ABC_MISSES = SCRATCH + 0x4000
+
+def _stub_abc_widths(emu):
+    I, C, R, M = vtmb_inject.I, vtmb_inject.C, vtmb_inject.R, vtmb_inject.M
+    # the original body after its prologue, widths from the char and the font tall at [ecx]
+    emu.write(ABC_MISSES, bytes(4))
+    emu.stub(0x16387, [
+        I.create_mem(C.INC_RM32, M(displ=ABC_MISSES, displ_size=4)),
+        I.create_reg_mem(C.MOV_R32_RM32, R.EDX, M(R.ESP, displ=0x14, displ_size=1)),
+        I.create_mem_u32(C.MOV_RM32_IMM32, M(R.EDX), 1),
+        I.create_reg_mem(C.MOV_R32_RM32, R.EDX, M(R.ESP, displ=0x18, displ_size=1)),
+        I.create_reg_u32(C.AND_EAX_IMM32, R.EAX, 0xf),
+        I.create_reg_mem(C.ADD_R32_RM32, R.EAX, M(R.ECX)),
+        I.create_mem_reg(C.MOV_RM32_R32, M(R.EDX), R.EAX),
+        I.create_reg_mem(C.MOV_R32_RM32, R.EDX, M(R.ESP, displ=0x1c, displ_size=1)),
+        I.create_mem_u32(C.MOV_RM32_IMM32, M(R.EDX), 0xffffffff),
+        I.create_reg_u32(C.ADD_RM32_IMM8, R.ESP, 0xc),
+        I.create_u32(C.RETND_IMM16, 0x10),
+    ])
+
+def _abc_measure(emu):
+    return lambda font, ch: (1, (ch & 0xf) + struct.unpack('<i', emu.read(font, 4))[0], -1)
+
+def _call_abc_widths(emu, font, b):
+    out = SCRATCH + 0x3000
+    emu.write(out, bytes(0xc))
+    _exit_check(emu, emu.call(emu.sym('get_char_abc_widths'), {'ecx': font},
+        [b, out, out + 4, out + 8]), (RET_ADDR, 0x16387))
+    return struct.unpack('<iii', emu.read(out, 0xc))
+
+def bench_get_char_abc_widths(emu, text):
+    _stub_abc_widths(emu)
+    model = c_abc_cache_model()
+    measure = _abc_measure(emu)
+    fonts = [SCRATCH + 0x1000, SCRATCH + 0x1840]
+    for font in fonts:
+        emu.write(font, struct.pack('<i', 8))
+    n = 0
+    lead = 0
+    for i, b in enumerate(text):
+        font = fonts[i % 2 if not lead else (i - 1) % 2]
+        abc = _call_abc_widths(emu, font, b)
+        if lead:
+            uc = ord(bytes([lead, b]).decode('gbk'))
+            # the hook code is checked against the cache model
+            if abc != model.get(font, uc, measure):
+                raise ValueError(report(f'error: abc cache unmatch at char 0x{uc:04X}'))
+            lead = 0
+            n += 1
+        elif b >= 0x80:
+            lead = b
+        else:
+            n += 1
+    return n
+
+def check_abc_cache(cfg = PP_CFG):
+    # abc_cache of the emulated hooks against the model: fills from two fonts,
+    # slot collisions and eviction, and a font made again at the same address
+    emu = c_hook_emu('vguimatsurface', cfg)
+    I, C = vtmb_inject.I, vtmb_inject.C
+    _stub_abc_widths(emu)
+    # the moved instructions of CWin32Font::Create leave the hook
+    emu.stub(emu.syms['create_font.moved'][0], [
+        I.create_branch(C.JMP_REL32_32, emu.base + 0x15f7d),
+    ])
+    model = c_abc_cache_model()
+    measure = _abc_measure(emu)
+    font_a = SCRATCH + 0x1000
+    font_b = SCRATCH + 0x1840
+    slot_mask = (1 << ABC_CACHE_BITS) - 1
+    def _set_tall(font, tall):
+        emu.write(font, struct.pack('<i', tall))
+    def _check(step, font, uc, hit):
+        byt = chr(uc).encode('gbk')
+        misses = struct.unpack('<I', emu.read(ABC_MISSES, 4))[0]
+        for b in byt:
+            abc = _call_abc_widths(emu, font, b)
+        miss = struct.unpack('<I', emu.read(ABC_MISSES, 4))[0] - misses
+        if (model.lookup(font, uc) is None) == hit:
+            raise ValueError(report(f'error: {step}: model {"misses" if hit else "hits"} 0x{uc:04X}'))
+        if miss != (0 if hit else 1):
+            raise ValueError(report(f'error: {step}: hook {"misses" if miss else "hits"} 0x{uc:04X}'))
+        if abc != model.get(font, uc, measure):
+            raise ValueError(report(f'error: {step}: abc of 0x{uc:04X} unmatch {abc}'))
+    def _create():
+        _exit_check(emu, emu.call(emu.sym('create_font'), {'eax': 0x12345678}), (0x15f7d,))
+        if emu.reg('eax') != 0x12345686:
+            raise ValueError(report(f'error: create_font charset eax:0x{emu.reg("eax"):08X}'))
+        model.clear()
+    _set_tall(font_a, 8)
+    _set_tall(font_b, 12)
+    c1 = ord('中')
+    c2 = ord('文')
+    # fills from two fonts
+    for font in [font_a, font_b]:
+        for uc in [c1, c2]:
+            _check('fill', font, uc, False)
+    for font in [font_a, font_b]:
+        for uc in [c1, c2]:
+            _check('hit', font, uc, True)
+    # a char of font b mapped to the slot of c1 in font a evicts it
+    c3 = c1 ^ ((font_a ^ font_b) >> 4 & slot_mask)
+    if abc_cache_slot(font_b, c3) != abc_cache_slot(font_a, c1):
+        raise ValueError(report('error: no colliding char'))
+    _check('collide', font_b, c3, False)
+    _check('evicted', font_a, c1, False)
+    _check('evicted', font_b, c3, False)
+    _check('kept', font_a, c2, True)
+    # font a made again with another tall
+    _set_tall(font_a, 20)
+    _create()
+    _check('re-create', font_a, c2, False)
+    _check('re-create', font_b, c2, False)
+    _check('re-create', font_a, c2, True)
+    report('abc_cache check passed')
+
+def bench_term_char_encode(emu, text):
+    term = SCRATCH + 0x10000
+    ent = emu.base + 0xc8060
+    emu.write(term + 0x7ac, struct.pack('<I', 0x7fffffff))
+    n = 0
+    for b in text:
+        # a new row now and then, rows are not bounded here
+        if n % 0x20 == 0:
+            emu.write(term + 0xe78, struct.pack('<II', 0, 0))
+        _exit_check(emu, emu.call(ent, {'ecx': term}, [b]), (RET_ADDR,))
+        n += 1
+    return len(text.decode('gbk'))
+
+def _lines(text, width):
+    # lines split at char boundaries
+    rs = []
+    cur = b''
+    for ch in text.decode('gbk'):
+        cb = ch.encode('gbk')
+        if len(cur) + len(cb) > width:
+            rs.append(cur)
+            cur = b''
+        cur += cb
+    if cur:
+        rs.append(cur)
+    return rs
+
+def bench_find_breakable(emu, text):
+    buf = SCRATCH + 0x20000
+    ent = emu.sym('find_breakable')
+    for line in _lines(text, 0x40):
+        emu.write(buf, line + b'\0')
+        _exit_check(emu, emu.call(ent, {'esi': buf, 'ebp': len(line)}), (0x55083,))
+    return len(text.decode('gbk'))
+
+def bench_subtitle_lnbrk(emu, text):
+    buf = SCRATCH + 0x20000
+    ent = emu.sym('subtitle_lnbrk')
+    for line in _lines(text, 0x40):
+        emu.write(buf, line + b'\0\0')
+        _exit_check(emu, emu.call(ent, {'ebx': buf}), (0xdb848,))
+    return len(text.decode('gbk'))
+
+BENCHES = {
+    'draw_unicode_char': ('vguimatsurface', bench_draw_unicode_char),
+    'get_char_abc_widths': ('vguimatsurface', bench_get_char_abc_widths),
+    'term_char_encode': ('client', bench_term_char_encode),
+    'find_breakable': ('client', bench_find_breakable),
+    'subtitle_lnbrk': ('engine', bench_subtitle_lnbrk),
+}
+
+def bench_texts(size = 0x1000, seed = 0):
+    # synthetic ascii and gbk text, gbk with common hanzi and punctuation
+    rnd = random.Random(seed)
+    words = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(1, 9)))
+        for _ in range(200)]
+    ascii_t = []
+    while len(''.join(ascii_t)) < size:
+        ascii_t.append(rnd.choice(words) + rnd.choice(' ' * 8 + '.,?!-'))
+    hanzi = [bytes([0xb0 + i // 94, 0xa1 + i % 94]).decode('gbk') for i in range(94 * 39)]
+    gbk_t = []
+    while len(''.join(gbk_t).encode('gbk')) < size:
+        gbk_t.append(''.join(rnd.choice(hanzi) for _ in range(rnd.randint(4, 16))) + rnd.choice('，，。？！'))
+    return {
+        'ascii': ''.join(ascii_t).encode('gbk')[:size],
+        'gbk': ''.join(gbk_t).encode('gbk')[:size].decode('gbk', 'ignore').encode('gbk'),
+    }
+
+def run_benches(names, cfg = PP_CFG, size = 0x1000):
+    # {bench: {text: (chars, instructions, estimated cycles)}}
+    texts = bench_texts(size)
+    rs = {}
+    for name in names:
+        dll, func = BENCHES[name]
+        rs[name] = {}
+        for tname, text in texts.items():
+            # each run starts with fresh memory, like caches after loading
+            emu = c_hook_emu(dll, cfg)
+            nch = func(emu, text)
+            rs[name][tname] = (nch, emu.n_ins, emu.n_cyc)
+    return rs
+
+def report_benches(rs, base = None):
+    report(f'{"hook":24}{"text":8}{"chars":>8}{"ins/ch":>10}{"cyc/ch":>10}')
+    for name, trs in rs.items():
+        for tname, (nch, n_ins, n_cyc) in trs.items():
+            line = f'{name:24}{tname:8}{nch:8}{n_ins / nch:10.2f}{n_cyc / nch:10.2f}'
+            if base and tname in base.get(name, {}):
+                b_nch, b_ins, b_cyc = base[name][tname]
+                line += f'  ({(n_cyc / nch) / (b_cyc / b_nch) - 1:+.1%} cyc)'
+            report(line)
+
+if __name__ == '__main__':
+    # python vtmb_hookbench.py [hook names] [--size n] [--save file] [--base file]
+    # python vtmb_hookbench.py --check
+    args = sys.argv[1:]
+    if '--check' in args:
+        check_abc_cache(PP_CFG)
+        sys.exit()
+    opts = {}
+    for k in ['--size', '--save', '--base']:
+        if k in args:
+            i = args.index(k)
+            opts[k] = args[i + 1]
+            del args[i: i + 2]
+    for name in args:
+        if not name in BENCHES:
+            report(f'error: unknown hook {name}, one of {", ".join(BENCHES)}')
+            sys.exit()
+    rs = run_benches(args or list(BENCHES), PP_CFG, int(opts.get('--size', '4096'), 0))
+    base = None
+    if '--base' in opts:
+        with open(opts['--base'], 'r', encoding = 'utf-8') as fd:
+            base = json.load(fd)
+    report_benches(rs, base)
+    if '--save' in opts:
+        with open(opts['--save'], 'w', encoding = 'utf-8') as fd:
+            json.dump(rs, fd, indent = 1)
+        report(f'results saved to {opts["--save"]}')
@@ -18,41 +18,144 @@
 
 import sys
 import os, os.path
+import io
+import json
 import shutil
+import traceback
+from functools import lru_cache
+from contextlib import redirect_stdout
 from hashlib import md5 as _md5
 
-try:
-    import iced_x86 as X
-    from iced_x86 import Instruction as I, Code as C, Register as R, MemoryOperand as M
-except:
-    print('''Install iced-x86 with
+# iced_x86 is imported by load_iced, only patch tables and the assembler need it
+X = I = C = R = M = None
+ICED_VER = None
+
+def load_iced():
+    global X, I, C, R, M, ICED_VER
+    if not X is None:
+        return
+    try:
+        import iced_x86
+        from iced_x86 import Instruction, Code, Register, MemoryOperand
+    except:
+        print('''Install iced-x86 with
 pip3 install iced-x86
 or
 pip install iced-x86
 ''')
-    sys.exit()
+        sys.exit()
+    try:
+        from importlib.metadata import version as _pkg_version
+        ICED_VER = _pkg_version('iced-x86')
+    except:
+        ICED_VER = ''
+    X, I, C, R, M = iced_x86, Instruction, Code, Register, MemoryOperand
 
 from glbcfg import GLB_CFG
 
-from vtmb_font_bitmap import vtmb_fbm_charset
+from vtmb_preflight import preflight
+
+from vtmb_sigscan import unique_sig
+
+from vtmb_pe import c_pe_file, hash_md5, hash_file, load_file, save_file, report, dll_paths, PLAN_FILE, pack_plan, make_delta, pack_delta
+
+@lru_cache(None)
+def patcher_src_md5():
+    # fixes in the patcher code change the plans it makes for the same tables
+    h = _md5()
+    for mod in (__name__, 'vtmb_pe'):
+        with open(sys.modules[mod].__file__, 'rb') as fd:
+            h.update(fd.read())
+    return h.hexdigest()
+
+@lru_cache(None)
+def vtmb_fbm_charset():
+    # Pillow renders the font only when the client patch is built
+    from vtmb_font_bitmap import vtmb_fbm_charset as _fbm_charset
+    return _fbm_charset()
+
+# gbk codes looked up by ansi_to_unicode, the rest are converted by vgui
+GBK_TAB_RANGE = (0x8140, 0xfeff)
+
+@lru_cache(None)
+def gbk_ucs2_table():
+    # ucs-2 of each code in GBK_TAB_RANGE, 0 for invalid ones
+    rs = bytearray()
+    for code in range(*GBK_TAB_RANGE):
+        try:
+            uc = code.to_bytes(2, 'big').decode('gbk')
+        except UnicodeDecodeError:
+            uc = ''
+        rs += (ord(uc) if len(uc) == 1 else 0).to_bytes(2, 'little')
+    return bytes(rs)
+
+# direct mapped abc widths cache of get_char_abc_widths, each 0x10 bytes slot is
+# font u32, char u32, a/b/c i16, a slot is replaced by the next char mapped to it.
+# CWin32Font::Create clears it, a font made again at the same address has new widths
+ABC_CACHE_BITS = 12
 
 PP_CFG = {
     'root': GLB_CFG.rdcfg('game'),
     'bitness': 32,
+    'mmap': True,
+    'sha256': False,
+    # worker processes for patching, 0 for all cpus, 1 to patch in sequence
+    'jobs': GLB_CFG.rdcfg('jobs', default=0),
+    'work': GLB_CFG.rdcfg('work'),
+    # sub dir of work to cache assembled patches, None to disable
+    'asm_cache': 'asm_cache',
+    'asm_listing': True,
+    # sub dir of work to write binary deltas of patched dlls, None to disable
+    'delta': 'delta',
+    # skip dlls already patched with the same plan, recorded next to each dll
+    'manifest': True,
+    # check patch ranges before writing, refuse to patch on errors
+    'preflight': True,
+    # sub dir of work to write symbol maps of laid out patches, None to disable
+    'sym_map': 'symbols',
+    # sub dir of work for code indexes of vtmb_xref.py
+    'xref': 'xref',
 }
 
 def shift_mem(src_len, shft_len):
     def _shift(addr, pe):
         s_offs, d_offs = pe.shift(addr, src_len, shft_len)
         return f'offs:0x{s_offs:08X}/0x{s_offs+src_len-1:08X} -> offs:0x{d_offs:08X}/0x{d_offs+src_len-1:08X} shift(n:0x{shft_len:04X})'
+    _shift.patch_info = {'type': 'shift', 'len': src_len, 'shift': shft_len}
     return _shift
 
 def insert_sect(sect_len, cfg):
     def _insert(addr, pe):
         d_offs, s_offs, s_size = pe.insert(addr, sect_len, cfg)
         return f'new sect {cfg["name"]}: 0x{s_offs:08X}/0x{s_offs+s_size:08X}'
+    _insert.patch_info = {'type': 'insert', 'len': sect_len}
     return _insert
 
+def move_code(src, min_len, room, bitness = 32):
+    # whole instructions covering min_len bytes at src run at addr, then jump back
+    def _move(addr, pe):
+        load_iced()
+        inss = []
+        mlen = 0
+        for ins in X.Decoder(bitness, bytes(pe.read(src, min_len + 0xf)), ip = src):
+            if ins.code == C.INVALID:
+                raise ValueError(report(f'invalid instruction at 0x{ins.ip:08X}'))
+            inss.append(ins)
+            mlen += ins.len
+            if mlen >= min_len:
+                break
+        inss.append(I.create_branch(C.JMP_REL32_32, src + mlen))
+        byt, fixup, _ = c_asm_block(bitness, inss, addr).encode()
+        if len(byt) > room:
+            raise ValueError(report(f'moved code 0x{src:08X}/0x{src+mlen-1:08X} overflows 0x{room:x} bytes'))
+        offs = pe.replace(addr, byt)
+        img_st = pe.addr_base
+        img_ed = img_st + pe.size_img
+        pe.update_reloc(addr, len(byt), [o for o, v in fixup if img_st <= v < img_ed])
+        return f'move code 0x{src:08X}/0x{src+mlen-1:08X} to offs:0x{offs:08X}/0x{offs+len(byt)-1:08X}'
+    _move.patch_info = {'type': 'copy', 'len': room}
+    return _move
+
 def from_mem(*mrngs):
     def _copy(addr, pe):
         rs = []
@@ -62,39 +165,257 @@ def from_mem(*mrngs):
         db = b''.join(rs)
         pe.replace(addr, db)
         return f'copy to addr:0x{addr:08X}/0x{addr+len(db)-1:08X}'
+    _copy.patch_info = {'type': 'copy', 'len': sum(r_ed - r_st for r_st, r_ed in mrngs)}
     return _copy
 
+# labels of a block, kept as symbols of the layout under the block scope
 class c_label_ctx:
-    def __init__(self):
-        self.tab = {}
+    def __init__(self, lyt, scope):
+        self.lyt = lyt
+        self.scope = scope
     def lb(self, name):
-        if not name in self.tab:
-            self.tab[name] = len(self.tab) + 1
-        return self.tab[name]
+        return self.lyt.label(f'{self.scope}.{name}')
     def add(self, name, ins):
         ins.ip = self.lb(name)
         return ins
 
-def with_label_ctx(func):
-    return func(c_label_ctx())
+def alignup(v, align):
+    return (v + align - 1) // align * align
+
+# address of a symbol, a patch entry at it is a block placed by the layout
+class c_sym_addr(int):
+    def __new__(cls, addr, name):
+        self = super().__new__(cls, addr)
+        self.name = name
+        return self
+
+# symbol table of a patch factory
+# code symbols are hooks and funcs placed in code_ext, labels are instructions
+# inside blocks, data symbols are slots packed into data_ext by their size.
+# with align 1 all hooks are assembled as one block, branches between them
+# can be short, otherwise each hook is assembled alone and aligned.
+# sites are addresses in the original code, pinned to the md5 build.
+class c_patch_layout:
+
+    # far enough apart that no branch between blocks is short while sizing
+    size_gap = 0x10000
+
+    def __init__(self, cfg):
+        self.base_addr = cfg['base']
+        self.code_ext = cfg['code']
+        self.fixed_data = cfg.get('data')
+        self.align = cfg.get('align', 1)
+        self.sect_align = cfg.get('sect_align', 0x1000)
+        self.externs = dict(cfg.get('extern', {}))
+        self.sigs = cfg.get('sigs', {})
+        self.code_syms = {}
+        self.labels = {}
+        self.data_syms = {}
+        self.ids = {}
+        self.merged = None
+        self.code_size = 0
+        self.data_size = 0
+        self.packed = False
+        self._update_data_ext()
+
+    def _update_data_ext(self):
+        if not self.fixed_data is None:
+            self.data_ext = self.fixed_data
+        else:
+            self.data_ext = self.code_ext + alignup(self.code_size, self.sect_align)
+
+    def _new_id(self, typ, name):
+        if self.packed:
+            raise ValueError(report(f'undefined symbol {name}'))
+        sid = self.code_ext + (len(self.ids) + 1) * self.size_gap
+        self.ids[sid] = (typ, name)
+        return sid
+
+    def va(self, addr):
+        return self.base_addr + addr
+
+    def site(self, name):
+        # rva of a patch site in the original code
+        if not name in self.sigs:
+            raise ValueError(report(f'undefined site {name}'))
+        return self.sigs[name][0]
+
+    def code(self, name):
+        # rva of a hook or func, or of a known function in the original code
+        if name in self.sigs:
+            return self.site(name)
+        if name in self.externs:
+            return self.externs[name]
+        if not name in self.code_syms:
+            self.code_syms[name] = {
+                'addr': self._new_id('code', name),
+                'size': None,
+            }
+        return c_sym_addr(self.code_syms[name]['addr'], name)
+
+    def label(self, name):
+        if not name in self.labels:
+            self.labels[name] = self._new_id('label', name)
+        return self.labels[name]
+
+    def data(self, name, size = 1):
+        # va of a data slot
+        if not name in self.data_syms:
+            if self.packed:
+                raise ValueError(report(f'undefined symbol {name}'))
+            if size < 1:
+                raise ValueError(report(f'data symbol {name} is empty'))
+            self.data_syms[name] = {
+                'addr': None,
+                'size': size,
+            }
+        elif self.data_syms[name]['size'] != size:
+            raise ValueError(report(f'data symbol {name} size unmatch'))
+        ent = self.data_syms[name]
+        if ent['addr'] is None:
+            return self.va(self.data_ext)
+        return self.va(ent['addr'])
+
+    def const(self, name, byt):
+        # patch entry of a data slot with initial bytes
+        return (self.data(name, len(byt)) - self.base_addr, byt)
+
+    def hook(self, name, func):
+        # patch entry of a hook or func placed by the layout
+        return (self.code(name), func(c_label_ctx(self, name)))
+
+    def local(self, scope, func):
+        # block with labels at a fixed address
+        return func(c_label_ctx(self, scope))
+
+    def merge(self, patch):
+        if self.align > 1:
+            return patch
+        rs = []
+        blk = None
+        for addr, seg in patch:
+            if not isinstance(addr, c_sym_addr) or not seg:
+                rs.append((addr, seg))
+                continue
+            if callable(seg) or isinstance(seg, (bytes, bytearray)):
+                raise ValueError(report(f'symbol {addr.name} is not code, layout needs align'))
+            if seg[0].ip:
+                raise ValueError(report(f'symbol {addr.name} starts with a label'))
+            if blk is None:
+                blk = []
+                rs.append((self.code_ext, blk))
+                self.merged = blk
+            ins = seg[0].copy()
+            ins.ip = addr
+            blk.append(ins)
+            blk.extend(seg[1:])
+        return rs
+
+    def pack(self, patch, bitness):
+        # offsets of labeled instructions in their blocks, from one assembly of each
+        offs = {}
+        for addr, seg in patch:
+            if not seg or callable(seg):
+                continue
+            if isinstance(seg, (bytes, bytearray)):
+                blen = len(seg)
+                rins = []
+            else:
+                dbyt, _, rins = c_asm_block(bitness, seg, addr).encode()
+                blen = len(dbyt)
+            if isinstance(addr, c_sym_addr):
+                ent = self.code_syms[addr.name]
+                if not ent['size'] is None:
+                    raise ValueError(report(f'multiple blocks at symbol {addr.name}'))
+                ent['size'] = blen
+                offs[int(addr)] = (addr, 0)
+            elif seg is self.merged:
+                self.code_size = blen
+            for ins, (rin, _) in zip(seg, rins):
+                if ins.ip:
+                    offs[ins.ip] = (addr, rin.ip - addr)
+        blk_addr = {}
+        if self.align > 1:
+            cur = self.code_ext
+            for name, ent in self.code_syms.items():
+                if ent['size'] is None:
+                    raise ValueError(report(f'undefined symbol {name}'))
+                cur = alignup(cur, self.align)
+                blk_addr[ent['addr']] = cur
+                cur += ent['size']
+            self.code_size = cur - self.code_ext
+        for sid, (typ, name) in self.ids.items():
+            if not sid in offs:
+                raise ValueError(report(f'undefined symbol {name}'))
+            addr, off = offs[sid]
+            addr = blk_addr.get(addr, addr) + off
+            if typ == 'code':
+                self.code_syms[name]['addr'] = addr
+            else:
+                self.labels[name] = addr
+        if self.align <= 1:
+            # hooks in the merged block end where the next one starts
+            ents = sorted(self.code_syms.values(), key = lambda v: v['addr'])
+            for ent, nxt in zip(ents, ents[1:] + [None]):
+                ent['size'] = (nxt['addr'] if nxt else self.code_ext + self.code_size) - ent['addr']
+        self._update_data_ext()
+        cur = self.data_ext
+        for ent in self.data_syms.values():
+            # natural alignment, a power of two up to 0x10
+            cur = alignup(cur, min(1 << (ent['size'] - 1).bit_length(), 0x10))
+            ent['addr'] = cur
+            cur += ent['size']
+        self.data_size = cur - self.data_ext
+        self.packed = True
+
+    def symbols(self):
+        # name: (rva, size), size is None for labels
+        rs = {name: (ent['addr'], ent['size']) for name, ent in self.code_syms.items()}
+        for name, addr in self.labels.items():
+            rs[name] = (addr, None)
+        for name, ent in self.data_syms.items():
+            rs[name] = (ent['addr'], ent['size'])
+        return rs
 
 MOD_OPTION = {
     'terminal_ignCR': GLB_CFG.rdcfg('terminal_ignCR', default=True),
     'terminal_8bits': GLB_CFG.rdcfg('terminal_8bits', default=True),
+    # subtitle lines break after these chars
+    'subtitle_lnbrk_punct': GLB_CFG.rdcfg('subtitle_lnbrk_punct', default='.?!？！。'),
 }
 
+def lnbrk_bitmap(chars):
+    # a bit for each char read as a word, ascii or gbk bytes in little endian
+    bm = bytearray(0x2000)
+    for ch in chars:
+        if not isinstance(ch, str) or len(ch) != 1:
+            raise ValueError(report(f'error: subtitle_lnbrk_punct entry {ch!r} is not a single char'))
+        try:
+            byt = ch.encode('gbk')
+        except UnicodeEncodeError:
+            raise ValueError(report(f'error: subtitle_lnbrk_punct char {ch!r} (U+{ord(ch):04X}) not in gbk'))
+        code = int.from_bytes(byt, 'little')
+        bm[code >> 3] |= 1 << (code & 0x7)
+    return bytes(bm)
+
+# patch tables are factories, built by resolve_patch only for the dlls being patched
 MOD_DLLS = {
     'vguimatsurface': {
         'path': 'Bin',
         'file': 'vguimatsurface.dll',
         'md5':  '0e8c1c67e4a4c7f227e4b5fa9e7e3eee',
-        'patch': (lambda base_addr, code_ext, data_ext, hooks, funcs:[
+        # hooks and data slots extend the end of .text and .data
+        'layout': {'base': 0x10000000, 'code': 0x35000, 'data': 0x4e000, 'extern': {
+            'get_vgui_localize': 0x19e00,
+        }},
+        'patch': lambda sym: [
             (0x38954, b'GetGlyphOutlineW'), # ipt replace GetGlyphOutlineA to GetGlyphOutlineW
-            (code_ext - 1, b'\xcc\xcc'), # force extend code sect
-            (data_ext - 1, b'\x00\x00\x00\x00\x00'), # force extend data sect
+            (sym.code_ext - 1, b'\xcc\xcc'), # force extend code sect
+            (sym.data_ext - 1, bytes(1 + sym.data_size)), # force extend data sect
+            sym.const('gbk_ucs2', gbk_ucs2_table()),
             # CMatSystemSurface::DrawUnicodeChar
             (0x0f1c0, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[0]),
+                I.create_branch(C.JMP_REL32_32, sym.code('draw_unicode_char')),
             ]),
             (0x0f24c, [
                 I.create_reg_reg(C.MOV_R32_RM32, R.EBX, R.EAX),
@@ -104,7 +425,7 @@ MOD_DLLS = {
                 I.create_reg_reg(C.MOV_R16_RM16, R.AX, R.BX),
             ]),
 ##            (0x0f2a3, [
-##                I.create_branch(C.JMP_REL32_32, code_ext + hooks[k]),
+##                I.create_branch(C.JMP_REL32_32, sym.code('draw_unicode_char_width')),
 ##                I.create(C.NOPD),
 ##                I.create(C.NOPD),
 ##                I.create(C.NOPD),
@@ -134,17 +455,12 @@ MOD_DLLS = {
 ##            ]),
             # CFontAmalgam::GetFontForChar
             (0x15dc0, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[2]),
-                I.create(C.NOPD),
-            ]),
-            # CWin32Font::Create
-            (0x15f7a, [
-                I.create_reg_u32(C.MOV_R8_IMM8, R.AL, 134), #GB2312
+                I.create_branch(C.JMP_REL32_32, sym.code('get_font_for_char')),
                 I.create(C.NOPD),
             ]),
             # CWin32Font::GetCharABCWidths
             (0x16380, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[1]),
+                I.create_branch(C.JMP_REL32_32, sym.code('get_char_abc_widths')),
                 I.create(C.NOPD),
                 I.create(C.NOPD),
             ]),
@@ -154,7 +470,7 @@ MOD_DLLS = {
 ##            ]),
             # get_char_info_ctype <- iswcntrl/iswspace/...
             (0x2bd9c, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[3]),
+                I.create_branch(C.JMP_REL32_32, sym.code('get_char_info_ctype')),
                 I.create(C.NOPD),
                 I.create(C.NOPD),
                 I.create(C.NOPD),
@@ -162,9 +478,9 @@ MOD_DLLS = {
                 I.create(C.NOPD),
             ]),
             # hooks for DrawUnicodeChar
-            (code_ext + hooks[0], with_label_ctx(lambda lbc: [
+            sym.hook('draw_unicode_char', lambda lbc: [
                 I.create_mem_u32(C.AND_RM32_IMM32, M(R.ESP, displ=0x4, displ_size=1), 0xffff),
-                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext+2, displ_size=4), 0),
+                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('draw_state'), displ_size=4), 0),
                 I.create_reg(C.PUSH_R32, R.ECX),
                 I.create_reg_mem(C.MOV_R16_RM16, R.AX, M(R.ESP, displ=0x8, displ_size=1)),
                 I.create_reg_u32(C.CMP_RM16_IMM16, R.AX, 0x100),
@@ -178,7 +494,7 @@ MOD_DLLS = {
                 ),
                 I.create_branch(C.JB_REL32_32, lbc.lb('ret')),
                 #read log
-                I.create_reg_mem(C.MOVZX_R16_RM8, R.CX, M(displ=base_addr+data_ext, displ_size=4)),
+                I.create_reg_mem(C.MOVZX_R16_RM8, R.CX, M(displ=sym.data('draw_lead'), displ_size=4)),
                 I.create_reg_reg(C.TEST_RM8_R8, R.CL, R.CL),
                 I.create_branch(C.JE_REL32_32, lbc.lb('byte_1')),
                 #byte_2
@@ -186,9 +502,9 @@ MOD_DLLS = {
                 I.create_reg_u32(C.SHL_RM16_IMM8, R.AX, 8), #LE for unicode convert
                 I.create_reg_reg(C.OR_R16_RM16, R.AX, R.CX),
                 #convert gbk to unicode
-                I.create_branch(C.CALL_REL32_32, code_ext + funcs[0]),
+                I.create_branch(C.CALL_REL32_32, sym.code('ansi_to_unicode')),
                 I.create_mem_reg(C.MOV_RM16_R16, M(R.ESP, displ=0x8, displ_size=1), R.AX),
-                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext+2, displ_size=4), 2),
+                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('draw_state'), displ_size=4), 2),
                 I.create_branch(C.JMP_REL32_32, lbc.lb('ret')),
                 #byte_1
                 lbc.add('byte_1',
@@ -196,23 +512,23 @@ MOD_DLLS = {
                 ),
                 I.create_branch(C.JB_REL32_32, lbc.lb('ret')),
                 #log and bypass
-                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext+2, displ_size=4), 1),
-                I.create_mem_reg(C.MOV_RM8_R8, M(displ=base_addr+data_ext, displ_size=4), R.AL),
+                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('draw_state'), displ_size=4), 1),
+                I.create_mem_reg(C.MOV_RM8_R8, M(displ=sym.data('draw_lead'), displ_size=4), R.AL),
                 I.create_reg_reg(C.XOR_R32_RM32, R.EAX, R.EAX),
                 I.create_reg(C.POP_R32, R.ECX),
                 I.create_u32(C.RETND_IMM16, 0x4),
                 #ret
                 lbc.add('ret',
-                    I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext, displ_size=4), 0),
+                    I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('draw_lead'), displ_size=4), 0),
                 ),
                 I.create_reg_mem(C.MOV_EAX_MOFFS32, R.EAX, M(displ=0x1004af4c, displ_size=4)),
                 I.create_reg(C.POP_R32, R.ECX),
                 I.create_branch(C.JMP_REL32_32, 0xf1c5),
-            ])),
+            ]),
             # hooks for GetCharABCWidths
-            (code_ext + hooks[1], with_label_ctx(lambda lbc: [
+            sym.hook('get_char_abc_widths', lambda lbc: [
                 I.create_mem_u32(C.AND_RM32_IMM32, M(R.ESP, displ=0x4, displ_size=1), 0xffff),
-                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext+3, displ_size=4), 0),
+                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('abc_state'), displ_size=4), 0),
                 I.create_reg(C.PUSH_R32, R.ECX),
                 I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x8, displ_size=1)),
                 I.create_reg_u32(C.CMP_RM16_IMM16, R.AX, 0x100),
@@ -226,7 +542,7 @@ MOD_DLLS = {
                 ),
                 I.create_branch(C.JB_REL32_32, lbc.lb('ret')),
                 #read log
-                I.create_reg_mem(C.MOVZX_R16_RM8, R.CX, M(displ=base_addr+data_ext+1, displ_size=4)),
+                I.create_reg_mem(C.MOVZX_R16_RM8, R.CX, M(displ=sym.data('abc_lead'), displ_size=4)),
                 I.create_reg_reg(C.TEST_RM8_R8, R.CL, R.CL),
                 I.create_branch(C.JE_REL32_32, lbc.lb('byte_1')),
                 #byte_2
@@ -234,18 +550,69 @@ MOD_DLLS = {
                 I.create_reg_u32(C.SHL_RM16_IMM8, R.AX, 8), #LE for unicode convert
                 I.create_reg_reg(C.OR_R16_RM16, R.AX, R.CX),
                 #convert gbk to unicode
-                I.create_branch(C.CALL_REL32_32, code_ext + funcs[0]),
+                I.create_branch(C.CALL_REL32_32, sym.code('ansi_to_unicode')),
                 I.create_mem_reg(C.MOV_RM16_R16, M(R.ESP, displ=0x8, displ_size=1), R.AX),
-                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext+3, displ_size=4), 2),
-                I.create_branch(C.JMP_REL32_32, lbc.lb('ret')),
+                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('abc_state'), displ_size=4), 2),
+                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('abc_lead'), displ_size=4), 0),
+                # lookup abc_cache by font and unicode char
+                I.create_reg_reg(C.MOVZX_R32_RM16, R.EAX, R.AX),
+                I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.ESP)),
+                I.create_reg_reg(C.MOV_R32_RM32, R.EDX, R.ECX),
+                I.create_reg_u32(C.SHR_RM32_IMM8, R.EDX, 4),
+                I.create_reg_reg(C.XOR_R32_RM32, R.EDX, R.EAX),
+                I.create_reg_u32(C.AND_RM32_IMM32, R.EDX, (1 << ABC_CACHE_BITS) - 1),
+                I.create_reg_u32(C.SHL_RM32_IMM8, R.EDX, 4),
+                I.create_reg_mem(C.LEA_R32_M, R.EDX, M(R.EDX,
+                    displ=sym.data('abc_cache', 0x10 << ABC_CACHE_BITS), displ_size=4)),
+                I.create_reg_mem(C.CMP_R32_RM32, R.ECX, M(R.EDX)),
+                I.create_branch(C.JNE_REL32_32, lbc.lb('miss')),
+                I.create_reg_mem(C.CMP_R32_RM32, R.EAX, M(R.EDX, displ=0x4, displ_size=1)),
+                I.create_branch(C.JNE_REL32_32, lbc.lb('miss')),
+                # hit, a/b/c from the slot
+                I.create_reg_mem(C.MOVSX_R32_RM16, R.EAX, M(R.EDX, displ=0x8, displ_size=1)),
+                I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.ESP, displ=0xc, displ_size=1)),
+                I.create_mem_reg(C.MOV_RM32_R32, M(R.ECX), R.EAX),
+                I.create_reg_mem(C.MOVSX_R32_RM16, R.EAX, M(R.EDX, displ=0xa, displ_size=1)),
+                I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.ESP, displ=0x10, displ_size=1)),
+                I.create_mem_reg(C.MOV_RM32_R32, M(R.ECX), R.EAX),
+                I.create_reg_mem(C.MOVSX_R32_RM16, R.EAX, M(R.EDX, displ=0xc, displ_size=1)),
+                I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.ESP, displ=0x14, displ_size=1)),
+                I.create_mem_reg(C.MOV_RM32_R32, M(R.ECX), R.EAX),
+                I.create_reg(C.POP_R32, R.ECX),
+                I.create_u32(C.RETND_IMM16, 0x10),
+                # miss, call the original and fill the slot
+                lbc.add('miss',
+                    I.create_reg(C.PUSH_R32, R.EDX),
+                ),
+                I.create_mem(C.PUSH_RM32, M(R.ESP, displ=0x18, displ_size=1)),
+                I.create_mem(C.PUSH_RM32, M(R.ESP, displ=0x18, displ_size=1)),
+                I.create_mem(C.PUSH_RM32, M(R.ESP, displ=0x18, displ_size=1)),
+                I.create_mem(C.PUSH_RM32, M(R.ESP, displ=0x18, displ_size=1)),
+                I.create_branch(C.CALL_REL32_32, lbc.lb('orig')),
+                I.create_reg(C.POP_R32, R.EDX),
+                I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.ESP)),
+                I.create_mem_reg(C.MOV_RM32_R32, M(R.EDX), R.ECX),
+                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x8, displ_size=1)),
+                I.create_mem_reg(C.MOV_RM32_R32, M(R.EDX, displ=0x4, displ_size=1), R.EAX),
+                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0xc, displ_size=1)),
+                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.EAX)),
+                I.create_mem_reg(C.MOV_RM16_R16, M(R.EDX, displ=0x8, displ_size=1), R.AX),
+                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x10, displ_size=1)),
+                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.EAX)),
+                I.create_mem_reg(C.MOV_RM16_R16, M(R.EDX, displ=0xa, displ_size=1), R.AX),
+                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x14, displ_size=1)),
+                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.EAX)),
+                I.create_mem_reg(C.MOV_RM16_R16, M(R.EDX, displ=0xc, displ_size=1), R.AX),
+                I.create_reg(C.POP_R32, R.ECX),
+                I.create_u32(C.RETND_IMM16, 0x10),
                 #byte_1
                 lbc.add('byte_1',
                     I.create_reg_u32(C.CMP_RM8_IMM8, R.AL, 0x80),
                 ),
                 I.create_branch(C.JB_REL32_32, lbc.lb('ret')),
                 #log and bypass
-                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext+3, displ_size=4), 1),
-                I.create_mem_reg(C.MOV_RM8_R8, M(displ=base_addr+data_ext+1, displ_size=4), R.AL),
+                I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('abc_state'), displ_size=4), 1),
+                I.create_mem_reg(C.MOV_RM8_R8, M(displ=sym.data('abc_lead'), displ_size=4), R.AL),
                 I.create_reg(C.POP_R32, R.ECX),
                 I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x8, displ_size=1)),
                 I.create_mem_u32(C.MOV_RM32_IMM32, M(R.EAX), 0),
@@ -256,15 +623,40 @@ MOD_DLLS = {
                 I.create_u32(C.RETND_IMM16, 0x10),
                 #ret
                 lbc.add('ret',
-                    I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=base_addr+data_ext+1, displ_size=4), 0),
+                    I.create_mem_u32(C.MOV_RM8_IMM8, M(displ=sym.data('abc_lead'), displ_size=4), 0),
                 ),
                 I.create_reg(C.POP_R32, R.ECX),
-                I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x4, displ_size=1)),
+                # the original, thiscall with 4 args
+                lbc.add('orig',
+                    I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x4, displ_size=1)),
+                ),
                 I.create_reg_u32(C.SUB_RM32_IMM8, R.ESP, 0xc),
                 I.create_branch(C.JMP_REL32_32, 0x16387),
-            ])),
+            ]),
+            # hooks for CWin32Font::Create, charset and clear abc_cache
+            sym.hook('create_font', lambda lbc: [
+                I.create(C.PUSHFD),
+                I.create_reg(C.PUSH_R32, R.EAX),
+                I.create_reg(C.PUSH_R32, R.ECX),
+                I.create_reg(C.PUSH_R32, R.EDI),
+                I.create(C.CLD),
+                I.create_reg_reg(C.XOR_R32_RM32, R.EAX, R.EAX),
+                I.create_reg_u32(C.MOV_R32_IMM32, R.EDI, sym.data('abc_cache', 0x10 << ABC_CACHE_BITS)),
+                I.create_reg_u32(C.MOV_R32_IMM32, R.ECX, (0x10 << ABC_CACHE_BITS) // 4),
+                I.create_stosd(32, X.RepPrefixKind.REPE),
+                I.create_reg(C.POP_R32, R.EDI),
+                I.create_reg(C.POP_R32, R.ECX),
+                I.create_reg(C.POP_R32, R.EAX),
+                I.create(C.POPFD),
+                I.create_reg_u32(C.MOV_R8_IMM8, R.AL, 134), #GB2312
+                # the instructions after the charset one are moved here
+                lbc.add('moved',
+                    I.create(C.INT3),
+                ),
+                *[I.create(C.INT3) for _ in range(0x17)],
+            ]),
             # hooks for CFontAmalgam::GetFontForChar, un-negtive src char
-            (code_ext + hooks[2], with_label_ctx(lambda lbc: [
+            sym.hook('get_font_for_char', lambda lbc: [
                 I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x4, displ_size=1)),
                 I.create_reg_u32(C.AND_EAX_IMM32, R.EAX, 0xff00),
                 I.create_reg_u32(C.CMP_EAX_IMM32, R.EAX, 0xff00),
@@ -283,9 +675,9 @@ MOD_DLLS = {
                 I.create_reg_mem(C.MOV_R32_RM32, R.ESI, M(R.ECX, displ=0xc, displ_size=1)),
                 I.create_reg_reg(C.XOR_R32_RM32, R.EDX, R.EDX),
                 I.create_branch(C.JMP_REL32_32, 0x15dc6),
-            ])),
+            ]),
             # hooks for get_char_info_ctype <- iswcntrl/iswspace/...
-            (code_ext + hooks[3], with_label_ctx(lambda lbc: [
+            sym.hook('get_char_info_ctype', lambda lbc: [
                 I.create_mem_u32(C.CMP_RM16_IMM16, M(R.ESP, displ=0x4, displ_size=1), 0xff00),
                 I.create_branch(C.JAE_REL32_32, lbc.lb('ret_bypass')),
                 #ret
@@ -302,9 +694,9 @@ MOD_DLLS = {
                 # but it's work to let flags 0x157 be true and flags 0x8 be false.
                 I.create_reg_u32(C.AND_EAX_IMM32, R.EAX, 0x300),
                 I.create(C.RETND), #cdecl
-            ])),
+            ]),
             # hooks for DrawUnicodeChar width calc
-##            (code_ext + hooks[k], [
+##            (sym.code('draw_unicode_char_width'), [
 ##                I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.ESP, displ=0x30, displ_size=1)),
 ##                I.create_reg_mem(C.ADD_R32_RM32, R.ECX, M(R.ESP, displ=0x40, displ_size=1)),
 ##                I.create_mem_reg(C.MOV_RM32_R32, M(R.ESP, displ=0x30, displ_size=1), R.ECX),
@@ -313,13 +705,31 @@ MOD_DLLS = {
 ##                I.create_branch(C.JMP_REL32_32, 0xf2ab),
 ##            ]),
             # func convert ansi to unicode
-            (code_ext + funcs[0], with_label_ctx(lambda lbc: [
+            sym.hook('ansi_to_unicode', lambda lbc: [
+                # lookup gbk_ucs2 by lead << 8 | trail
+                I.create_reg(C.PUSH_R32, R.ECX),
+                I.create_reg_reg(C.MOVZX_R32_RM16, R.ECX, R.AX),
+                I.create_reg_u32(C.ROL_RM16_IMM8, R.CX, 8),
+                I.create_reg_u32(C.SUB_RM32_IMM32, R.ECX, GBK_TAB_RANGE[0]),
+                I.create_reg_u32(C.CMP_RM32_IMM32, R.ECX, GBK_TAB_RANGE[1] - GBK_TAB_RANGE[0]),
+                I.create_branch(C.JAE_REL32_32, lbc.lb('convert')),
+                I.create_reg_mem(C.MOVZX_R32_RM16, R.ECX, M(index=R.ECX, scale=2,
+                    displ=sym.data('gbk_ucs2', len(gbk_ucs2_table())), displ_size=4)),
+                I.create_reg_reg(C.TEST_RM32_R32, R.ECX, R.ECX),
+                I.create_branch(C.JE_REL32_32, lbc.lb('convert')),
+                I.create_reg_reg(C.MOV_R16_RM16, R.AX, R.CX),
+                I.create_reg(C.POP_R32, R.ECX),
+                I.create(C.RETND),
+                # invalid or user defined codes
+                lbc.add('convert',
+                    I.create_reg(C.POP_R32, R.ECX),
+                ),
                 I.create_reg_u32(C.SUB_RM32_IMM8, R.ESP, 0x4),
                 I.create_reg(C.PUSH_R32, R.EAX),
                 I.create_reg(C.PUSH_R32, R.ECX),
                 I.create_reg(C.PUSH_R32, R.EDX),
                 # get g_pVGuiLocalize
-                I.create_branch(C.CALL_REL32_32, 0x19e00),
+                I.create_branch(C.CALL_REL32_32, sym.code('get_vgui_localize')),
                 I.create_reg_mem(C.MOV_R32_RM32, R.EDX, M(R.EAX)),
                 I.create_u32(C.PUSHD_IMM32, 0x2),
                 I.create_reg_mem(C.LEA_R32_M, R.EAX, M(R.ESP, displ=0x10, displ_size=1)),
@@ -335,14 +745,20 @@ MOD_DLLS = {
                 I.create_reg_mem(C.MOV_R16_RM16, R.AX, M(R.ESP)),
                 I.create_reg_u32(C.ADD_RM32_IMM8, R.ESP, 0x4),
                 I.create(C.RETND),
-            ])),
-        ])(0x10000000, 0x35000, 0x4e000, [0, 0x100, 0x200, 0x300], [0x800]),
+            ]),
+            # CWin32Font::Create, the charset instruction and the next ones jump to the hook,
+            # read them before the jump is written
+            (sym.label('create_font.moved'), move_code(0x15f7d, 2, 0x18)),
+            (0x15f7a, [
+                I.create_branch(C.JMP_REL32_32, sym.code('create_font')),
+            ]),
+        ],
     },
     'vstdlib': {
         'path': 'Bin',
         'file': 'vstdlib.dll',
         'md5':  '82791036bdadc8e08cfd5ee46823944a',
-        'patch': [
+        'patch': lambda: [
             # Q_isprint
 ##            (0x40D4, [
 ##                I.create(C.RETND),
@@ -356,7 +772,7 @@ MOD_DLLS = {
         'path': 'Bin',
         'file': 'vgui2.dll',
         'md5':  '21347f4265fa01173f09e31dc57ddbce',
-        'patch': [
+        'patch': lambda: [
 ##            # CLocalizedStringTable::ConvertANSIToUnicode CP_ACP -> CP_OEMCP (GBK)
 ##            (0x9373, [
 ##                I.create_u32(C.PUSHD_IMM8, 1),
@@ -384,22 +800,24 @@ MOD_DLLS = {
         'path': 'Unofficial_Patch\cl_dlls',
         'file': 'client.dll',
         'md5':  '1c80bb0ae0486c9dfb6ecc35c604b050',
-        'patch': (lambda base_addr, code_ext, data_ext, hooks, funcs:[
-            #(code_ext - 1, b'\xcc\xcc'), # force extend code sect
+        # new sects are inserted before .reloc, .chrst follows the packed .hook
+        'layout': {'base': 0x10000000, 'code': 0x683000},
+        'patch': lambda sym: [
+            #(sym.code_ext - 1, b'\xcc\xcc'), # force extend code sect
             # insert new sect before .reloc
-            (code_ext, insert_sect(data_ext - code_ext, {
+            (sym.code_ext, insert_sect(sym.data_ext - sym.code_ext, {
                 'name': '.hook', 'like': '.text',
             })),
-            (data_ext, insert_sect(0x10, {
+            (sym.data_ext, insert_sect(0x10, {
                 'name': '.chrst', 'like': '.rdata',
             })),
             # insert new gbk charset
-            (data_ext, vtmb_fbm_charset()),
+            (sym.data_ext, vtmb_fbm_charset()),
             # replace old ascii charset from 0x1b to 0x7f
-            (data_ext + (0x80+0x1b)*8, from_mem((0x232ee8, 0x233210))),
+            (sym.data_ext + (0x80+0x1b)*8, from_mem((0x232ee8, 0x233210))),
             # a func which split text to multi lines, here find breakable position
             (0x55075, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[0]),
+                I.create_branch(C.JMP_REL32_32, sym.code('find_breakable')),
             ]),
             # mabe a bug, that make the 1st line shorter than others.
             (0x550e3, [
@@ -420,7 +838,7 @@ MOD_DLLS = {
                 I.create_reg(C.PUSH_R32, R.ECX),
             ]),
             # subtitle linebreak modify
-            (0xf223b, with_label_ctx(lambda lbc: [
+            (0xf223b, sym.local('subtitle_lnbrk', lambda lbc: [
                 # mod width_limit_len if the last char is not space
                 I.create_reg(C.PUSH_R32, R.EAX),
                 I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.EBP, displ=-0x10, displ_size=1)),
@@ -476,28 +894,28 @@ MOD_DLLS = {
             ])),
             # draw_text_info init stack
             (0x1ae72a, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[9]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dti_init_stack')),
             ]),
             # draw_text_info cache a char for next calc
             (0x1ae7f5, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[10]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dti_cache_char')),
                 I.create(C.NOPD),
             ]),
             # draw_text_info record char_index
             (0x1ae8e1, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[11]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dti_record_index')),
                 I.create(C.NOPD),
                 I.create(C.NOPD),
                 I.create(C.NOPD),
             ]),
             # draw_text_info make a line start position table
             (0x1aea1d, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[1]),
+                I.create_branch(C.JMP_REL32_32, sym.code('line_start_tab')),
                 I.create(C.NOPD),
             ]),
             # draw_text_info load char_index
             (0x1aebb2, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[12]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dti_load_index')),
                 I.create(C.NOPD),
             ]),
             # terminal buff clean
@@ -514,50 +932,50 @@ MOD_DLLS = {
             ]),
             # terminal char encode
             (0xc8060, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[2]),
+                I.create_branch(C.JMP_REL32_32, sym.code('term_char_encode')),
                 I.create(C.NOPD),
             ]),
             # terminal charset read
             (0xc79d5, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[3]),
+                I.create_branch(C.JMP_REL32_32, sym.code('term_charset_read')),
             ]),
             # terminal charset from .chrst
             (0xc7a36, [
-                I.create_reg_mem(C.MOV_R8_RM8, R.DL, M(R.EBX, index=R.EAX, scale=8, displ=base_addr+data_ext, displ_size=4)),
+                I.create_reg_mem(C.MOV_R8_RM8, R.DL, M(R.EBX, index=R.EAX, scale=8, displ=sym.va(sym.data_ext), displ_size=4)),
             ]),
             # terminal charset draw width
 ##            (0xc7a3f, [
 ##                I.create_reg_u32(C.MOV_R32_IMM32, R.EDX, 0x8),
 ##            ]),
             (0xc7a3d, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[4]),
+                I.create_branch(C.JMP_REL32_32, sym.code('term_char_width')),
                 I.create(C.NOPD),
                 I.create(C.NOPD),
             ] if MOD_OPTION['terminal_8bits'] else None),
             # dialog choice linebreak modify
             # dlg_chc_lnbrk init loop
             (0x53d5c,[
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[5]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dlg_lnbrk_init')),
                 I.create(C.NOPD),
             ]),
             # dlg_chc_lnbrk find breakable char
             (0x53dca,[
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[6]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dlg_lnbrk_find')),
             ]),
             # dlg_chc_lnbrk modify breakable char to EOS
             (0x53d6c,[
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[7]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dlg_lnbrk_eos')),
                 I.create(C.NOPD), I.create(C.NOPD),
                 I.create(C.NOPD), I.create(C.NOPD),
             ]),
             # dlg_chc_lnbrk recover breakable char
             (0x53d7b,[
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[8]),
+                I.create_branch(C.JMP_REL32_32, sym.code('dlg_lnbrk_recover')),
                 I.create(C.NOPD),
                 I.create(C.NOPD),
             ]),
             # hooks find breakable char
-            (code_ext + hooks[0], with_label_ctx(lambda lbc: [
+            sym.hook('find_breakable', lambda lbc: [
                 I.create_reg_reg(C.MOV_R32_RM32, R.EDX, R.EBP),
                 I.create_reg_reg(C.XOR_R32_RM32, R.EAX, R.EAX),
                 I.create_reg_reg(C.XOR_R32_RM32, R.ECX, R.ECX),
@@ -613,9 +1031,9 @@ MOD_DLLS = {
                 I.create_branch(C.JB_REL32_32, lbc.lb('loop')),
                 # ret
                 I.create_branch(C.JMP_REL32_32, 0x55083),
-            ])),
+            ]),
             # hooks draw_text_info record line start position
-            (code_ext + hooks[1], with_label_ctx(lambda lbc: [
+            sym.hook('line_start_tab', lambda lbc: [
                 I.create_mem_reg(C.MOV_RM32_R32, M(R.ECX, index=R.EAX, scale=4), R.EBX),
                 # check cur-byte-2 flag
                 I.create_mem_u32(C.CMP_RM8_IMM8, M(R.ESP, displ=0x1a, displ_size=1), 0),
@@ -626,9 +1044,9 @@ MOD_DLLS = {
                     I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.EBP)),
                 ),
                 I.create_branch(C.JMP_REL32_32, 0x1aea23),
-            ])),
+            ]),
             # hooks terminal char encode
-            (code_ext + hooks[2], with_label_ctx(lambda lbc: [
+            sym.hook('term_char_encode', lambda lbc: [
                 I.create_reg(C.PUSH_R32, R.EBX),
                 I.create_reg_mem(C.MOV_R32_RM32, R.EBX, M(R.ESP, displ=0x8)),
                 I.create_reg(C.PUSH_R32, R.ESI),
@@ -717,14 +1135,14 @@ MOD_DLLS = {
                 ),
                 I.create_reg_reg(C.MOV_R32_RM32, R.ECX, R.ESI),
                 I.create_branch(C.JMP_REL32_32, 0xc8066),
-            ])),
+            ]),
             # hooks terminal charset read
-            (code_ext + hooks[3], with_label_ctx(lambda lbc: [
+            sym.hook('term_charset_read', lambda lbc: [
                 I.create_reg_u32(C.OR_RM16_IMM16, R.AX, 0x80),
                 I.create_branch(C.JMP_REL32_32, 0xc7a11),
-            ])),
+            ]),
             # hooks terminal charset draw width
-            (code_ext + hooks[4], with_label_ctx(lambda lbc: [
+            sym.hook('term_char_width', lambda lbc: [
                 #I.create_reg_u32(C.CMP_EAX_IMM32, R.EAX, 0x2020),
                 #I.create_branch(C.JE_REL32_32, lbc.lb('7b')),
                 I.create_reg_u32(C.CMP_EAX_IMM32, R.EAX, 0x100),
@@ -739,16 +1157,16 @@ MOD_DLLS = {
                 ),
                 I.create_reg_u32(C.MOV_R32_IMM32, R.EDX, 0x7),
                 I.create_branch(C.JMP_REL32_32, 0xc7a44),
-            ])),
+            ]),
             # hook dlg_chc_lnbrk init loop
-            (code_ext + hooks[5], with_label_ctx(lambda lbc: [
+            sym.hook('dlg_lnbrk_init', lambda lbc: [
                 I.create_reg_reg(C.XOR_R32_RM32, R.EDX, R.EDX),
                 I.create_reg_mem(C.MOV_R32_RM32, R.ECX, M(R.ESP, displ=0x28, displ_size=1)),
                 I.create_reg_reg(C.TEST_RM32_R32, R.ECX, R.ECX),
                 I.create_branch(C.JMP_REL32_32, 0x53d62),
-            ])),
+            ]),
             # hook dlg_chc_lnbrk find breakable char
-            (code_ext + hooks[6], with_label_ctx(lambda lbc: [
+            sym.hook('dlg_lnbrk_find', lambda lbc: [
                 # check byte-2 flag
                 I.create_reg_reg(C.TEST_RM8_R8, R.DH, R.DH),
                 I.create_branch(C.JNE_REL32_32, lbc.lb('pre-breakable')),
@@ -787,9 +1205,9 @@ MOD_DLLS = {
                 lbc.add('unbreakable',
                     I.create_branch(C.JMP_REL32_32, 0x53dd3),
                 ),
-            ])),
+            ]),
             # hook dlg_chc_lnbrk modify breakable char to EOS
-            (code_ext + hooks[7], with_label_ctx(lambda lbc: [
+            sym.hook('dlg_lnbrk_eos', lambda lbc: [
                 # read breakable char
                 I.create_reg_mem(C.MOV_R8_RM8, R.DL, M(R.ESP, index=R.EBX, displ=0x30, displ_size=1)),
                 # shift ebx to save breakable char
@@ -809,9 +1227,9 @@ MOD_DLLS = {
                 # done
                 I.create_reg_mem(C.LEA_R32_M, R.EDX, M(R.ESP, index=R.ESI, displ=0x30, displ_size=1)),
                 I.create_branch(C.JMP_REL32_32, 0x53d75),
-            ])),
+            ]),
             # hook dlg_chc_lnbrk recover breakable char
-            (code_ext + hooks[8], with_label_ctx(lambda lbc: [
+            sym.hook('dlg_lnbrk_recover', lambda lbc: [
                 # recover ebx
                 I.create_reg_reg(C.MOV_R8_RM8, R.CL, R.BL),
                 I.create_reg_u32(C.SHR_RM32_IMM8, R.EBX, 16),
@@ -826,15 +1244,15 @@ MOD_DLLS = {
                 ),
                 I.create_reg_u32(C.ADD_RM32_IMM8, R.ESP, 4),
                 I.create_branch(C.JMP_REL32_32, 0x53d82),
-            ])),
+            ]),
             # hook draw_text_info init stack
-            (code_ext + hooks[9], with_label_ctx(lambda lbc: [
+            sym.hook('dti_init_stack', lambda lbc: [
                 I.create_mem_u32(C.MOV_RM8_IMM8, M(R.ESP, displ=0x12, displ_size=1), 0),
                 I.create_mem_u32(C.MOV_RM32_IMM32, M(R.ESP, displ=0x18, displ_size=1), 0),
                 I.create_branch(C.JMP_REL32_32, 0x1ae72f),
-            ])),
+            ]),
             # hook draw_text_info cache a char for next calc
-            (code_ext + hooks[10], with_label_ctx(lambda lbc: [
+            sym.hook('dti_cache_char', lambda lbc: [
                 # read and check byte-2 flag
                 I.create_reg_mem(C.MOV_R8_RM8, R.AH, M(R.ESP, displ=0x19, displ_size=1)),
                 I.create_reg_reg(C.TEST_RM8_R8, R.AH, R.AH),
@@ -862,9 +1280,9 @@ MOD_DLLS = {
                 ),
                 I.create_reg_u32(C.CMP_AL_IMM8, R.AL, 1),
                 I.create_branch(C.JMP_REL32_32, 0x1ae7fb),
-            ])),
+            ]),
             # hook draw_text_info record char_index
-            (code_ext + hooks[11], with_label_ctx(lambda lbc: [
+            sym.hook('dti_record_index', lambda lbc: [
                 # read cur-byte-2 and byte-2
                 I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x18, displ_size=1)),
                 # put them highest 16b in eax
@@ -877,9 +1295,9 @@ MOD_DLLS = {
                 # done
                 I.create_reg_mem(C.MOV_R8_RM8, R.AL, M(R.ESP, displ=0x11, displ_size=1)),
                 I.create_branch(C.JMP_REL32_32, 0x1ae8e9),
-            ])),
+            ]),
             # hook draw_text_info load char_index
-            (code_ext + hooks[12], with_label_ctx(lambda lbc: [
+            sym.hook('dti_load_index', lambda lbc: [
                 # read merged index
                 I.create_reg_mem(C.MOV_R32_RM32, R.EAX, M(R.ESP, displ=0x3c, displ_size=1)),
                 # load ebx
@@ -890,46 +1308,40 @@ MOD_DLLS = {
                 I.create_mem_reg(C.MOV_RM8_R8, M(R.ESP, displ=0x1a, displ_size=1), R.AH),
                 #done
                 I.create_branch(C.JMP_REL32_32, 0x1aebc4),
-            ])),
-        ])(0x10000000, 0x683000, 0x685000, [0x0, 0x100, 0x200, 0x300, 0x380, 0x400, 0x480, 0x500, 0x580, 0x600, 0x680, 0x700, 0x780], []),
+            ]),
+        ],
     },
     'engine': {
         'path': 'Bin',
         'file': 'engine.dll',
         #'md5':  'fafa9e361f08c505a63b1b5a353b2b01',
         'md5':  'bfc51e7dc7988107d6942caae20d9fe6',
-        'patch': (lambda base_addr, code_ext, data_ext, hooks, funcs:[
-            #(code_ext - 1, b'\xcc\xcc'), # force extend code sect
+        'layout': {'base': 0x10000000, 'code': 0x1391000},
+        'patch': lambda sym: [
+            #(sym.code_ext - 1, b'\xcc\xcc'), # force extend code sect
             # insert new sect before .reloc
-            (code_ext, insert_sect(data_ext - code_ext, {
+            (sym.code_ext, insert_sect(sym.data_ext - sym.code_ext, {
                 'name': '.hook', 'like': '.text',
             })),
+            (sym.data_ext, insert_sect(0x10, {
+                'name': '.lnbrk', 'like': '.rdata',
+            })),
+            sym.const('lnbrk_map', lnbrk_bitmap(MOD_OPTION['subtitle_lnbrk_punct'])),
             # auto line break in subtitle
             (0xDB803, [
-                I.create_branch(C.JMP_REL32_32, code_ext + hooks[0]),
+                I.create_branch(C.JMP_REL32_32, sym.code('subtitle_lnbrk')),
                 I.create(C.NOPD),
             ]),
-            (code_ext + hooks[0], with_label_ctx(lambda lbc: [
+            sym.hook('subtitle_lnbrk', lambda lbc: [
                 I.create_reg_reg(C.MOV_R32_RM32, R.EBP, R.EBX),
                 I.create_branch(C.CALL_REL32_32, lbc.lb('func_getc')),
                 I.create_reg_reg(C.TEST_RM16_R16, R.AX, R.AX),
                 I.create_branch(C.JE_REL32_32, lbc.lb('ph2')),
                 
                 lbc.add('ph1',
-                    I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0x2e), # "."
+                    I.create_branch(C.CALL_REL32_32, lbc.lb('func_isbrk')),
                 ),
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph1done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0x3f), # "?"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph1done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0x21), # "!"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph1done')),
-
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0xbfa3), # "？"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph1done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0xa1a3), # "！"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph1done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0xa3a1), # "。"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph1done')),
+                I.create_branch(C.JB_REL32_32, lbc.lb('ph1done')),
                 
                 I.create_branch(C.CALL_REL32_32, lbc.lb('func_nxtc')),
                 I.create_branch(C.CALL_REL32_32, lbc.lb('func_getc')),
@@ -945,19 +1357,8 @@ MOD_DLLS = {
                     I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0x20), # " "
                 ),
                 I.create_branch(C.JE_REL32_32, lbc.lb('done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0x2e), # "."
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph2done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0x3f), # "?"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph2done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0x21), # "!"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph2done')),
-
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0xbfa3), # "？"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph2done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0xa1a3), # "！"
-                I.create_branch(C.JE_REL32_32, lbc.lb('ph2done')),
-                I.create_reg_u32(C.CMP_AX_IMM16, R.AX, 0xa3a1), # "。"
-                I.create_branch(C.JNE_REL32_32, lbc.lb('done')),
+                I.create_branch(C.CALL_REL32_32, lbc.lb('func_isbrk')),
+                I.create_branch(C.JAE_REL32_32, lbc.lb('done')),
 
                 lbc.add('ph2done',
                     I.create_branch(C.CALL_REL32_32, lbc.lb('func_nxtc')),
@@ -981,6 +1382,15 @@ MOD_DLLS = {
                     I.create(C.RETND),
                 ),
 
+                # function is_breakable, CF set for the chars in lnbrk_map
+                lbc.add('func_isbrk',
+                    I.create_reg(C.PUSH_R32, R.ECX),
+                ),
+                I.create_reg_reg(C.MOVZX_R32_RM16, R.ECX, R.AX),
+                I.create_mem_reg(C.BT_RM32_R32, M(displ=sym.data('lnbrk_map', 0x2000), displ_size=4), R.ECX),
+                I.create_reg(C.POP_R32, R.ECX),
+                I.create(C.RETND),
+
                 # function next_char
                 lbc.add('func_nxtc',
                     I.create_reg_u32(C.CMP_AL_IMM8, R.AL, 0x80),
@@ -992,856 +1402,155 @@ MOD_DLLS = {
                 ),
                 I.create(C.RETND),
                 
-            ])),
-        ])(0x10000000, 0x1391000, 0x1392000, [0], []),
+            ]),
+        ],
     },
 }
 
-def hash_md5(val):
-    return _md5(val).hexdigest()
-
-def report(*args):
-    r = ' '.join(args)
-    print(r)
-    return r
-
-alignup   = lambda v, a: ((v - 1) // a + 1) * a
-aligndown = lambda v, a: (v // a) * a
-
-def readval_le(raw, offset, size, signed):
-    neg = False
-    v = 0
-    endpos = offset + size - 1
-    for i in range(endpos, offset - 1, -1):
-        b = raw[i]
-        if signed and i == endpos and b > 0x7f:
-            neg = True
-            b &= 0x7f
-        #else:
-        #    b &= 0xff
-        v <<= 8
-        v += b
-    return v - (1 << (size*8 - 1)) if neg else v
-
-def writeval_le(val, dst, offset, size):
-    if val < 0:
-        val += (1 << (size*8))
-    for i in range(offset, offset + size):
-        dst[i] = (val & 0xff)
-        val >>= 8
-
-class c_mark:
-
-    def __init__(self, raw, offset):
-        self._raw = raw
-        self._mod = None
-        self.offset = offset
-        self.parent = None
-        self._par_offset = 0
-
-    @property
-    def raw(self):
-        if self.parent:
-            return self.parent.raw
-        return self._mod if not self._mod is None else self._raw
-
-    @property
-    def mod(self):
-        if self.parent:
-            return self.parent.mod
-        if self._mod is None:
-            self._mod = bytearray(self._raw)
-        return self._mod
-
-    @property
-    def par_offset(self):
-        po = self._par_offset
-        if self.parent:
-            po += self.parent.par_offset
-        return po
-
-    @property
-    def real_offset(self):
-        return self.par_offset + self.offset
-
-    def shift(self, offs):
-        self._par_offset += offs
-
-    def extendto(self, cnt):
-        extlen = self.offset + cnt - len(self.raw)
-        if extlen > 0:
-            self.mod.extend(bytes(extlen))
-
-    def readval(self, pos, cnt, signed):
-        return readval_le(self.raw, self.offset + pos, cnt, signed)
-
-    def writeval(self, val, pos, cnt):
-        self.extendto(pos + cnt)
-        writeval_le(val, self.mod, self.offset + pos, cnt)
-
-    def fill(self, val, pos, cnt):
-        for i in range(pos, pos + cnt):
-            self.mod[i] = val
-
-    I8  = lambda self, pos: self.readval(pos, 1, True)
-    U8  = lambda self, pos: self.readval(pos, 1, False)
-    I16 = lambda self, pos: self.readval(pos, 2, True)
-    U16 = lambda self, pos: self.readval(pos, 2, False)
-    I32 = lambda self, pos: self.readval(pos, 4, True)
-    U32 = lambda self, pos: self.readval(pos, 4, False)
-    I64 = lambda self, pos: self.readval(pos, 8, True)
-    U64 = lambda self, pos: self.readval(pos, 8, False)
-
-    W8  = lambda self, val, pos: self.writeval(val, pos, 1)
-    W16 = lambda self, val, pos: self.writeval(val, pos, 2)
-    W32 = lambda self, val, pos: self.writeval(val, pos, 4)
-    W64 = lambda self, val, pos: self.writeval(val, pos, 8)
-
-    def BYTES(self, pos, cnt):
-        st = self.offset + pos
-        if cnt is None:
-            ed = None
-        else:
-            ed = st + cnt
-            self.extendto(pos + cnt)
-        return self.raw[st: ed]
-
-    def WBYTES(self, dst, pos):
-        st = self.offset + pos
-        cnt = len(dst)
-        ed = st + cnt
-        self.extendto(pos + cnt)
-        self.mod[st: ed] = dst
-        return cnt
-
-    def STR(self, pos, cnt, codec = 'utf8'):
-        return self.BYTES(pos, cnt).split(b'\0')[0].decode(codec)
-
-    def WSTR(self, dst, pos, codec = 'utf8'):
-        b = dst.encode(codec)
-        if b[-1] != 0:
-            b += b'\0'
-        return self.WBYTES(b, pos)
-
-    def BYTESN(self, pos):
-        st = self.offset + pos
-        rl = len(self.raw)
-        ed = rl
-        for i in range(st, rl):
-            if self.raw[i] == 0:
-                ed = i
-                break
-        return self.raw[st:ed], ed - st
-
-    def STRN(self, pos, codec = 'utf8'):
-        b, n = self.BYTESN(pos)
-        return b.decode(codec), n
-
-    def sub(self, pos, length = None):
-        if length is None:
-            s = c_mark(None, self.offset + pos)
-            s.parent = self
-        else:
-            s = c_mark(None, 0)
-            s._mod = bytearray(self.BYTES(pos, length))
-            s._par_offset = self.real_offset + pos
-        return s
-
-class c_pe_file(c_mark):
-
-    def __init__(self, raw):
-        super().__init__(raw, 0)
-        self.parse_head()
-
-    def parse_head(self):
-        if self.U16(0) != 0x5a4d:
-            raise ValueError(report('invalid PE header'))
-        self.parse_coff(self.sub(self.U32(0x3c)))
-
-    def parse_coff(self, mark):
-        self.mark_coff = mark
-        if mark.U32(0) != 0x4550:
-            raise ValueError(report('invalid COFF header'))
-        self.num_sect = mark.U16(0x6)
-        self.parse_opt_coff(mark.sub(0x18), mark.U16(0x14))
-
-    def parse_opt_coff(self, mark, size):
-        if size < 0x1c:
-            self.parse_opt_win(mark.sub(size) if size > 0 else mark, 0)
-            return
-        self.mark_opt_coff = mark
-        magic = mark.U16(0)
-        if magic == 0x10b:
-            self.flag_32plus = False
-        elif magic == 0x20b:
-            self.flag_32plus = True
-        else:
-            raise ValueError(report('invalid magic'))
-        self.size_code = mark.U32(0x4)
-        self.size_idat = mark.U32(0x8)
-        self.size_udat = mark.U32(0xc)
-        self.addr_entry = mark.U32(0x10)
-        self.addr_code = mark.U32(0x14)
-        self.addr_data = mark.U32(0x18)
-        self.parse_opt_win(mark.sub(0x1c), size - 0x1c)
-
-    def parse_opt_win(self, mark, size):
-        if size < 0x44:
-            self.parse_opt_datdir(mark.sub(size) if size > 0 else mark, 0, 0)
-            return
-        self.mark_opt_win = mark
-        self.addr_base = mark.U32(0)
-        self.align_addr = mark.U32(0x4)
-        self.align_offs = mark.U32(0x8)
-        self.size_img = mark.U32(0x1c)
-        self.size_hdr = mark.U32(0x20)
-        self.parse_opt_datdir(mark.sub(0x44), size - 0x44, mark.U32(0x40))
-
-    def parse_opt_datdir(self, mark, size, num):
-        dsize = num * 0x8
-        if size < dsize:
-            self.parse_sect(mark.sub(size) if size > 0 else mark, 0)
-            return
-        assert size == dsize
-        self.mark_opt_datdir = mark
-        datdir = []
-        for i in range(num):
-            p = i * 0x8
-            mark_dd = mark.sub(i * 0x8)
-            datdir_info = {
-                'mark_h': mark_dd,
-                'addr': mark_dd.U32(0),
-                'size_v': mark_dd.U32(0x4),
-                'mark': None,
-            }
-            datdir.append(datdir_info)
-        self.tab_datdir = datdir
-        self.parse_sect(mark.sub(size), 0)
-
-    def _upd_opt_datdir(self, sect_info):
-        s_mark = sect_info['mark']
-        s_szva = self.aligned_address(sect_info['size_v'])
-        s_addr = sect_info['addr']
-        s_last = s_addr + s_szva
-        for i, datdir_info in enumerate(self.tab_datdir):
-            if datdir_info['mark']:
-                continue
-            d_addr = datdir_info['addr']
-            d_szv = datdir_info['size_v']
-            if not s_addr <= d_addr < s_last:
-                continue
-            if not d_addr + d_szv < s_last:
-                raise ValueError(report(
-                    f'data dir {i} cross section {sect_info["name"]}'))
-            datdir_info['mark'] = s_mark.sub(d_addr - s_addr)
-
-    def parse_sect(self, mark, idx):
-        if idx >= self.num_sect:
-            self.parse_tail(self.sub(self.offs_sect_nxt))
-            return
-        sect_info = {
-            'mark_h': mark,
-            'idx': idx,
-            'name': mark.STR(0, 0x8),
-            'size_v': mark.U32(0x8),
-            'addr': mark.U32(0xc),
-            'size': mark.U32(0x10),
-            'offs': mark.U32(0x14),
-        }
-        ch = mark.U32(0x24)
-        sect_info['char'] = {
-            'code': ch & 0x20,
-            'idat': ch & 0x40,
-            'udat': ch & 0x80,
-            'ncch': ch & 0x4000000,
-            'npag': ch & 0x8000000,
-            'shar': ch & 0x10000000,
-            'exec': ch & 0x20000000,
-            'read': ch & 0x40000000,
-            'writ': ch & 0x80000000,
-        }
-        sect_info['mark'] = self.sub(sect_info['offs'], sect_info['size'])
-        if idx == 0:
-            self.tab_sect = []
-        elif self.offs_sect_nxt != sect_info['offs']:
-            raise ValueError(report(
-                f'invalid offset of sect {sect_info["name"]}'))
-        self.offs_sect_nxt = sect_info['offs'] + sect_info['size']
-        self.tab_sect.append(sect_info)
-        self._upd_opt_datdir(sect_info)
-        self.parse_sect(mark.sub(0x28), idx+1)
-
-    def parse_tail(self, mark):
-        self.mark_tail = mark
-        self.offs_tail = mark.offset
-
-    def aligned_offset(self, offs):
-        return alignup(offs, self.align_offs)
-
-    def aligned_address(self, addr):
-        return alignup(addr, self.align_addr)
-
-    def _shift_sect(self, idx, elen, elen_v):
-        if idx >= len(self.tab_sect):
-            return
-        sect_info = self.tab_sect[idx]
-        mkh = sect_info['mark_h']
-        if elen > 0:
-            sect_info['offs'] += elen
-            mkh.W32(sect_info['offs'], 0x14)
-            sect_info['mark'].shift(elen)
-        if elen_v > 0:
-            sect_info['addr'] += elen_v
-            mkh.W32(sect_info['addr'], 0xc)
-        self._shift_sect(idx + 1, elen, elen_v)
-
-    def _get_sect_by_addr(self, addr, cache = None, nearest = False):
-        if cache:
-            st = cache['st']
-            ed = cache['ed']
-            if st <= addr < ed:
-                return cache['si'], addr - st
-        if nearest:
-            lst_offs = float('inf')
-            lst_si = None
-        for sect_info in self.tab_sect:
-            s_szva = self.aligned_address(sect_info['size_v'])
-            s_addr = sect_info['addr']
-            s_last = s_addr + s_szva
-            if s_addr <= addr < s_last:
-                if not cache is None:
-                    cache['st'] = s_addr
-                    cache['ed'] = s_last
-                    cache['si'] = sect_info
-                return sect_info, addr - s_addr
-            elif nearest and s_addr <= addr:
-                cur_offs = addr - s_addr
-                if cur_offs < lst_offs:
-                    lst_offs = cur_offs
-                    lst_si = sect_info
-                    if not cache is None:
-                        cache['st'] = s_addr
-                        cache['ed'] = s_last
-                        cache['si'] = sect_info
-        else:
-            if nearest and lst_si:
-                return lst_si, lst_offs
-            else:
-                raise ValueError(report(f'invalid address 0x{addr:x}'))
-
-    def _shift_addr(self, mark, moffs, st_addr, ed_addr, elen_v):
-        addr = mark.U32(moffs)
-        if addr >= st_addr and (ed_addr is None or addr < ed_addr):
-            addr += elen_v
-            mark.W32(addr, moffs)
-        return addr
-
-    def _shift_datdir_export(self, datdir_info, st_addr, ed_addr, elen_v):
-        mk = datdir_info['mark']
-        if mk.U32(0) != 0:
-            raise ValueError(report(f'invalid export tab'))
-        addr_name = self._shift_addr(mk, 0xc, st_addr, ed_addr, elen_v)
-        num_func = mk.U32(0x14)
-        num_fname = mk.U32(0x18)
-        addr_func_arr = self._shift_addr(mk, 0x1c, st_addr, ed_addr, elen_v)
-        addr_fname_arr = self._shift_addr(mk, 0x20, st_addr, ed_addr, elen_v)
-        addr_fnord_arr = self._shift_addr(mk, 0x24, st_addr, ed_addr, elen_v)
-        sect_cache = {}
-        sect_info, offs_sect = self._get_sect_by_addr(addr_func_arr, sect_cache)
-        mk_s = sect_info['mark']
-        for i in range(offs_sect, offs_sect + num_func * 0x4, 0x4):
-            self._shift_addr(mk_s, i, st_addr, ed_addr, elen_v)
-        sect_info, offs_sect = self._get_sect_by_addr(addr_fname_arr, sect_cache)
-        mk_s = sect_info['mark']
-        for i in range(offs_sect, offs_sect + num_fname * 0x4, 0x4):
-            self._shift_addr(mk_s, i, st_addr, ed_addr, elen_v)
-
-    def _shift_datdir_import(self, datdir_info, st_addr, ed_addr, elen_v):
-        mk = datdir_info['mark']
-        szv = datdir_info['size_v']
-        if szv % 0x14:
-            raise ValueError(report('invalid import table size 0x{szv}'))
-        sect_cache = {}
-        flag_32plus = self.flag_32plus
-        for i in range(0, szv - 0x14, 0x14): # last is empty
-            addr_ilt = self._shift_addr(mk, i, st_addr, ed_addr, elen_v)
-            addr_name = self._shift_addr(mk, i + 0xc, st_addr, ed_addr, elen_v)
-            addr_iat = self._shift_addr(mk, i + 0x10, st_addr, ed_addr, elen_v)
-            for addr_tab in (addr_ilt, addr_iat):
-                sect_info, offs_sect = self._get_sect_by_addr(addr_tab, sect_cache)
-                mk_s = sect_info['mark']
-                offs_idx = offs_sect
-                while True:
-                    ti_v = mk_s.U32(offs_idx)
-                    if flag_32plus:
-                        ti_v2 = mk_s.U32(offs_idx + 0x4)
-                        if ti_v == 0 and ti_v2 == 0:
-                            break
-                        ti_addr = ti_v
-                        ti_flg = ti_v2
-                    else:
-                        if ti_v == 0:
-                            break
-                        ti_addr = (ti_v & 0x7fffffff)
-                        ti_flg = (ti_v & 0x80000000)
-                    if ti_flg:
-                        report(f'warning: import tab by ord 0x{ti_addr:x}')
-                        if flag_32plus:
-                            offs_idx += 0x8
-                        else:
-                            offs_idx += 0x4
-                        continue
-                    if ti_addr >= st_addr and (ed_addr is None or ti_addr < ed_addr):
-                        ti_addr += elen_v
-                    if flag_32plus:
-                        mk_s.W32(ti_addr, offs_idx)
-                        offs_idx += 0x8
-                    else:
-                        mk_s.W32(ti_addr | ti_flg, offs_idx)
-                        offs_idx += 0x4
-
-    def _shift_datdir_reloc(self, datdir_info, st_addr, ed_addr, elen_v):
-        mk = datdir_info['mark']
-        szv = datdir_info['size_v']
-        idx = 0
-        sect_cache = {}
-        while idx < szv:
-            tbase = mk.U32(idx)
-            if tbase >= st_addr and (ed_addr is None or tbase < ed_addr):
-                tbase += elen_v
-                mk.W32(tbase, idx)
-                tb_shift = True
-            else:
-                tb_shift = False
-            idx += 0x4
-            tsize = mk.U32(idx) - 0x8
-            idx += 0x4
-            for i in range(idx, idx + tsize, 2):
-                rel_v = mk.U16(i)
-                rel_addr = (rel_v & 0xfff) + tbase
-                rel_flg = rel_v >> 12
-                if not tb_shift and rel_addr >= st_addr and (ed_addr is None or rel_addr < ed_addr):
-                    raise ValueError(report(
-                        f'reloc item 0x{rel_addr:x} shift cross block 0x{tbase:x}'))
-                if rel_flg == 0:
-                    pass
-                elif rel_flg == 3:
-                    sect_info, offs_sect = self._get_sect_by_addr(rel_addr, sect_cache)
-                    mk_s = sect_info['mark']
-                    s_addr = mk_s.U32(offs_sect)
-                    s_addr_based = s_addr - self.addr_base
-                    if s_addr_based >= st_addr and (ed_addr is None or s_addr_based < ed_addr):
-                        d_addr = s_addr + elen_v
-                        mk_s.W32(d_addr, offs_sect)
-                    #else:
-                        #report(f'warning: ref 0x{s_addr:x} < 0x{st_addr + self.addr_base:x} at 0x{rel_addr + self.addr_base:x} not changed')
-                else:
-                    report(f'warning: not implemented reloc type 0x{rel_flg:x}')
-            idx += tsize
-            if idx > szv:
-                raise ValueError(report('invalid .reloc size'))
-
-    def _shift_datdir(self, idx, st_addr, ed_addr, elen_v):
-        datdir_info = self.tab_datdir[idx]
-        if idx == 0:
-            self._shift_datdir_export(datdir_info, st_addr, ed_addr, elen_v)
-        elif idx == 0x1:
-            self._shift_datdir_import(datdir_info, st_addr, ed_addr, elen_v)
-        elif idx == 0x5:
-            self._shift_datdir_reloc(datdir_info, st_addr, ed_addr, elen_v)
-        elif idx == 0xc:
-            # IAT handled by import tab
-            pass
-        else:
-            report(f'warning: not implemented datdir({idx}) shift')
-            return NotImplemented
-
-    def _shift_datdir_tab(self, st_addr, ed_addr, elen_v):
-        mk = self.mark_opt_datdir
-        for i, datdir_info in enumerate(self.tab_datdir):
-            if datdir_info['addr'] >= st_addr and (ed_addr is None or datdir_info['addr'] < ed_addr):
-                datdir_info['addr'] += elen_v
-                datdir_info['mark_h'].W32(datdir_info['addr'], 0)
-                self._shift_datdir(i, st_addr, ed_addr, elen_v)
-
-    def ext_sect(self, idx, dlen):
-        if idx >= len(self.tab_sect):
-            return
-        sect_info = self.tab_sect[idx]
-        mks = sect_info['mark']
-        mkh = sect_info['mark_h']
-        sz = sect_info['size']
-        szv = sect_info['size_v']
-        szva = self.aligned_address(szv)
-        if dlen <= sz:
-            if dlen > szv:
-                if sect_info['char']['code']:
-                    mks.fill(0xcc, szv, dlen - szv)
-                sect_info['size_v'] = dlen
-                mkh.W32(sect_info['size_v'], 0x8)
-            return
-        dlen_f = self.aligned_offset(dlen)
-        elen = dlen_f - sz
-        sect_info['size'] = dlen_f
-        mkh.W32(sect_info['size'], 0x10)
-        mks.extendto(dlen_f)
-        elen_v = 0
-        if dlen > szv:
-            if sect_info['char']['code']:
-                mks.fill(0xcc, szv, dlen - szv)
-            elen_v = (self.aligned_address(dlen) - szva)
-            sect_info['size_v'] = dlen
-            mkh.W32(sect_info['size_v'], 0x8)
-        self._shift_sect(idx + 1, elen, elen_v)
-        shift_st_addr = sect_info['addr'] + szva
-        self._shift_datdir_tab(shift_st_addr, None, elen_v)
-        mkc = self.mark_opt_coff
-        self.addr_entry = self._shift_addr(mkc, 0x10, shift_st_addr, None, elen_v)
-        self.addr_code = self._shift_addr(mkc, 0x14, shift_st_addr, None, elen_v)
-        self.addr_data = self._shift_addr(mkc, 0x18, shift_st_addr, None, elen_v)
-        if sect_info['char']['code']:
-            self.size_code += elen_v
-            mkc.W32(self.size_code, 0x4)
-        if sect_info['char']['idat']:
-            self.size_idat += elen_v
-            mkc.W32(self.size_idat, 0x8)
-        if sect_info['char']['udat']:
-            self.size_udat += elen_v
-            mkc.W32(self.size_udat, 0xc)
-        self.size_img += elen_v
-        self.mark_opt_win.W32(self.size_img, 0x1c)
-        self.offs_tail += elen
-
-    def _insert_sect(self, src_sect_info, cfg):
-        mkh = src_sect_info['mark_h'].sub(0, 0x28)
-        sidx = src_sect_info['idx']
-        sect_info = {
-            'mark_h': mkh,
-            'idx': sidx,
-            'name': cfg['name'],
-            'size_v': 0,
-            'addr': src_sect_info['addr'],
-            'size': 0,
-            'offs': src_sect_info['offs'],
-        }
-        mkh.WSTR((sect_info['name'] + '\0'*8)[:8], 0x0)
-        mkh.W32(sect_info['size_v'], 0x8)
-        mkh.W32(sect_info['addr'], 0xc)
-        mkh.W32(sect_info['size'], 0x10)
-        mkh.W32(sect_info['offs'], 0x14)
-        flg = cfg['char']
-        sect_info['char'] = {
-            'code': 0x20 if 'code' in flg and flg['code'] else 0,
-            'idat': 0x40 if 'idat' in flg and flg['idat'] else 0,
-            'udat': 0x80 if 'udat' in flg and flg['udat'] else 0,
-            'ncch': 0x4000000 if 'ncch' in flg and flg['ncch'] else 0,
-            'npag': 0x8000000 if 'npag' in flg and flg['npag'] else 0,
-            'shar': 0x10000000 if 'shar' in flg and flg['shar'] else 0,
-            'exec': 0x20000000 if 'exec' in flg and flg['exec'] else 0,
-            'read': 0x40000000 if 'read' in flg and flg['read'] else 0,
-            'writ': 0x80000000 if 'writ' in flg and flg['writ'] else 0,
-        }
-        ch = 0
-        for v in sect_info['char'].values():
-            ch |= v
-        mkh.W32(ch, 0x24)
-        sect_info['mark'] = self.sub(sect_info['offs'], sect_info['size'])
-        tab_sect = self.tab_sect
-        for idx in range(sidx, len(tab_sect)):
-            shft_sect_info = tab_sect[idx]
-            shft_sect_info['idx'] += 1
-        tab_sect.insert(sidx, sect_info)
-        self.num_sect += 1
-        self.mark_coff.W16(self.num_sect, 0x6)
-
-    def insert_sect(self, idx, dlen, cfg):
-        if idx >= len(self.tab_sect):
-            return
-        src_sect_info = self.tab_sect[idx]
-        self._insert_sect(src_sect_info, cfg)
-        self.ext_sect(idx, dlen)
-
-    def _access(self, a_st, a_ed, ext = True):
-        sect_info, offs_sect = self._get_sect_by_addr(a_st, None, True)
-        s_st = sect_info['addr']
-        s_ed = s_st + sect_info['size']
-        s_ed_v = s_st + sect_info['size_v']
-        if a_ed > s_ed or a_ed > s_ed_v:
-            if ext:
-                self.ext_sect(sect_info['idx'], a_ed - s_st)
-            else:
-                raise ValueError(report(
-                    f'access 0x{a_st:x}/0x{a_ed:x} cross section {sect_info["name"]}'))
-        return sect_info, offs_sect
-
-    def read(self, r_addr, rlen):
-        sect_info, offs_sect = self._access(r_addr, r_addr + rlen, False)
-        mk = sect_info['mark']
-        return mk.BYTES(offs_sect, rlen)
-
-    def replace(self, r_addr, dst):
-        rlen = len(dst)
-        sect_info, offs_sect = self._access(r_addr, r_addr + rlen)
-        mk = sect_info['mark']
-        for i, b in enumerate(dst):
-            mk.W8(b, offs_sect + i)
-        return offs_sect + sect_info['offs']
-
-    def _shift(self, mk, offs_sect, s_len, shft_len):
-        if shft_len < 0:
-            s_offs = offs_sect - shft_len
-            rng = range(s_offs, s_offs + s_len)
-        else:
-            s_offs = offs_sect
-            rng = range(s_offs + s_len - 1, s_offs - 1, -1)
-        for i in rng:
-            mk.W8(mk.U8(i), i + shft_len)
-        return s_offs, s_offs + shft_len
-
-    def shift(self, s_st, s_len, shft_len):
-        s_ed = s_st + s_len
-        d_st = s_st + shft_len
-        d_ed = s_ed + shft_len
-        a_st = min(s_st, d_st)
-        a_ed = max(s_ed, d_ed)
-        sect_info, offs_sect = self._access(a_st, a_ed)
-        mk = sect_info['mark']
-        r_st, r_ed = self._shift(mk, offs_sect, s_len, shft_len)
-        self._shift_datdir_tab(s_st, s_ed, shft_len)
-        return r_st, r_ed
-
-    def _cfg_sect(self, cfg):
-        ncfg = {}
-        if 'like' in cfg:
-            lsname = cfg['like']
-            for sect_info in self.tab_sect:
-                if sect_info['name'] == lsname:
-                    ncfg['char'] = sect_info['char'].copy()
-                    break
-        for k, v in cfg.items():
-            if k == 'char' and k in ncfg:
-                ncfg[k].update(v)
-            else:
-                ncfg[k] = v
-        return ncfg
-
-    def insert(self, s_st, s_len, cfg):
-        src_sect_info, offs_sect = self._get_sect_by_addr(s_st, None, True)
-        sidx = src_sect_info['idx']
-        self.insert_sect(sidx, offs_sect + s_len, self._cfg_sect(cfg))
-        sect_info = self.tab_sect[sidx]
-        return sect_info['offs'] + offs_sect, sect_info['offs'], sect_info['size']
-
-    def _page_aligned_base(self, addr):
-        page_len = 0x1000
-        return aligndown(addr, page_len)
-
-    def _page_ed(self, st_addr):
-        page_len = 0x1000
-        assert not st_addr % page_len
-        return st_addr + page_len
-
-    def _find_reloc_block_remain(self, mk, blk_base, blk_offs, blk_size, rng_addr, is_first):
-        lst_i = 0
-        for i in range(0, blk_size, 2):
-            rel_v = mk.U16(blk_offs + i)
-            rel_addr = (rel_v & 0xfff) + blk_base
-            rel_flg = rel_v >> 12
-            if rel_flg == 0:
-                pass
-            elif rel_flg == 3:
-                if rng_addr <= rel_addr:
-                    break
-                lst_i = i + 2
+def resolve_patch(sinfo, bitness = 32, syms = None):
+    patch = sinfo['patch']
+    if not callable(patch):
+        return patch
+    load_iced()
+    if not 'layout' in sinfo:
+        return patch()
+    # build once to size the blocks, and again with the packed symbols
+    lyt = c_patch_layout(sinfo['layout'])
+    lyt.pack(lyt.merge(patch(lyt)), bitness)
+    patch = lyt.merge(patch(lyt))
+    if not syms is None:
+        syms.update(lyt.symbols())
+    return patch
+
+# single pass block assembler, branch sizing follows X.BlockEncoder
+class c_asm_block:
+
+    max_iters = 5
+
+    def __init__(self, bitness, seg, rip):
+        load_iced()
+        self.bitness = bitness
+        self.rip = rip
+        self.inss = [ins.copy() for ins in seg]
+        lbs = {}
+        dup_zero = False
+        for i, ins in enumerate(self.inss):
+            o_ip = ins.ip
+            if o_ip in lbs:
+                if o_ip != 0:
+                    raise ValueError(report(f'multiple instructions with ip 0x{o_ip:x}'))
+                dup_zero = True
             else:
-                report(f'warning: not implemented reloc type 0x{rel_flg:x} at 0x{blk_offs+i:x}')
-        if is_first:
-            return lst_i
+                lbs[o_ip] = i
+        if dup_zero:
+            del lbs[0]
+        br_kinds = (X.OpKind.NEAR_BRANCH16, X.OpKind.NEAR_BRANCH32, X.OpKind.NEAR_BRANCH64)
+        self.infos = []
+        for ins in self.inss:
+            info = {
+                'size': 0,
+                'done': True,
+            }
+            if any(ins.op_kind(i) in br_kinds for i in range(ins.op_count)):
+                tgt = ins.near_branch_target
+                info['label'] = lbs.get(tgt)
+                info['target'] = tgt
+                if ins.is_jmp_short_or_near or ins.is_jcc_short_or_near:
+                    info['short'] = self._sized(ins, True)
+                    info['near'] = self._sized(ins, False)
+                    info['size'] = info['near'][1]
+                    info['done'] = False
+            self.infos.append(info)
+            if info['done']:
+                info['size'] = self._encode_len(ins, 'target' in info)
+        self._layout()
+
+    def _encode_len(self, ins, is_br):
+        ins = ins.copy()
+        if is_br:
+            ins.near_branch64 = 0
+            return X.Encoder(self.bitness).encode(ins, 0)
+        return X.Encoder(self.bitness).encode(ins, self.rip)
+
+    def _sized(self, ins, short):
+        ins = ins.copy()
+        if short:
+            ins.as_short_branch()
         else:
-            return blk_size - lst_i
-
-    def _find_reloc(self, mk, szv, rng_st_addr, rng_len):
-        rng_ed_addr = rng_st_addr + rng_len
-        reloc_st_offs = 0
-        reloc_ed_offs = None
-        blk_fst_entry_offs = None
-        blk_fst_page_addr = self._page_aligned_base(rng_st_addr)
-        blk_fst_rm_size = None
-        blk_lst_entry_offs = None
-        blk_lst_page_addr = self._page_aligned_base(rng_ed_addr - 1)
-        blk_lst_rm_size = None
-        idx = 0
-        while idx < szv:
-            blk_enttry_offs = idx
-            blk_page_st_addr = mk.U32(idx)
-            blk_page_ed_addr = self._page_ed(blk_page_st_addr)
-            idx += 0x4
-            blk_size = mk.U32(idx) - 0x8
-            idx += 0x4
-            if blk_page_ed_addr <= rng_st_addr:
-                reloc_st_offs = idx + blk_size
-            elif rng_ed_addr <= blk_page_st_addr:
+            ins.as_near_branch()
+        return ins.code, self._encode_len(ins, True)
+
+    def _target(self, info):
+        lb = info['label']
+        if lb is None:
+            return info['target']
+        return self.infos[lb]['ip']
+
+    def _optimize(self, info, gained):
+        s_code, s_size = info['short']
+        diff = self._target(info) - (info['ip'] + s_size)
+        if not info['label'] is None and diff >= 0:
+            diff -= gained
+        if -0x80 <= diff <= 0x7f:
+            info['size'] = s_size
+            info['done'] = True
+
+    def _layout(self):
+        infos = self.infos
+        ip = self.rip
+        for info in infos:
+            info['ip'] = ip
+            ip += info['size']
+        ip = self.rip
+        for info in infos:
+            info['ip'] = ip
+            if not info['done']:
+                self._optimize(info, 0)
+            ip += info['size']
+        for _ in range(self.max_iters):
+            updated = False
+            ip = self.rip
+            gained = 0
+            for info in infos:
+                info['ip'] = ip
+                if not info['done']:
+                    o_size = info['size']
+                    self._optimize(info, gained)
+                    if info['size'] < o_size:
+                        gained += o_size - info['size']
+                        updated = True
+                ip += info['size']
+            if not updated:
                 break
-            reloc_ed_offs = idx + blk_size
-            if blk_page_st_addr <= rng_st_addr < blk_page_ed_addr:
-                assert blk_fst_entry_offs is None
-                blk_fst_entry_offs = blk_enttry_offs
-                blk_fst_page_addr = blk_page_st_addr
-                blk_fst_rm_size = self._find_reloc_block_remain(
-                    mk, blk_page_st_addr, idx, blk_size, rng_st_addr, True)
-                reloc_st_offs = idx + blk_fst_rm_size
-            if blk_page_st_addr <= rng_ed_addr <= blk_page_ed_addr:
-                assert blk_lst_entry_offs is None
-                blk_lst_entry_offs = blk_enttry_offs
-                blk_lst_page_addr = blk_page_st_addr
-                blk_lst_rm_size = self._find_reloc_block_remain(
-                    mk, blk_page_st_addr, idx, blk_size, rng_ed_addr, False)
-                reloc_ed_offs = idx + blk_size - blk_lst_rm_size
-            idx += blk_size
-        assert idx <= szv
-        return (reloc_st_offs, reloc_ed_offs,
-            blk_fst_entry_offs, blk_fst_page_addr, blk_fst_rm_size,
-            blk_lst_entry_offs, blk_lst_page_addr, blk_lst_rm_size)
-
-    def _pack_reloc(self, r_st, reloc_offs):
-        reloc_pack = []
-        blk = None
-        blk_base = set()
-        for offs in sorted(reloc_offs):
-            addr = r_st + offs
-            blk_addr = self._page_aligned_base(addr)
-            offs_blk = r_st - blk_addr
-            if not blk_addr in blk_base:
-                blk = []
-                reloc_pack.append((blk_addr, blk))
-                blk_base.add(blk_addr)
-            blk.append(offs + offs_blk)
-        return reloc_pack
-
-    def update_reloc(self, r_st, r_len, reloc_offs):
-        blk_entry_len = 0x8
-        reloc_entry_len = 0x2
-        datdir_info = self.tab_datdir[0x5]
-        mk = datdir_info['mark']
-        szv = datdir_info['size_v']
-        (cut_st_offs, cut_ed_offs,
-            blk_fst_entry_offs, blk_fst_page_addr, blk_fst_rm_size,
-            blk_lst_entry_offs, blk_lst_page_addr, blk_lst_rm_size,
-        ) = self._find_reloc(mk, szv, r_st, r_len)
-        cut_len = cut_ed_offs - cut_st_offs
-        if not blk_lst_entry_offs is None and blk_fst_entry_offs != blk_lst_entry_offs:
-            cut_len -= blk_entry_len
-        tail_len = szv - cut_ed_offs
-        new_reloc_len = 0
-        reloc_pack = self._pack_reloc(r_st, reloc_offs)
-        if reloc_pack:
-            new_reloc_len = 0
-            for blk_addr, blk in reloc_pack:
-                new_reloc_len += blk_entry_len + len(blk) * reloc_entry_len
-            rp_blk_fst_page_addr = reloc_pack[0][0]
-            assert rp_blk_fst_page_addr >= blk_fst_page_addr
-            rp_blk_lst_page_addr = reloc_pack[-1][0]
-            assert rp_blk_lst_page_addr <= blk_lst_page_addr
-            skip_fst = False
-            skip_lst = False
-            if (not blk_fst_entry_offs is None
-                and rp_blk_fst_page_addr == blk_fst_page_addr):
-                new_reloc_len -= blk_entry_len
-                skip_fst = True
-            if (not blk_lst_entry_offs is None
-                and rp_blk_lst_page_addr == blk_lst_page_addr):
-                if not skip_fst:
-                    new_reloc_len -= blk_entry_len
-                skip_lst = True
-        shift_len = new_reloc_len - cut_len
-        self.shift(datdir_info['addr'] + cut_ed_offs, tail_len, shift_len)
-        datdir_info['size_v'] += shift_len
-        datdir_info['mark_h'].W32(datdir_info['size_v'], 0x4)
-        rp_blk_num = len(reloc_pack)
-        idx = cut_st_offs
-        for i, (blk_addr, blk) in enumerate(reloc_pack):
-            blk_entry_idx = idx
-            idx += blk_entry_len
-            blk_sz = len(blk) * reloc_entry_len + blk_entry_len
-            if i == 0 and skip_fst:
-                blk_entry_idx = blk_fst_entry_offs
-                blk_sz += blk_fst_rm_size
-                idx -= blk_entry_len
-            else:
-                mk.W32(blk_addr, blk_entry_idx)
-            if i == rp_blk_num - 1 and skip_lst:
-                blk_sz += blk_lst_rm_size
-            mk.W32(blk_sz, blk_entry_idx + 0x4)
-            for r_offs in blk:
-                mk.W16(0x3000 | r_offs, idx)
-                idx += reloc_entry_len
-        if not reloc_pack:
-            if blk_fst_entry_offs == blk_lst_entry_offs != None:
-                mk.W32(blk_fst_rm_size + blk_lst_rm_size + blk_entry_len,
-                    blk_fst_entry_offs + 0x4)
-            else:
-                if not blk_fst_entry_offs is None:
-                    mk.W32(blk_fst_rm_size + blk_entry_len, blk_fst_entry_offs + 0x4)
-                if not blk_lst_entry_offs is None:
-                    mk.W32(blk_lst_page_addr, idx)
-                    mk.W32(blk_lst_rm_size + blk_entry_len, idx + 0x4)
-
-    def _repack_header(self):
-        tab_sect = self.tab_sect
-        size_hdr = self.size_hdr
-        if not tab_sect:
-            yield self.BYTES(0, size_hdr)
-            return size_hdr
-        offs_1st_sect = tab_sect[0]['mark_h'].real_offset
-        yield self.BYTES(0, offs_1st_sect)
-        size_all = offs_1st_sect
-        for sect_info in tab_sect:
-            yield sect_info['mark_h'].BYTES(0, 0x28)
-            size_all += 0x28
-            if size_all > self.size_hdr:
-                raise ValueError(report(
-                    f'sect header overflow: {sect_info["name"]}'))
-        if size_all < self.size_hdr:
-            yield self.BYTES(size_all, size_hdr - size_all)
-        return size_hdr
-
-    def repack(self):
-        size_code = 0
-        size_idat = 0
-        size_udat = 0
-        size_all = yield from self._repack_header()
-        nxt_offs = size_all
-        nxt_addr = size_all
-        for sect_info in self.tab_sect:
-            if sect_info['offs'] != nxt_offs:
-                raise ValueError(report(
-                    f'invalid offset of sect {sect_info["name"]}'))
-            if sect_info['addr'] != nxt_addr:
-                raise ValueError(report(
-                    f'invalid address of sect {sect_info["name"]}'))
-            szv = self.aligned_address(sect_info['size_v'])
-            sz = sect_info['size']
-            mk = sect_info['mark']
-            yield mk.BYTES(0, sz)
-            nxt_offs = self.aligned_offset(nxt_offs + sz)
-            nxt_addr += szv
-            size_all += sz
-            if sect_info['char']['code']:
-                size_code += szv
-            if sect_info['char']['idat']:
-                size_idat += szv
-            if sect_info['char']['udat']:
-                size_udat += szv
-        if (size_code != self.size_code
-            or size_idat != self.size_idat
-            or size_udat != self.size_udat
-            or nxt_addr != self.size_img):
-            raise ValueError(report(
-                f'invalid size of sects'))
-        tl = self.mark_tail
-        if self.offs_tail != nxt_offs:
-            raise ValueError(report('invalid offset of tail'))
-        yield tl.BYTES(0, None)
+
+    def encode(self):
+        # bytes, [(offset, value) of 32 bits absolute fields], [(instruction, bytes)]
+        enc = X.Encoder(self.bitness)
+        dbyt = bytearray()
+        fixups = []
+        rins = []
+        for ins, info in zip(self.inss, self.infos):
+            ip = info['ip']
+            if 'target' in info:
+                if 'short' in info:
+                    ins.code = info['short' if info['done'] else 'near'][0]
+                ins.near_branch64 = self._target(info)
+            ins.ip = ip
+            if enc.encode(ins, ip) != info['size']:
+                raise ValueError(report(f'instruction size changed at 0x{ip:x}'))
+            ibyt = enc.take_buffer()
+            if not 'target' in info:
+                co = enc.get_constant_offsets()
+                if (co.has_displacement and co.displacement_size == 4
+                    and not ins.is_ip_rel_memory_operand):
+                    fixups.append(len(dbyt) + co.displacement_offset)
+                if co.has_immediate and co.immediate_size == 4:
+                    fixups.append(len(dbyt) + co.immediate_offset)
+            rins.append((ins, ibyt))
+            dbyt.extend(ibyt)
+        dbyt = bytes(dbyt)
+        fixups = [(offs, int.from_bytes(dbyt[offs: offs + 4], 'little')) for offs in fixups]
+        return dbyt, fixups, rins
 
 class c_pe_patcher:
 
@@ -1866,6 +1575,33 @@ class c_pe_patcher:
             if not self.patch(name):
                 report(f'warning: patch {name} failed')
 
+    def compile_all(self, fn):
+        dlls = []
+        for name, sinfo in self.src_info.items():
+            if not name in self.dst_info:
+                report(f'warning: compile {name} failed')
+                continue
+            if self.dst_info[name].get('skip'):
+                report(f'warning: compile {name} failed, disable manifest to compile')
+                continue
+            pe = self.dst_info[name]['pe']
+            pe.plan_ops = []
+            if not self.patch(name):
+                report(f'warning: compile {name} failed')
+                continue
+            dst_md5 = hash_md5(b''.join(pe.repack()))
+            dlls.append({
+                'name': name,
+                'path': sinfo['path'],
+                'file': sinfo['file'],
+                'md5': sinfo['md5'],
+                'dst_md5': dst_md5,
+                'ops': pe.plan_ops,
+            })
+            report(f'{name} compiled: {len(pe.plan_ops)} ops, patched md5: {dst_md5}')
+        save_file(fn, [pack_plan(dlls)], ())
+        report(f'plan saved to {fn}')
+
     def load_src(self, name):
         if not name in self.src_info:
             report(f'error: unknown src {name}')
@@ -1877,35 +1613,54 @@ class c_pe_patcher:
         if not os.path.exists(fn):
             report(f'error: {fn} not exist')
             return False
-        fn_b, fn_e = os.path.splitext(fn)
-        fn_src = fn_b + '_src' + fn_e
-        fn_dst = fn_b + '_dst' + fn_e
+        fn_src, fn_dst = dll_paths(fn)
         dinfo['ori_fn'] = fn
         dinfo['src_fn'] = fn_src
         dinfo['dst_fn'] = fn_dst
+        dinfo['mani_fn'] = os.path.splitext(fn)[0] + '_manifest.json'
         dinfo['load_from'] = 'ori'
-        with open(fn, 'rb') as fd:
-            raw = fd.read()
+        if 'en' in sinfo and not sinfo['en']:
+            #bypass
+            dinfo['patch'] = []
+        else:
+            dinfo['syms'] = {}
+            dinfo['patch'] = resolve_patch(sinfo, self.cfg['bitness'], dinfo['syms'])
+        if self.cfg.get('manifest', False):
+            dinfo['plan'] = self._plan_key(dinfo['patch'])
+            if self._check_manifest(dinfo, dstmd5):
+                report(f'{name} already patched, skipped')
+                dinfo['skip'] = True
+                self.dst_info[name] = dinfo
+                return True
+        use_mmap = self.cfg.get('mmap', False)
+        raw = load_file(fn, use_mmap)
         fmd5 = hash_md5(raw)
         if fmd5 != dstmd5:
             if os.path.exists(fn_src):
-                with open(fn_src, 'rb') as fd:
-                    raw = fd.read()
+                raw = load_file(fn_src, use_mmap)
                 fmd5 = hash_md5(raw)
+                dinfo['load_from'] = 'src'
             if not fmd5 == dstmd5:
                 report(f'error: {name} md5 unmatch: cur:{fmd5} dst:{dstmd5}')
                 return False
-            dinfo['load_from'] = 'src'
+        if use_mmap and dinfo['load_from'] == 'ori':
+            # the original may be overwritten by save_dst, map a matching backup
+            # instead or read the original into memory
+            raw.close()
+            raw = None
+            if os.path.exists(fn_src):
+                raw_src = load_file(fn_src, True)
+                if hash_md5(raw_src) == fmd5:
+                    raw = raw_src
+                else:
+                    raw_src.close()
+            if raw is None:
+                raw = load_file(fn)
         try:
             pe = c_pe_file(raw)
         except:
             return False
         dinfo['pe'] = pe
-        if 'en' in sinfo and not sinfo['en']:
-            #bypass
-            dinfo['patch'] = []
-        else:
-            dinfo['patch'] = sinfo['patch']
         self.dst_info[name] = dinfo
         return True
 
@@ -1915,66 +1670,235 @@ class c_pe_patcher:
             return False
         assert name in self.src_info
         dinfo = self.dst_info[name]
+        if dinfo.get('skip'):
+            return True
         fn = dinfo['ori_fn']
         fn_src = dinfo['src_fn']
         fn_dst = dinfo['dst_fn']
         pe = dinfo['pe']
         if dinfo['load_from'] == 'ori' and not os.path.exists(fn_src):
             shutil.copy2(fn, fn_src)
-        with open(fn_dst, 'wb') as fd:
-            try:
-                for d in pe.repack():
-                    fd.write(d)
-            except:
-                report(f'error: {name} repack failed')
-                return False
-        with open(fn_dst, 'rb') as fd:
-            report(f'{name} patched md5: {hash_md5(fd.read())}')
+        hashes = ['md5']
+        if self.cfg.get('sha256', False):
+            hashes.append('sha256')
+        try:
+            hvs = save_file(fn_dst, pe.repack_views(), hashes)
+        except:
+            report(f'error: {name} repack failed')
+            return False
+        report(f'{name} patched md5: {hvs["md5"]}')
+        if 'sha256' in hvs:
+            report(f'{name} patched sha256: {hvs["sha256"]}')
+        if not self.save_delta(name, hvs['md5']):
+            report(f'warning: {name} delta save failed')
         if overwrite:
             shutil.copy2(fn_dst, fn)
+            if 'plan' in dinfo:
+                self._save_manifest(dinfo, {
+                    'src_md5': self.src_info[name]['md5'],
+                    'dst_md5': hvs['md5'],
+                    'plan': dinfo['plan'],
+                    'stat': self._stat_info(fn),
+                })
+        return True
+
+    @staticmethod
+    def _stat_info(fn):
+        st = os.stat(fn)
+        return {
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'ino': st.st_ino,
+        }
+
+    def _plan_key(self, patch):
+        load_iced()
+        h = _md5(f'plan:{ICED_VER}:{patcher_src_md5()}:{self.cfg["bitness"]}:'.encode())
+        def _upd_code(code):
+            h.update(code.co_code)
+            h.update(repr(code.co_names).encode())
+            for c in code.co_consts:
+                if hasattr(c, 'co_code'):
+                    _upd_code(c)
+                else:
+                    h.update(repr(c).encode())
+        for ip, seg in patch:
+            h.update(f'{ip:x}:'.encode())
+            if callable(seg):
+                _upd_code(seg.__code__)
+                for cell in seg.__closure__ or ():
+                    h.update(repr(cell.cell_contents).encode())
+            elif isinstance(seg, (bytes, bytearray)):
+                h.update(seg)
+            else:
+                for ins in seg:
+                    h.update(ins.__getstate__())
+        return h.hexdigest()
+
+    def _check_manifest(self, dinfo, src_md5):
+        fn = dinfo['ori_fn']
+        try:
+            with open(dinfo['mani_fn'], 'r', encoding = 'utf-8') as fd:
+                mani = json.load(fd)
+        except:
+            return False
+        if mani.get('src_md5') != src_md5 or mani.get('plan') != dinfo['plan']:
+            return False
+        stat = self._stat_info(fn)
+        if mani.get('stat') == stat:
+            return True
+        # stat changed, the content may still be the patched one
+        if hash_file(fn)['md5'] != mani.get('dst_md5'):
+            return False
+        mani['stat'] = stat
+        self._save_manifest(dinfo, mani)
+        return True
+
+    def _save_manifest(self, dinfo, mani):
+        try:
+            save_file(dinfo['mani_fn'], [json.dumps(mani, indent = 1).encode('utf-8')], ())
+        except OSError:
+            report(f'warning: save manifest {dinfo["mani_fn"]} failed')
+
+    def save_syms(self, name):
+        sdir = self.cfg.get('sym_map')
+        if not sdir:
+            return
+        pe = self.dst_info[name]['pe']
+        rs = []
+        for sname, (saddr, ssize) in sorted(self.dst_info[name]['syms'].items(), key = lambda v: v[1][0]):
+            slen = '' if ssize is None else f' n:0x{ssize:04X}'
+            rs.append(f'0x{pe.addr_base + saddr:08X} {sname}{slen}\n')
+        sdir = os.path.join(self.cfg.get('work', '.'), sdir)
+        fn = os.path.join(sdir, name + '.map')
+        try:
+            os.makedirs(sdir, exist_ok = True)
+            save_file(fn, [''.join(rs).encode('utf-8')], ())
+        except OSError:
+            report(f'warning: save symbol map {fn} failed')
+            return
+        report(f'symbol map: {fn}')
+
+    @staticmethod
+    def _code_ranges(pe):
+        # (offset, end, rva) of code sections in the file
+        return [(si['offs'], si['offs'] + si['size'], si['addr'])
+            for si in pe.tab_sect if si['char']['code']]
+
+    def make_sigs(self, name, max_len = 0x40):
+        # signatures of the fixed sites in the pinned build, relocated fields
+        # and branch displacements are wildcards
+        load_iced()
+        sinfo = self.src_info[name]
+        dinfo = self.dst_info[name]
+        pe = dinfo['pe']
+        lyt = sinfo['layout']
+        sites = {}
+        for sname, sdef in lyt.get('sigs', {}).items():
+            sites[sdef[0]] = sname
+        for sname, addr in lyt.get('extern', {}).items():
+            sites.setdefault(addr, sname)
+        for addr, seg in dinfo['patch']:
+            if seg and not isinstance(addr, c_sym_addr) and addr < lyt['code']:
+                sites.setdefault(addr, f'site_{addr:x}')
+        rngs = self._code_ranges(pe)
+        relocs = set()
+        for page, blk in pe._get_reloc_tab():
+            for rel_v in blk:
+                if rel_v >> 12 == 3:
+                    relocs.update(range(page + (rel_v & 0xfff), page + (rel_v & 0xfff) + 4))
+        rs = {}
+        for addr, sname in sorted(sites.items()):
+            rng = [(st, ed, raddr) for st, ed, raddr in rngs if raddr <= addr < raddr + ed - st]
+            if not rng:
+                continue
+            st, ed, raddr = rng[0]
+            offs = addr - raddr + st
+            byt = bytes(pe.raw[offs: min(offs + max_len, ed)])
+            dec = X.Decoder(self.cfg['bitness'], byt, ip = addr)
+            wild = {i - addr for i in range(addr, addr + len(byt)) if i in relocs}
+            steps = []
+            for ins in dec:
+                if ins.is_invalid:
+                    break
+                co = dec.get_constant_offsets(ins)
+                if ins.is_call_near or ins.is_jmp_short_or_near or ins.is_jcc_short_or_near:
+                    i_offs = ins.ip - addr + co.immediate_offset
+                    wild.update(range(i_offs, i_offs + co.immediate_size))
+                steps.append(ins.next_ip - addr)
+            sig = unique_sig(pe.raw, [(s, e) for s, e, _ in rngs], offs, steps, wild)
+            if sig is None:
+                report(f'warning: {name} no unique signature for {sname} at 0x{addr:08X}')
+                continue
+            rs[sname] = (addr, sig)
+        return rs
+
+    def save_delta(self, name, dst_md5):
+        ddir = self.cfg.get('delta')
+        if not ddir:
+            return True
+        sinfo = self.src_info[name]
+        pe = self.dst_info[name]['pe']
+        ddir = os.path.join(self.cfg.get('work', '.'), ddir)
+        try:
+            os.makedirs(ddir, exist_ok = True)
+            ops = make_delta(pe)
+            save_file(os.path.join(ddir, name + '.delta'), [pack_delta({
+                'name': name,
+                'path': sinfo['path'],
+                'file': sinfo['file'],
+                'md5': sinfo['md5'],
+                'dst_md5': dst_md5,
+            }, ops)], ())
+        except:
+            return False
+        report(f'{name} delta: {sum(not isinstance(op, tuple) for op in ops)}/{len(ops)} data ops')
         return True
 
-    def _check_reloc(self, dec, ins):
-        if not (ins.memory_displ_size
-            and ins.memory_displacement
-            and (ins.memory_base == 0 or (
-                ins.memory_displ_size == 4
-                and 0x10000000 < ins.memory_displacement < 0x80000000
-                and ins.memory_segment == R.DS
-            ))):
+    def _asm_cache_path(self, name):
+        cdir = self.cfg.get('asm_cache')
+        if not name or not cdir:
+            return None
+        return os.path.join(self.cfg.get('work', '.'), cdir, name + '.json')
+
+    def _load_asm_cache(self, name):
+        fn = self._asm_cache_path(name)
+        if fn is None:
             return None
-        offs_info = dec.get_constant_offsets(ins)
-        assert (offs_info.has_displacement
-                and offs_info.displacement_size >= 4
-                and 0 < offs_info.displacement_offset < ins.len)
-        return offs_info.displacement_offset
-
-    def disasm(self, dbyt, ip, ret_ins = False):
-        dec = X.Decoder(self.cfg['bitness'], dbyt, ip = ip)
+        if not os.path.exists(fn):
+            return {}
+        try:
+            with open(fn, 'r', encoding = 'utf-8') as fd:
+                return json.load(fd)
+        except:
+            report(f'warning: invalid asm cache: {fn}')
+            return {}
+
+    def _save_asm_cache(self, name, cache):
+        fn = self._asm_cache_path(name)
+        os.makedirs(os.path.dirname(fn), exist_ok = True)
+        save_file(fn, [json.dumps(cache, indent = 1).encode('utf-8')], ())
+
+    def _asm_key(self, ip, seg):
+        load_iced()
+        h = _md5(f'fixup:{ICED_VER}:{self.cfg["bitness"]}:{ip:x}:'.encode())
+        for ins in seg:
+            h.update(ins.__getstate__())
+        return h.hexdigest()
+
+    def listing(self, rins):
+        load_iced()
         fmt = X.Formatter(X.FormatterSyntax.NASM)
         fmt.first_operand_char_index = 8
-        asm_repr = []
-        asm_reloc = []
-        if ret_ins:
-            rins = []
-        for ins in dec:
-            disasm = fmt.format(ins)
-            b_st = ins.ip - ip
-            raw = dbyt[b_st:b_st + ins.len].hex().upper()
-            asm_repr.append(f"{ins.ip:08X} {raw:20} {disasm}")
-            reloc = self._check_reloc(dec, ins)
-            if not reloc is None:
-                asm_reloc.append(b_st + reloc)
-            if ret_ins:
-                rins.append(ins)
-        if ret_ins:
-            return asm_repr, asm_reloc, rins
-        else:
-            return asm_repr, asm_reloc
+        return [f"{ins.ip:08X} {ibyt.hex().upper():20} {fmt.format(ins)}"
+            for ins, ibyt in rins]
 
-    def asm(self, patch):
+    def asm(self, patch, name = None, labels = ()):
         bitness = self.cfg['bitness']
+        lst = self.cfg.get('asm_listing', True)
         asm_patch = []
+        cache = self._load_asm_cache(name)
+        used = {}
         for ip, seg in patch:
             if not seg:
                 continue
@@ -1989,21 +1913,66 @@ class c_pe_patcher:
                 asm_info['byte'] = seg
                 continue
             asm_info['type'] = 'asm'
-            enc = X.BlockEncoder(bitness)
-            enc.add_many(seg)
-            dbyt = enc.encode(ip)
+            if not cache is None:
+                key = self._asm_key(ip, seg)
+                ent = cache.get(key)
+                if ent and (ent['repr'] or not lst):
+                    used[key] = ent
+                    asm_info['byte'] = bytes.fromhex(ent['byte'])
+                    asm_info['repr'] = ent['repr']
+                    asm_info['fixup'] = [tuple(fx) for fx in ent['fixup']]
+                    continue
+            dbyt, fixups, rins = c_asm_block(bitness, seg, ip).encode()
+            # labels are symbols resolved by the layout, they must not move
+            for ins, (rin, _) in zip(seg, rins):
+                if ins.ip in labels and ins.ip != rin.ip:
+                    raise ValueError(report(f'label 0x{ins.ip:08X} moved to 0x{rin.ip:08X}'))
             asm_info['byte'] = dbyt
-            asm_info['repr'], asm_info['reloc'] = self.disasm(dbyt, ip)
+            asm_info['fixup'] = fixups
+            asm_info['repr'] = self.listing(rins) if lst else None
+            if not cache is None:
+                used[key] = {
+                    'byte': dbyt.hex(),
+                    'repr': asm_info['repr'],
+                    'fixup': fixups,
+                }
+        # entries of changed or removed patches are dropped
+        if not cache is None and used != cache:
+            self._save_asm_cache(name, used)
         return asm_patch
 
+    def check(self, asm_patch, name, verbose = False):
+        ok = True
+        for lvl, msg in preflight(asm_patch):
+            if lvl == 'error':
+                ok = False
+            elif lvl == 'info' and not verbose:
+                continue
+            report(f'{lvl}: {name} {msg}')
+        return ok
+
     def patch(self, name):
         if not name in self.dst_info:
             report(f'error: unknown dst {name}')
             return False
         dinfo = self.dst_info[name]
+        if dinfo.get('skip'):
+            return True
         pe = dinfo['pe']
         report(f'patch {name}:')
-        asm_patch = self.asm(dinfo['patch'])
+        if dinfo.get('syms'):
+            self.save_syms(name)
+        labels = {saddr for saddr, _ in dinfo.get('syms', {}).values()}
+        asm_patch = self.asm(dinfo['patch'], name, labels)
+        if self.cfg.get('preflight', True) and not self.check(asm_patch, name):
+            return False
+        # absolute addresses inside the image need base relocations, the image
+        # end is taken after all patches, so the order of sect extends does not matter
+        img_st = pe.addr_base
+        img_ed = img_st + max([pe.size_img] + [pe.aligned_address(addr + plen)
+            for addr, plen in self._write_ranges(asm_patch)])
+        dropped = []
+        pe.begin_layout()
         for addr, patch_info in asm_patch:
             ptyp = patch_info['type']
             report(f'addr:0x{addr:08X} ({ptyp}):')
@@ -2023,16 +1992,151 @@ class c_pe_patcher:
                     brf += '...'
                 report(f'offs:0x{offs:08X} write(n:0x{byt_len:04X}): {brf}')
                 if ptyp == 'asm':
-                    pe.update_reloc(addr, byt_len, patch_info['reloc'])
-                    report('asm:')
-                    for i in patch_info['repr']:
-                        report(i)
+                    relocs = []
+                    for offs, val in patch_info['fixup']:
+                        if img_st <= val < img_ed:
+                            relocs.append(offs)
+                        elif val >= img_ed:
+                            dropped.append((addr + offs, val))
+                    pe.update_reloc(addr, byt_len, relocs)
+                    if patch_info['repr']:
+                        report('asm:')
+                        for i in patch_info['repr']:
+                            report(i)
             else:
                 report(f'warning: unknown patch type {ptyp}')
+        img_ed = img_st + pe.size_img
+        for addr, val in dropped:
+            if val < img_ed:
+                raise ValueError(report(
+                    f'error: 0x{val:08X} at 0x{addr:08X} is in the image but not relocated'))
+        pe.commit_layout()
         return True
 
+    @staticmethod
+    def _write_ranges(asm_patch):
+        # (addr, len) written by each patch
+        for addr, patch_info in asm_patch:
+            ptyp = patch_info['type']
+            if ptyp in ['asm', 'raw']:
+                yield addr, len(patch_info['byte'])
+                continue
+            finfo = getattr(patch_info.get('func'), 'patch_info', None)
+            if finfo and finfo['type'] in ['copy', 'insert']:
+                yield addr, finfo['len']
+
+def _patch_worker(cfg, name, overwrite):
+    buf = io.StringIO()
+    ok = False
+    with redirect_stdout(buf):
+        try:
+            pt = c_pe_patcher(cfg, {name: MOD_DLLS[name]})
+            ok = pt.patch(name) and pt.save_dst(name, overwrite)
+        except:
+            traceback.print_exc(file = sys.stdout)
+    return ok, buf.getvalue()
+
+def patch_dlls(cfg, src_info, overwrite = False):
+    jobs = cfg.get('jobs', 1)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    names = list(src_info)
+    # workers rebuild their patch tables from MOD_DLLS
+    if jobs <= 1 or len(names) <= 1 or not all(
+            src_info[name] is MOD_DLLS.get(name) for name in names):
+        pt = c_pe_patcher(cfg, src_info)
+        pt.patch_all()
+        pt.save_all(overwrite)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(min(jobs, len(names))) as exe:
+        futs = [exe.submit(_patch_worker, cfg, name, overwrite) for name in names]
+        for name, fut in zip(names, futs):
+            try:
+                ok, log = fut.result()
+            except Exception as ex:
+                ok = False
+                report(f'error: {name} worker failed: {ex}')
+            else:
+                sys.stdout.write(log)
+            if not ok:
+                report(f'warning: patch {name} failed')
+
+def verify_dlls(cfg, src_info):
+    # state of installed dlls by md5, without building any patch table
+    for name, sinfo in src_info.items():
+        fn = os.path.join(cfg['root'], sinfo['path'], sinfo['file'])
+        if not os.path.exists(fn):
+            report(f'{name}: not exist')
+            continue
+        fmd5 = hash_file(fn)['md5']
+        if fmd5 == sinfo['md5']:
+            report(f'{name}: original')
+            continue
+        try:
+            with open(os.path.splitext(fn)[0] + '_manifest.json', 'r', encoding = 'utf-8') as fd:
+                mani = json.load(fd)
+        except:
+            mani = {}
+        if fmd5 == mani.get('dst_md5'):
+            report(f'{name}: patched')
+        else:
+            report(f'{name}: unknown md5 {fmd5}')
+
+def check_dlls(cfg, src_info):
+    # pre-flight check only, no dll is loaded
+    pt = c_pe_patcher(cfg, {})
+    for name, sinfo in src_info.items():
+        if 'en' in sinfo and not sinfo['en']:
+            continue
+        asm_patch = pt.asm(resolve_patch(sinfo, cfg['bitness']), name)
+        if pt.check(asm_patch, name, True):
+            report(f'{name}: {len(asm_patch)} patches checked')
+        else:
+            report(f'{name}: check failed')
+
+def sig_dlls(cfg, src_info):
+    # signatures for the 'sigs' of layouts, made from the pinned builds
+    src_info = {name: sinfo for name, sinfo in src_info.items() if 'layout' in sinfo}
+    pt = c_pe_patcher({**cfg, 'manifest': False}, src_info)
+    for name in src_info:
+        if not name in pt.dst_info:
+            report(f'warning: {name} pinned build not found')
+            continue
+        report(f"{name} 'sigs': {{")
+        for sname, (addr, sig) in pt.make_sigs(name).items():
+            report(f"    '{sname}': (0x{addr:x}, '{sig}'),")
+        report('},')
+
+def select_dlls(names):
+    for name in names:
+        if not name in MOD_DLLS:
+            report(f'error: unknown dll {name}')
+            sys.exit()
+    return {name: MOD_DLLS[name] for name in names} if names else MOD_DLLS
+
 if __name__ == '__main__':
     from pprint import pprint as ppr
-    pt = c_pe_patcher(PP_CFG, MOD_DLLS)
-    pt.patch_all()
-    pt.save_all(True)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else None
+    if cmd == 'compile':
+        # python vtmb_inject.py compile [plan file], apply it with vtmb_apply.py
+        pt = c_pe_patcher({**PP_CFG, 'manifest': False}, MOD_DLLS)
+        pt.compile_all(sys.argv[2] if len(sys.argv) > 2 else
+            os.path.join(PP_CFG['work'], PLAN_FILE))
+    elif cmd == 'list':
+        # python vtmb_inject.py list
+        for name, sinfo in MOD_DLLS.items():
+            en = '' if sinfo.get('en', True) else ' (disabled)'
+            report(f'{name}: {os.path.join(sinfo["path"], sinfo["file"])} md5:{sinfo["md5"]}{en}')
+    elif cmd == 'check':
+        # python vtmb_inject.py check [dll names]
+        check_dlls(PP_CFG, select_dlls(sys.argv[2:]))
+    elif cmd == 'sigs':
+        # python vtmb_inject.py sigs [dll names]
+        sig_dlls(PP_CFG, select_dlls(sys.argv[2:]))
+    elif cmd == 'verify':
+        # python vtmb_inject.py verify [dll names]
+        verify_dlls(PP_CFG, select_dlls(sys.argv[2:]))
+    else:
+        # python vtmb_inject.py [dll names]
+        patch_dlls(PP_CFG, select_dlls(sys.argv[1:]), True)
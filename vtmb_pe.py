@@ -0,0 +1,1561 @@
+#! python3
+# coding: utf-8
+
+# VtMB PE file patching engine
+# Copyright (C) 2022 Tring
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path
+import struct
+import mmap
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+import hashlib
+from hashlib import md5 as _md5
+
+# optional, only used to speed up relocation rewrites, imported on first use
+np = None
+_np_tried = False
+
+def load_np():
+    global np, _np_tried
+    if _np_tried:
+        return np
+    _np_tried = True
+    try:
+        import numpy as np
+    except:
+        np = None
+    return np
+
+def hash_md5(val):
+    return _md5(val).hexdigest()
+
+def load_file(fn, use_mmap = False):
+    with open(fn, 'rb') as fd:
+        if use_mmap:
+            return mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_COPY)
+        return fd.read()
+
+IOV_MAX = 1024
+
+def _write_bufs(fd, bufs):
+    writev = getattr(os, 'writev', None)
+    iov_max = IOV_MAX
+    i = 0
+    while i < len(bufs):
+        if writev:
+            n = writev(fd, bufs[i: i + iov_max])
+        else:
+            n = os.write(fd, bufs[i])
+        while n > 0:
+            blen = len(bufs[i])
+            if n < blen:
+                bufs[i] = bufs[i][n:]
+                break
+            n -= blen
+            i += 1
+
+def save_file(fn, bufs, hashes = ('md5',), check = None):
+    # bufs can be a generator, it is written in batches as it goes
+    hs = [hashlib.new(h) for h in hashes]
+    fn_tmp = fn + '.tmp'
+    fd = os.open(fn_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    batch = []
+    def _flush():
+        _write_bufs(fd, batch)
+        for b in batch:
+            b.release()
+        batch.clear()
+    try:
+        try:
+            for b in bufs:
+                b = memoryview(b).cast('B')
+                if not len(b):
+                    continue
+                for h in hs:
+                    h.update(b)
+                batch.append(b)
+                if len(batch) >= IOV_MAX:
+                    _flush()
+            _flush()
+        finally:
+            os.close(fd)
+        hvs = {h: hv.hexdigest() for h, hv in zip(hashes, hs)}
+        if check:
+            for h, hv in check.items():
+                if hvs.get(h) != hv:
+                    raise ValueError(report(f'{fn} {h} unmatch: cur:{hvs.get(h)} dst:{hv}'))
+        os.replace(fn_tmp, fn)
+    except:
+        if os.path.exists(fn_tmp):
+            os.remove(fn_tmp)
+        raise
+    return hvs
+
+def hash_file(fn, hashes = ('md5',), chunk = 0x100000):
+    hs = [hashlib.new(h) for h in hashes]
+    with open(fn, 'rb') as fd:
+        while True:
+            dat = fd.read(chunk)
+            if not dat:
+                break
+            for h in hs:
+                h.update(dat)
+    return {h: hv.hexdigest() for h, hv in zip(hashes, hs)}
+
+def dll_paths(fn):
+    # backup of the original dll and the patched output beside it
+    fn_b, fn_e = os.path.splitext(fn)
+    return fn_b + '_src' + fn_e, fn_b + '_dst' + fn_e
+
+def report(*args):
+    r = ' '.join(args)
+    print(r)
+    return r
+
+alignup   = lambda v, a: ((v - 1) // a + 1) * a
+aligndown = lambda v, a: (v // a) * a
+
+def readval_le(raw, offset, size, signed):
+    neg = False
+    v = 0
+    endpos = offset + size - 1
+    for i in range(endpos, offset - 1, -1):
+        b = raw[i]
+        if signed and i == endpos and b > 0x7f:
+            neg = True
+            b &= 0x7f
+        #else:
+        #    b &= 0xff
+        v <<= 8
+        v += b
+    return v - (1 << (size*8 - 1)) if neg else v
+
+def writeval_le(val, dst, offset, size):
+    if val < 0:
+        val += (1 << (size*8))
+    for i in range(offset, offset + size):
+        dst[i] = (val & 0xff)
+        val >>= 8
+
+_LE_TYPE = {
+    (1, True): 'b', (1, False): 'B',
+    (2, True): 'h', (2, False): 'H',
+    (4, True): 'i', (4, False): 'I',
+    (8, True): 'q', (8, False): 'Q',
+}
+
+@lru_cache(maxsize=None)
+def le_struct(size, signed, num = 1):
+    t = _LE_TYPE.get((size, signed))
+    if t is None:
+        return None
+    return struct.Struct(f'<{num}{t}')
+
+class c_extents:
+
+    def __init__(self):
+        self.st = []
+        self.ed = []
+
+    def __len__(self):
+        return len(self.st)
+
+    def __iter__(self):
+        return zip(self.st, self.ed)
+
+    def add(self, st, ed):
+        if st >= ed:
+            return
+        i = bisect_left(self.ed, st)
+        j = bisect_right(self.st, ed)
+        if i < j:
+            st = min(st, self.st[i])
+            ed = max(ed, self.ed[j-1])
+        self.st[i:j] = [st]
+        self.ed[i:j] = [ed]
+
+    def add_many(self, rngs):
+        rngs = sorted(rngs)
+        if not rngs:
+            return
+        if self.st:
+            rngs = sorted(list(zip(self.st, self.ed)) + rngs)
+        sts = []
+        eds = []
+        for st, ed in rngs:
+            if st >= ed:
+                continue
+            if eds and st <= eds[-1]:
+                if ed > eds[-1]:
+                    eds[-1] = ed
+            else:
+                sts.append(st)
+                eds.append(ed)
+        self.st = sts
+        self.ed = eds
+
+    def clip(self, st, ed):
+        i = bisect_right(self.ed, st)
+        for j in range(i, len(self.st)):
+            e_st = self.st[j]
+            if e_st >= ed:
+                break
+            yield max(e_st, st), min(self.ed[j], ed)
+
+    def hit(self, st, ed):
+        i = bisect_right(self.ed, st)
+        return i < len(self.st) and self.st[i] < ed
+
+# piecewise address translation composed from shift steps
+class c_addr_map:
+
+    def __init__(self):
+        self.los = [0]
+        self.dts = [0]
+
+    def __bool__(self):
+        return any(self.dts)
+
+    def step(self, st_addr, ed_addr, elen_v):
+        if not elen_v:
+            return
+        los = []
+        dts = []
+        his = self.los[1:] + [None]
+        for lo, hi, dt in zip(self.los, his, self.dts):
+            # split [lo, hi) where its image crosses the step range
+            cuts = [lo]
+            for b in (st_addr, ed_addr):
+                if b is None:
+                    continue
+                c = b - dt
+                if lo < c and (hi is None or c < hi):
+                    cuts.append(c)
+            for c in sorted(cuts):
+                v = c + dt
+                if v >= st_addr and (ed_addr is None or v < ed_addr):
+                    d = dt + elen_v
+                else:
+                    d = dt
+                if dts and dts[-1] == d:
+                    continue
+                los.append(c)
+                dts.append(d)
+        self.los = los
+        self.dts = dts
+
+    def __call__(self, addr):
+        i = bisect_right(self.los, addr) - 1
+        if i < 0:
+            return addr
+        return addr + self.dts[i]
+
+    def arr(self, addrs):
+        if load_np() is None:
+            return [self(addr) for addr in addrs]
+        idx = np.searchsorted(np.array(self.los, dtype=np.int64), addrs, 'right') - 1
+        dts = np.array(self.dts, dtype=np.int64)[idx]
+        dts[idx < 0] = 0
+        return addrs + dts
+
+class c_mark:
+
+    def __init__(self, raw, offset):
+        self._raw = raw
+        self._mod = None
+        self.offset = offset
+        self.parent = None
+        self._par_offset = 0
+        self._root = self
+        # offset of the buffer in the source file, None for new data
+        self._src = 0 if raw is not None else None
+        self._jnl = c_extents()
+
+    @property
+    def raw(self):
+        rt = self._root
+        return rt._mod if not rt._mod is None else rt._raw
+
+    @property
+    def mod(self):
+        rt = self._root
+        if rt._mod is None:
+            if isinstance(rt._raw, mmap.mmap):
+                # copy-on-write mapping, only dirtied pages are materialized
+                rt._mod = rt._raw
+            else:
+                rt._mod = bytearray(rt._raw)
+        return rt._mod
+
+    @property
+    def par_offset(self):
+        po = self._par_offset
+        if self.parent:
+            po += self.parent.par_offset
+        return po
+
+    @property
+    def real_offset(self):
+        return self.par_offset + self.offset
+
+    def shift(self, offs):
+        self._par_offset += offs
+
+    def extendto(self, cnt):
+        extlen = self.offset + cnt - len(self.raw)
+        if extlen > 0:
+            rt = self._root
+            if not isinstance(self.mod, bytearray):
+                rt._mod = bytearray(rt._mod)
+            rl = len(rt._mod)
+            rt._mod.extend(bytes(extlen))
+            rt._jnl.add(rl, rl + extlen)
+
+    def dirty(self, pos, cnt):
+        st = self.offset + pos
+        self._root._jnl.add(st, st + cnt)
+
+    def readval(self, pos, cnt, signed):
+        st = le_struct(cnt, signed)
+        if st is None:
+            return readval_le(self.raw, self.offset + pos, cnt, signed)
+        return st.unpack_from(self.raw, self.offset + pos)[0]
+
+    def writeval(self, val, pos, cnt):
+        self.extendto(pos + cnt)
+        self.dirty(pos, cnt)
+        st = le_struct(cnt, False)
+        if st is None:
+            writeval_le(val, self.mod, self.offset + pos, cnt)
+            return
+        st.pack_into(self.mod, self.offset + pos, val & ((1 << (cnt*8)) - 1))
+
+    def readarr(self, pos, num, cnt, signed):
+        if num <= 0:
+            return ()
+        return le_struct(cnt, signed, num).unpack_from(self.raw, self.offset + pos)
+
+    def writearr(self, vals, pos, cnt):
+        num = len(vals)
+        if num <= 0:
+            return
+        self.extendto(pos + num * cnt)
+        self.dirty(pos, num * cnt)
+        mask = (1 << (cnt*8)) - 1
+        le_struct(cnt, False, num).pack_into(
+            self.mod, self.offset + pos, *(v & mask for v in vals))
+
+    def fill(self, val, pos, cnt):
+        st = self.offset + pos
+        self.dirty(pos, cnt)
+        self.mod[st: st + cnt] = bytes((val,)) * cnt
+
+    def move(self, s_pos, d_pos, cnt):
+        self.extendto(max(s_pos, d_pos) + cnt)
+        s_st = self.offset + s_pos
+        d_st = self.offset + d_pos
+        self.dirty(d_pos, cnt)
+        self.mod[d_st: d_st + cnt] = self.raw[s_st: s_st + cnt]
+
+    I8  = lambda self, pos: self.readval(pos, 1, True)
+    U8  = lambda self, pos: self.readval(pos, 1, False)
+    I16 = lambda self, pos: self.readval(pos, 2, True)
+    U16 = lambda self, pos: self.readval(pos, 2, False)
+    I32 = lambda self, pos: self.readval(pos, 4, True)
+    U32 = lambda self, pos: self.readval(pos, 4, False)
+    I64 = lambda self, pos: self.readval(pos, 8, True)
+    U64 = lambda self, pos: self.readval(pos, 8, False)
+
+    W8  = lambda self, val, pos: self.writeval(val, pos, 1)
+    W16 = lambda self, val, pos: self.writeval(val, pos, 2)
+    W32 = lambda self, val, pos: self.writeval(val, pos, 4)
+    W64 = lambda self, val, pos: self.writeval(val, pos, 8)
+
+    U16A = lambda self, pos, num: self.readarr(pos, num, 2, False)
+    U32A = lambda self, pos, num: self.readarr(pos, num, 4, False)
+
+    W16A = lambda self, vals, pos: self.writearr(vals, pos, 2)
+    W32A = lambda self, vals, pos: self.writearr(vals, pos, 4)
+
+    def BYTES(self, pos, cnt):
+        st = self.offset + pos
+        if cnt is None:
+            ed = None
+        else:
+            ed = st + cnt
+            self.extendto(pos + cnt)
+        return self.raw[st: ed]
+
+    def VIEW(self, pos, cnt):
+        st = self.offset + pos
+        if cnt is None:
+            ed = None
+        else:
+            ed = st + cnt
+            self.extendto(pos + cnt)
+        return memoryview(self.raw)[st: ed]
+
+    def WBYTES(self, dst, pos):
+        st = self.offset + pos
+        cnt = len(dst)
+        ed = st + cnt
+        self.extendto(pos + cnt)
+        self.dirty(pos, cnt)
+        self.mod[st: ed] = dst
+        return cnt
+
+    def STR(self, pos, cnt, codec = 'utf8'):
+        return bytes(self.BYTES(pos, cnt)).split(b'\0')[0].decode(codec)
+
+    def WSTR(self, dst, pos, codec = 'utf8'):
+        b = dst.encode(codec)
+        if b[-1] != 0:
+            b += b'\0'
+        return self.WBYTES(b, pos)
+
+    def BYTESN(self, pos):
+        st = self.offset + pos
+        rl = len(self.raw)
+        ed = rl
+        for i in range(st, rl):
+            if self.raw[i] == 0:
+                ed = i
+                break
+        return bytes(self.raw[st:ed]), ed - st
+
+    def STRN(self, pos, codec = 'utf8'):
+        b, n = self.BYTESN(pos)
+        return b.decode(codec), n
+
+    def sub(self, pos, length = None):
+        if length is None:
+            s = c_mark(None, self.offset + pos)
+            s.parent = self
+            s._root = self._root
+        else:
+            s = c_mark(None, 0)
+            st = self.offset + pos
+            self.extendto(pos + length)
+            raw = self.raw
+            if self._root._mod is None or isinstance(raw, mmap.mmap):
+                # share the unmodified buffer, copy on first write
+                s._raw = memoryview(raw)[st: st + length]
+            else:
+                s._mod = bytearray(raw[st: st + length])
+            s._par_offset = self.real_offset + pos
+            rt = self._root
+            if not rt._src is None:
+                s._src = rt._src + st
+            for e_st, e_ed in rt._jnl.clip(st, st + length):
+                s._jnl.add(e_st - st, e_ed - st)
+        return s
+
+    def runs(self, pos, cnt):
+        st = self.offset + pos
+        ed = st + cnt
+        rt = self._root
+        buf = memoryview(self.raw)
+        for e_st, e_ed in rt._jnl.clip(st, ed):
+            if st < e_st:
+                yield None if rt._src is None else rt._src + st, buf[st: e_st]
+            yield None, buf[e_st: e_ed]
+            st = e_ed
+        if st < ed:
+            yield None if rt._src is None else rt._src + st, buf[st: ed]
+
+class c_reloc_tab:
+
+    page_len = 0x1000
+
+    def __init__(self, mk, size):
+        self.blks = {}
+        self.dirty = False
+        idx = 0
+        while idx < size:
+            page = mk.U32(idx)
+            blk_size = mk.U32(idx + 0x4) - 0x8
+            idx += 0x8
+            if idx + blk_size > size:
+                raise ValueError(report('invalid .reloc size'))
+            blk = self.blks.setdefault(page, [])
+            blk.extend(mk.U16A(idx, (blk_size + 1) // 2))
+            idx += blk_size
+
+    def __iter__(self):
+        for page in sorted(self.blks):
+            yield page, self.blks[page]
+
+    def _remain(self, page, blk, rng_addr):
+        lst_i = 0
+        for i, rel_v in enumerate(blk):
+            rel_flg = rel_v >> 12
+            if rel_flg == 3:
+                if rng_addr <= (rel_v & 0xfff) + page:
+                    break
+                lst_i = i + 1
+            elif rel_flg != 0:
+                report(f'warning: not implemented reloc type 0x{rel_flg:x} in block 0x{page:x}')
+        return lst_i
+
+    def update(self, r_st, r_len, reloc_offs):
+        r_ed = r_st + r_len
+        fst_page = aligndown(r_st, self.page_len)
+        lst_page = aligndown(r_ed - 1, self.page_len)
+        blks = self.blks
+        heads = {}
+        tails = {}
+        for page in [p for p in blks if fst_page <= p <= lst_page]:
+            blk = blks.pop(page)
+            if page == fst_page:
+                heads[page] = blk[:self._remain(page, blk, r_st)]
+            if page == lst_page:
+                tails[page] = blk[self._remain(page, blk, r_ed):]
+        news = {}
+        for offs in sorted(reloc_offs):
+            addr = r_st + offs
+            page = aligndown(addr, self.page_len)
+            news.setdefault(page, []).append(0x3000 | (addr - page))
+        for page in set(heads) | set(tails) | set(news):
+            blks[page] = heads.get(page, []) + news.get(page, []) + tails.get(page, [])
+        self.dirty = True
+
+    def remap(self, amap):
+        blks = {}
+        shifted = []
+        for page, blk in self.blks.items():
+            n_page = amap(page)
+            tb_shift = (n_page != page)
+            if tb_shift:
+                page = n_page
+                self.dirty = True
+            if page in blks:
+                blks[page].extend(blk)
+            else:
+                blks[page] = blk
+            shifted.append((page, blk, tb_shift))
+        self.blks = blks
+        return shifted
+
+    def pack(self):
+        rs = []
+        for page, blk in self:
+            num = len(blk)
+            rs.append(struct.pack(f'<II{num}H', page, 0x8 + num * 0x2, *blk))
+        return b''.join(rs)
+
+class c_pe_file(c_mark):
+
+    def __init__(self, raw):
+        super().__init__(raw, 0)
+        self._sect_idx = None
+        self.reloc_tab = None
+        self._lyt_txn = False
+        self._lyt_maps = {}
+        self._lyt_opt = c_addr_map()
+        self._lyt_tch = None
+        # recorded layout and content edits, see pack_plan
+        self.plan_ops = None
+        self.parse_head()
+
+    def parse_head(self):
+        if self.U16(0) != 0x5a4d:
+            raise ValueError(report('invalid PE header'))
+        self.parse_coff(self.sub(self.U32(0x3c)))
+
+    def parse_coff(self, mark):
+        self.mark_coff = mark
+        if mark.U32(0) != 0x4550:
+            raise ValueError(report('invalid COFF header'))
+        self.num_sect = mark.U16(0x6)
+        self.parse_opt_coff(mark.sub(0x18), mark.U16(0x14))
+
+    def parse_opt_coff(self, mark, size):
+        if size < 0x1c:
+            self.parse_opt_win(mark.sub(size) if size > 0 else mark, 0)
+            return
+        self.mark_opt_coff = mark
+        magic = mark.U16(0)
+        if magic == 0x10b:
+            self.flag_32plus = False
+        elif magic == 0x20b:
+            self.flag_32plus = True
+        else:
+            raise ValueError(report('invalid magic'))
+        self.size_code = mark.U32(0x4)
+        self.size_idat = mark.U32(0x8)
+        self.size_udat = mark.U32(0xc)
+        self.addr_entry = mark.U32(0x10)
+        self.addr_code = mark.U32(0x14)
+        self.addr_data = mark.U32(0x18)
+        self.parse_opt_win(mark.sub(0x1c), size - 0x1c)
+
+    def parse_opt_win(self, mark, size):
+        if size < 0x44:
+            self.parse_opt_datdir(mark.sub(size) if size > 0 else mark, 0, 0)
+            return
+        self.mark_opt_win = mark
+        self.addr_base = mark.U32(0)
+        self.align_addr = mark.U32(0x4)
+        self.align_offs = mark.U32(0x8)
+        self.size_img = mark.U32(0x1c)
+        self.size_hdr = mark.U32(0x20)
+        self.parse_opt_datdir(mark.sub(0x44), size - 0x44, mark.U32(0x40))
+
+    def parse_opt_datdir(self, mark, size, num):
+        dsize = num * 0x8
+        if size < dsize:
+            self.parse_sect(mark.sub(size) if size > 0 else mark, 0)
+            return
+        assert size == dsize
+        self.mark_opt_datdir = mark
+        datdir = []
+        for i in range(num):
+            p = i * 0x8
+            mark_dd = mark.sub(i * 0x8)
+            datdir_info = {
+                'mark_h': mark_dd,
+                'addr': mark_dd.U32(0),
+                'size_v': mark_dd.U32(0x4),
+                'mark': None,
+            }
+            datdir.append(datdir_info)
+        self.tab_datdir = datdir
+        self.parse_sect(mark.sub(size), 0)
+
+    def _upd_opt_datdir(self, sect_info):
+        s_mark = sect_info['mark']
+        s_szva = self.aligned_address(sect_info['size_v'])
+        s_addr = sect_info['addr']
+        s_last = s_addr + s_szva
+        for i, datdir_info in enumerate(self.tab_datdir):
+            if datdir_info['mark']:
+                continue
+            d_addr = datdir_info['addr']
+            d_szv = datdir_info['size_v']
+            if not s_addr <= d_addr < s_last:
+                continue
+            if not d_addr + d_szv < s_last:
+                raise ValueError(report(
+                    f'data dir {i} cross section {sect_info["name"]}'))
+            datdir_info['mark'] = s_mark.sub(d_addr - s_addr)
+
+    def parse_sect(self, mark, idx):
+        if idx >= self.num_sect:
+            self.parse_tail(self.sub(self.offs_sect_nxt))
+            return
+        sect_info = {
+            'mark_h': mark,
+            'idx': idx,
+            'name': mark.STR(0, 0x8),
+            'size_v': mark.U32(0x8),
+            'addr': mark.U32(0xc),
+            'size': mark.U32(0x10),
+            'offs': mark.U32(0x14),
+        }
+        ch = mark.U32(0x24)
+        sect_info['char'] = {
+            'code': ch & 0x20,
+            'idat': ch & 0x40,
+            'udat': ch & 0x80,
+            'ncch': ch & 0x4000000,
+            'npag': ch & 0x8000000,
+            'shar': ch & 0x10000000,
+            'exec': ch & 0x20000000,
+            'read': ch & 0x40000000,
+            'writ': ch & 0x80000000,
+        }
+        sect_info['mark'] = self.sub(sect_info['offs'], sect_info['size'])
+        if idx == 0:
+            self.tab_sect = []
+        elif self.offs_sect_nxt != sect_info['offs']:
+            raise ValueError(report(
+                f'invalid offset of sect {sect_info["name"]}'))
+        self.offs_sect_nxt = sect_info['offs'] + sect_info['size']
+        self.tab_sect.append(sect_info)
+        self._sect_idx = None
+        self._upd_opt_datdir(sect_info)
+        self.parse_sect(mark.sub(0x28), idx+1)
+
+    def parse_tail(self, mark):
+        self.mark_tail = mark
+        self.offs_tail = mark.offset
+
+    def aligned_offset(self, offs):
+        return alignup(offs, self.align_offs)
+
+    def aligned_address(self, addr):
+        return alignup(addr, self.align_addr)
+
+    def _shift_sect(self, idx, elen, elen_v):
+        if idx >= len(self.tab_sect):
+            return
+        sect_info = self.tab_sect[idx]
+        mkh = sect_info['mark_h']
+        if elen > 0:
+            sect_info['offs'] += elen
+            mkh.W32(sect_info['offs'], 0x14)
+            sect_info['mark'].shift(elen)
+        if elen_v > 0:
+            sect_info['addr'] += elen_v
+            mkh.W32(sect_info['addr'], 0xc)
+            self._sect_idx = None
+        self._shift_sect(idx + 1, elen, elen_v)
+
+    def _sect_index(self):
+        idx = self._sect_idx
+        if idx is None:
+            sts = []
+            eds = []
+            sis = []
+            for sect_info in sorted(self.tab_sect, key = lambda si: si['addr']):
+                s_addr = sect_info['addr']
+                sts.append(s_addr)
+                eds.append(s_addr + self.aligned_address(sect_info['size_v']))
+                sis.append(sect_info)
+            idx = (sts, eds, sis)
+            self._sect_idx = idx
+        return idx
+
+    def _get_sect_by_addr(self, addr, cache = None, nearest = False):
+        if cache:
+            st = cache['st']
+            ed = cache['ed']
+            if st <= addr < ed:
+                return cache['si'], addr - st
+        sts, eds, sis = self._sect_index()
+        i = bisect_right(sts, addr) - 1
+        if i >= 0 and addr < eds[i]:
+            pass
+        elif nearest and i >= 0:
+            # the first one of the sections starting at the same address
+            i = bisect_left(sts, sts[i])
+        else:
+            raise ValueError(report(f'invalid address 0x{addr:x}'))
+        s_addr = sts[i]
+        if not cache is None:
+            cache['st'] = s_addr
+            cache['ed'] = eds[i]
+            cache['si'] = sis[i]
+        return sis[i], addr - s_addr
+
+    def get_sects_by_addrs(self, addrs):
+        sts, eds, sis = self._sect_index()
+        rs = []
+        for addr in addrs:
+            i = bisect_right(sts, addr) - 1
+            if i < 0 or addr >= eds[i]:
+                raise ValueError(report(f'invalid address 0x{addr:x}'))
+            rs.append((sis[i], addr - sts[i]))
+        return rs
+
+    def addrs_to_offsets(self, addrs):
+        return [sect_info['offs'] + offs_sect
+            for sect_info, offs_sect in self.get_sects_by_addrs(addrs)]
+
+    def _remap_addr(self, mark, moffs, amap):
+        addr = mark.U32(moffs)
+        n_addr = amap(addr)
+        if n_addr != addr:
+            mark.W32(n_addr, moffs)
+        return n_addr
+
+    def _remap_addr_arr(self, mark, moffs, num, amap):
+        addrs = mark.U32A(moffs, num)
+        s_addrs = [amap(addr) for addr in addrs]
+        if s_addrs != list(addrs):
+            mark.W32A(s_addrs, moffs)
+        return s_addrs
+
+    def _remap_datdir_export(self, datdir_info, amap):
+        mk = datdir_info['mark']
+        if mk.U32(0) != 0:
+            raise ValueError(report(f'invalid export tab'))
+        addr_name = self._remap_addr(mk, 0xc, amap)
+        num_func = mk.U32(0x14)
+        num_fname = mk.U32(0x18)
+        addr_func_arr = self._remap_addr(mk, 0x1c, amap)
+        addr_fname_arr = self._remap_addr(mk, 0x20, amap)
+        addr_fnord_arr = self._remap_addr(mk, 0x24, amap)
+        sect_cache = {}
+        sect_info, offs_sect = self._get_sect_by_addr(addr_func_arr, sect_cache)
+        self._remap_addr_arr(sect_info['mark'], offs_sect, num_func, amap)
+        sect_info, offs_sect = self._get_sect_by_addr(addr_fname_arr, sect_cache)
+        self._remap_addr_arr(sect_info['mark'], offs_sect, num_fname, amap)
+
+    def _iter_import_thunk(self, addr_tab, sect_cache):
+        sect_info, offs_sect = self._get_sect_by_addr(addr_tab, sect_cache)
+        mk_s = sect_info['mark']
+        flag_32plus = self.flag_32plus
+        offs_idx = offs_sect
+        while True:
+            ti_v = mk_s.U32(offs_idx)
+            if flag_32plus:
+                ti_v2 = mk_s.U32(offs_idx + 0x4)
+                if ti_v == 0 and ti_v2 == 0:
+                    break
+                ti_addr = ti_v
+                ti_flg = ti_v2
+            else:
+                if ti_v == 0:
+                    break
+                ti_addr = (ti_v & 0x7fffffff)
+                ti_flg = (ti_v & 0x80000000)
+            yield mk_s, offs_idx, ti_addr, ti_flg
+            if flag_32plus:
+                offs_idx += 0x8
+            else:
+                offs_idx += 0x4
+
+    def _remap_datdir_import(self, datdir_info, amap):
+        mk = datdir_info['mark']
+        szv = datdir_info['size_v']
+        if szv % 0x14:
+            raise ValueError(report('invalid import table size 0x{szv}'))
+        sect_cache = {}
+        flag_32plus = self.flag_32plus
+        for i in range(0, szv - 0x14, 0x14): # last is empty
+            addr_ilt = self._remap_addr(mk, i, amap)
+            addr_name = self._remap_addr(mk, i + 0xc, amap)
+            addr_iat = self._remap_addr(mk, i + 0x10, amap)
+            for addr_tab in (addr_ilt, addr_iat):
+                for mk_s, offs_idx, ti_addr, ti_flg in self._iter_import_thunk(addr_tab, sect_cache):
+                    if ti_flg:
+                        report(f'warning: import tab by ord 0x{ti_addr:x}')
+                        continue
+                    ti_addr = amap(ti_addr)
+                    if flag_32plus:
+                        mk_s.W32(ti_addr, offs_idx)
+                    else:
+                        mk_s.W32(ti_addr | ti_flg, offs_idx)
+
+    def _remap_reloc_block(self, rel_vs, tbase, tb_shift, amap):
+        if load_np() is None:
+            rel_flgs = [rel_v >> 12 for rel_v in rel_vs]
+            rel_addrs = [(rel_v & 0xfff) + tbase for rel_v in rel_vs]
+            if not tb_shift:
+                for rel_addr in rel_addrs:
+                    if amap(rel_addr) != rel_addr:
+                        raise ValueError(report(
+                            f'reloc item 0x{rel_addr:x} shift cross block 0x{tbase:x}'))
+            for rel_flg in rel_flgs:
+                if not rel_flg in (0, 3):
+                    report(f'warning: not implemented reloc type 0x{rel_flg:x}')
+            return [rel_addr for rel_flg, rel_addr in zip(rel_flgs, rel_addrs)
+                if rel_flg == 3]
+        rel_vs = np.asarray(rel_vs, dtype=np.uint16)
+        rel_flgs = rel_vs >> 12
+        rel_addrs = (rel_vs & 0xfff).astype(np.int64) + tbase
+        if not tb_shift:
+            rel_cross = amap.arr(rel_addrs) != rel_addrs
+            if rel_cross.any():
+                rel_addr = int(rel_addrs[rel_cross][0])
+                raise ValueError(report(
+                    f'reloc item 0x{rel_addr:x} shift cross block 0x{tbase:x}'))
+        for rel_flg in rel_flgs[(rel_flgs != 0) & (rel_flgs != 3)]:
+            report(f'warning: not implemented reloc type 0x{rel_flg:x}')
+        return rel_addrs[rel_flgs == 3]
+
+    def _remap_reloc_refs(self, rel_addrs, amap):
+        base = self.addr_base
+        if load_np() is None:
+            for (sect_info, offs_sect) in self.get_sects_by_addrs(rel_addrs):
+                mk_s = sect_info['mark']
+                s_addr = mk_s.U32(offs_sect)
+                s_addr_based = s_addr - base
+                d_addr_based = amap(s_addr_based)
+                if d_addr_based != s_addr_based:
+                    mk_s.W32(d_addr_based + base, offs_sect)
+            return
+        sts, eds, sis = self._sect_index()
+        sidx = np.searchsorted(np.array(sts, dtype=np.int64), rel_addrs, 'right') - 1
+        s_bad = (sidx < 0) | (rel_addrs >= np.array(eds, dtype=np.int64)[sidx])
+        if s_bad.any():
+            raise ValueError(report(f'invalid address 0x{int(rel_addrs[s_bad][0]):x}'))
+        for i in np.unique(sidx):
+            mk_s = sis[i]['mark']
+            offs = rel_addrs[sidx == i] - sts[i] + mk_s.offset
+            buf = np.frombuffer(mk_s.raw, dtype=np.uint8)
+            if len(offs) and offs.max() + 4 > len(buf):
+                raise ValueError(report(f'reloc ref out of section {sis[i]["name"]}'))
+            s_addrs = np.zeros(len(offs), dtype=np.int64)
+            for b in range(4):
+                s_addrs |= buf[offs + b].astype(np.int64) << (8 * b)
+            s_addrs_based = s_addrs - base
+            d_addrs_based = amap.arr(s_addrs_based)
+            s_shift = d_addrs_based != s_addrs_based
+            if not s_shift.any():
+                continue
+            offs = offs[s_shift]
+            d_addrs = (d_addrs_based[s_shift] + base) & 0xffffffff
+            buf = np.frombuffer(mk_s.mod, dtype=np.uint8)
+            for b in range(4):
+                buf[offs + b] = (d_addrs >> (8 * b)) & 0xff
+            mk_s._root._jnl.add_many([(o, o + 4) for o in offs.tolist()])
+
+    def _iter_reloc_blocks(self, datdir_info):
+        # (page, entries) of the raw .reloc table
+        mk = datdir_info['mark']
+        szv = datdir_info['size_v']
+        idx = 0
+        while idx < szv:
+            tbase = mk.U32(idx)
+            tsize = mk.U32(idx + 0x4) - 0x8
+            idx += 0x8
+            if idx + tsize > szv:
+                raise ValueError(report('invalid .reloc size'))
+            num = (tsize + 1) // 2
+            if load_np() is None:
+                rel_vs = mk.U16A(idx, num)
+            else:
+                rel_vs = np.frombuffer(mk.raw, dtype='<u2', count=num, offset=mk.offset + idx)
+            yield idx - 0x8, tbase, rel_vs
+            idx += tsize
+
+    def _remap_datdir_reloc(self, datdir_info, amap):
+        rel_addrs = []
+        if not self.reloc_tab is None:
+            for tbase, blk, tb_shift in self.reloc_tab.remap(amap):
+                rel_addrs.append(self._remap_reloc_block(blk, tbase, tb_shift, amap))
+        else:
+            mk = datdir_info['mark']
+            for idx, tbase, rel_vs in self._iter_reloc_blocks(datdir_info):
+                n_tbase = amap(tbase)
+                tb_shift = (n_tbase != tbase)
+                if tb_shift:
+                    mk.W32(n_tbase, idx)
+                rel_addrs.append(self._remap_reloc_block(rel_vs, n_tbase, tb_shift, amap))
+        if load_np() is None:
+            rel_addrs = [rel_addr for blk in rel_addrs for rel_addr in blk]
+        elif rel_addrs:
+            rel_addrs = np.concatenate(rel_addrs)
+        else:
+            rel_addrs = np.zeros(0, dtype=np.int64)
+        self._remap_reloc_refs(rel_addrs, amap)
+
+    def _remap_datdir(self, idx, amap):
+        datdir_info = self.tab_datdir[idx]
+        if idx == 0:
+            self._remap_datdir_export(datdir_info, amap)
+        elif idx == 0x1:
+            self._remap_datdir_import(datdir_info, amap)
+        elif idx == 0x5:
+            self._remap_datdir_reloc(datdir_info, amap)
+        elif idx == 0xc:
+            # IAT handled by import tab
+            pass
+        else:
+            report(f'warning: not implemented datdir({idx}) shift')
+            return NotImplemented
+
+    def _touched_datdir(self, idx, amap):
+        # address ranges the pending remap of a data dir reads or writes
+        datdir_info = self.tab_datdir[idx]
+        d_addr = datdir_info['addr']
+        rngs = [(d_addr, d_addr + datdir_info['size_v'])]
+        mk = datdir_info['mark']
+        sect_cache = {}
+        if idx == 0:
+            for moffs, noffs in ((0x1c, 0x14), (0x20, 0x18)):
+                addr_arr = amap(mk.U32(moffs))
+                rngs.append((addr_arr, addr_arr + mk.U32(noffs) * 0x4))
+        elif idx == 0x1:
+            ti_len = 0x8 if self.flag_32plus else 0x4
+            for i in range(0, datdir_info['size_v'] - 0x14, 0x14):
+                for moffs in (i, i + 0x10):
+                    addr_tab = amap(mk.U32(moffs))
+                    ti_num = sum(1 for _ in self._iter_import_thunk(addr_tab, sect_cache))
+                    rngs.append((addr_tab, addr_tab + ti_num * ti_len))
+        elif idx == 0x5:
+            if not self.reloc_tab is None:
+                blks = iter(self.reloc_tab)
+            else:
+                blks = ((tbase, rel_vs) for _, tbase, rel_vs in self._iter_reloc_blocks(datdir_info))
+            for tbase, rel_vs in blks:
+                tbase = amap(tbase)
+                rngs.extend((rel_addr, rel_addr + 0x4)
+                    for rel_addr in ((int(rel_v) & 0xfff) + tbase
+                        for rel_v in rel_vs if int(rel_v) >> 12 == 3))
+        return rngs
+
+    def _layout_touched(self):
+        tch = self._lyt_tch
+        if tch is None:
+            tch = c_extents()
+            rngs = []
+            for idx, amap in self._lyt_maps.items():
+                rngs.extend(self._touched_datdir(idx, amap))
+            tch.add_many(rngs)
+            self._lyt_tch = tch
+        return tch
+
+    def _apply_layout(self):
+        maps = self._lyt_maps
+        self._lyt_maps = {}
+        self._lyt_tch = None
+        for idx in sorted(maps):
+            self._remap_datdir(idx, maps[idx])
+        amap = self._lyt_opt
+        if amap:
+            self._lyt_opt = c_addr_map()
+            mkc = self.mark_opt_coff
+            self.addr_entry = self._remap_addr(mkc, 0x10, amap)
+            self.addr_code = self._remap_addr(mkc, 0x14, amap)
+            self.addr_data = self._remap_addr(mkc, 0x18, amap)
+
+    def _sync_layout(self, a_st = None, a_ed = None):
+        # apply pending layout changes before content at a_st/a_ed is accessed
+        if not self._lyt_maps and not self._lyt_opt:
+            return
+        if not a_st is None and not self._layout_touched().hit(a_st, a_ed):
+            return
+        self._apply_layout()
+
+    def begin_layout(self):
+        self._lyt_txn = True
+
+    def commit_layout(self):
+        self._lyt_txn = False
+        self._apply_layout()
+
+    def _shift_datdir_tab(self, st_addr, ed_addr, elen_v):
+        if not elen_v:
+            return
+        for i, datdir_info in enumerate(self.tab_datdir):
+            if datdir_info['addr'] >= st_addr and (ed_addr is None or datdir_info['addr'] < ed_addr):
+                datdir_info['addr'] += elen_v
+                datdir_info['mark_h'].W32(datdir_info['addr'], 0)
+                self._lyt_maps.setdefault(i, c_addr_map()).step(st_addr, ed_addr, elen_v)
+        self._lyt_tch = None
+        if not self._lyt_txn:
+            self._apply_layout()
+
+    def ext_sect(self, idx, dlen):
+        if idx >= len(self.tab_sect):
+            return
+        sect_info = self.tab_sect[idx]
+        mks = sect_info['mark']
+        mkh = sect_info['mark_h']
+        sz = sect_info['size']
+        szv = sect_info['size_v']
+        szva = self.aligned_address(szv)
+        if dlen <= sz:
+            if dlen > szv:
+                if sect_info['char']['code']:
+                    mks.fill(0xcc, szv, dlen - szv)
+                sect_info['size_v'] = dlen
+                mkh.W32(sect_info['size_v'], 0x8)
+                self._sect_idx = None
+            return
+        dlen_f = self.aligned_offset(dlen)
+        elen = dlen_f - sz
+        sect_info['size'] = dlen_f
+        mkh.W32(sect_info['size'], 0x10)
+        mks.extendto(dlen_f)
+        elen_v = 0
+        if dlen > szv:
+            if sect_info['char']['code']:
+                mks.fill(0xcc, szv, dlen - szv)
+            elen_v = (self.aligned_address(dlen) - szva)
+            sect_info['size_v'] = dlen
+            mkh.W32(sect_info['size_v'], 0x8)
+            self._sect_idx = None
+        self._shift_sect(idx + 1, elen, elen_v)
+        shift_st_addr = sect_info['addr'] + szva
+        self._lyt_opt.step(shift_st_addr, None, elen_v)
+        self._shift_datdir_tab(shift_st_addr, None, elen_v)
+        mkc = self.mark_opt_coff
+        if sect_info['char']['code']:
+            self.size_code += elen_v
+            mkc.W32(self.size_code, 0x4)
+        if sect_info['char']['idat']:
+            self.size_idat += elen_v
+            mkc.W32(self.size_idat, 0x8)
+        if sect_info['char']['udat']:
+            self.size_udat += elen_v
+            mkc.W32(self.size_udat, 0xc)
+        self.size_img += elen_v
+        self.mark_opt_win.W32(self.size_img, 0x1c)
+        self.offs_tail += elen
+
+    def _insert_sect(self, src_sect_info, cfg):
+        mkh = src_sect_info['mark_h'].sub(0, 0x28)
+        sidx = src_sect_info['idx']
+        sect_info = {
+            'mark_h': mkh,
+            'idx': sidx,
+            'name': cfg['name'],
+            'size_v': 0,
+            'addr': src_sect_info['addr'],
+            'size': 0,
+            'offs': src_sect_info['offs'],
+        }
+        mkh.WSTR((sect_info['name'] + '\0'*8)[:8], 0x0)
+        mkh.W32(sect_info['size_v'], 0x8)
+        mkh.W32(sect_info['addr'], 0xc)
+        mkh.W32(sect_info['size'], 0x10)
+        mkh.W32(sect_info['offs'], 0x14)
+        flg = cfg['char']
+        sect_info['char'] = {
+            'code': 0x20 if 'code' in flg and flg['code'] else 0,
+            'idat': 0x40 if 'idat' in flg and flg['idat'] else 0,
+            'udat': 0x80 if 'udat' in flg and flg['udat'] else 0,
+            'ncch': 0x4000000 if 'ncch' in flg and flg['ncch'] else 0,
+            'npag': 0x8000000 if 'npag' in flg and flg['npag'] else 0,
+            'shar': 0x10000000 if 'shar' in flg and flg['shar'] else 0,
+            'exec': 0x20000000 if 'exec' in flg and flg['exec'] else 0,
+            'read': 0x40000000 if 'read' in flg and flg['read'] else 0,
+            'writ': 0x80000000 if 'writ' in flg and flg['writ'] else 0,
+        }
+        ch = 0
+        for v in sect_info['char'].values():
+            ch |= v
+        mkh.W32(ch, 0x24)
+        sect_info['mark'] = self.sub(sect_info['offs'], sect_info['size'])
+        tab_sect = self.tab_sect
+        for idx in range(sidx, len(tab_sect)):
+            shft_sect_info = tab_sect[idx]
+            shft_sect_info['idx'] += 1
+        tab_sect.insert(sidx, sect_info)
+        self._sect_idx = None
+        self.num_sect += 1
+        self.mark_coff.W16(self.num_sect, 0x6)
+
+    def _record(self, *op):
+        if not self.plan_ops is None:
+            self.plan_ops.append(op)
+
+    def insert_sect(self, idx, dlen, cfg):
+        self._record('insert_sect', idx, dlen, cfg)
+        if idx >= len(self.tab_sect):
+            return
+        src_sect_info = self.tab_sect[idx]
+        self._insert_sect(src_sect_info, cfg)
+        self.ext_sect(idx, dlen)
+
+    def _access(self, a_st, a_ed, ext = True):
+        sect_info, offs_sect = self._get_sect_by_addr(a_st, None, True)
+        s_st = sect_info['addr']
+        s_ed = s_st + sect_info['size']
+        s_ed_v = s_st + sect_info['size_v']
+        if a_ed > s_ed or a_ed > s_ed_v:
+            if ext:
+                self.ext_sect(sect_info['idx'], a_ed - s_st)
+            else:
+                raise ValueError(report(
+                    f'access 0x{a_st:x}/0x{a_ed:x} cross section {sect_info["name"]}'))
+        return sect_info, offs_sect
+
+    def read(self, r_addr, rlen):
+        sect_info, offs_sect = self._access(r_addr, r_addr + rlen, False)
+        self._sync_layout(r_addr, r_addr + rlen)
+        mk = sect_info['mark']
+        return mk.BYTES(offs_sect, rlen)
+
+    def replace(self, r_addr, dst):
+        self._record('replace', r_addr, bytes(dst))
+        rlen = len(dst)
+        sect_info, offs_sect = self._access(r_addr, r_addr + rlen)
+        self._sync_layout(r_addr, r_addr + rlen)
+        mk = sect_info['mark']
+        mk.WBYTES(dst, offs_sect)
+        return offs_sect + sect_info['offs']
+
+    def _shift(self, mk, offs_sect, s_len, shft_len):
+        if shft_len < 0:
+            s_offs = offs_sect - shft_len
+        else:
+            s_offs = offs_sect
+        mk.move(s_offs, s_offs + shft_len, s_len)
+        return s_offs, s_offs + shft_len
+
+    def shift(self, s_st, s_len, shft_len):
+        self._record('shift', s_st, s_len, shft_len)
+        s_ed = s_st + s_len
+        d_st = s_st + shft_len
+        d_ed = s_ed + shft_len
+        a_st = min(s_st, d_st)
+        a_ed = max(s_ed, d_ed)
+        sect_info, offs_sect = self._access(a_st, a_ed)
+        self._sync_layout(a_st, a_ed)
+        mk = sect_info['mark']
+        r_st, r_ed = self._shift(mk, offs_sect, s_len, shft_len)
+        self._shift_datdir_tab(s_st, s_ed, shft_len)
+        return r_st, r_ed
+
+    def _cfg_sect(self, cfg):
+        ncfg = {}
+        if 'like' in cfg:
+            lsname = cfg['like']
+            for sect_info in self.tab_sect:
+                if sect_info['name'] == lsname:
+                    ncfg['char'] = sect_info['char'].copy()
+                    break
+        for k, v in cfg.items():
+            if k == 'char' and k in ncfg:
+                ncfg[k].update(v)
+            else:
+                ncfg[k] = v
+        return ncfg
+
+    def insert(self, s_st, s_len, cfg):
+        src_sect_info, offs_sect = self._get_sect_by_addr(s_st, None, True)
+        sidx = src_sect_info['idx']
+        self.insert_sect(sidx, offs_sect + s_len, self._cfg_sect(cfg))
+        sect_info = self.tab_sect[sidx]
+        return sect_info['offs'] + offs_sect, sect_info['offs'], sect_info['size']
+
+    def _get_reloc_tab(self):
+        if self.reloc_tab is None:
+            datdir_info = self.tab_datdir[0x5]
+            self.reloc_tab = c_reloc_tab(datdir_info['mark'], datdir_info['size_v'])
+        return self.reloc_tab
+
+    def update_reloc(self, r_st, r_len, reloc_offs):
+        self._record('update_reloc', r_st, r_len, list(reloc_offs))
+        if 0x5 in self._lyt_maps:
+            self._apply_layout()
+        self._get_reloc_tab().update(r_st, r_len, reloc_offs)
+
+    def _flush_reloc(self):
+        reloc_tab = self.reloc_tab
+        if reloc_tab is None or not reloc_tab.dirty:
+            return
+        datdir_info = self.tab_datdir[0x5]
+        dat = reloc_tab.pack()
+        dlen = len(dat)
+        szv = datdir_info['size_v']
+        r_addr = datdir_info['addr']
+        self._access(r_addr, r_addr + max(dlen, szv))
+        self._sync_layout()
+        mk = datdir_info['mark']
+        mk.WBYTES(dat, 0)
+        if dlen < szv:
+            mk.fill(0, dlen, szv - dlen)
+        datdir_info['size_v'] = dlen
+        datdir_info['mark_h'].W32(dlen, 0x4)
+        reloc_tab.dirty = False
+
+    def _repack_header(self):
+        tab_sect = self.tab_sect
+        size_hdr = self.size_hdr
+        if not tab_sect:
+            yield self, 0, size_hdr
+            return size_hdr
+        offs_1st_sect = tab_sect[0]['mark_h'].real_offset
+        yield self, 0, offs_1st_sect
+        size_all = offs_1st_sect
+        for sect_info in tab_sect:
+            yield sect_info['mark_h'], 0, 0x28
+            size_all += 0x28
+            if size_all > self.size_hdr:
+                raise ValueError(report(
+                    f'sect header overflow: {sect_info["name"]}'))
+        if size_all < self.size_hdr:
+            yield self, size_all, size_hdr - size_all
+        return size_hdr
+
+    def _repack_marks(self):
+        self._sync_layout()
+        self._flush_reloc()
+        size_code = 0
+        size_idat = 0
+        size_udat = 0
+        size_all = yield from self._repack_header()
+        nxt_offs = size_all
+        nxt_addr = size_all
+        for sect_info in self.tab_sect:
+            if sect_info['offs'] != nxt_offs:
+                raise ValueError(report(
+                    f'invalid offset of sect {sect_info["name"]}'))
+            if sect_info['addr'] != nxt_addr:
+                raise ValueError(report(
+                    f'invalid address of sect {sect_info["name"]}'))
+            szv = self.aligned_address(sect_info['size_v'])
+            sz = sect_info['size']
+            mk = sect_info['mark']
+            yield mk, 0, sz
+            nxt_offs = self.aligned_offset(nxt_offs + sz)
+            nxt_addr += szv
+            size_all += sz
+            if sect_info['char']['code']:
+                size_code += szv
+            if sect_info['char']['idat']:
+                size_idat += szv
+            if sect_info['char']['udat']:
+                size_udat += szv
+        if (size_code != self.size_code
+            or size_idat != self.size_idat
+            or size_udat != self.size_udat
+            or nxt_addr != self.size_img):
+            raise ValueError(report(
+                f'invalid size of sects'))
+        tl = self.mark_tail
+        if self.offs_tail != nxt_offs:
+            raise ValueError(report('invalid offset of tail'))
+        yield tl, 0, None
+
+    def repack(self):
+        for mk, pos, cnt in self._repack_marks():
+            yield mk.BYTES(pos, cnt)
+
+    def repack_views(self):
+        # layout of the whole output as zero-copy views
+        return [mk.VIEW(pos, cnt) for mk, pos, cnt in self._repack_marks()]
+
+    def extents(self):
+        # (offset in repacked file, offset in source file or None if modified, data)
+        offs = 0
+        for mk, pos, cnt in self._repack_marks():
+            if cnt is None:
+                cnt = len(mk.raw) - mk.offset - pos
+            else:
+                mk.extendto(pos + cnt)
+            for src, dat in mk.runs(pos, cnt):
+                yield offs, src, dat
+                offs += len(dat)
+
+    def changed_extents(self):
+        rs = []
+        for offs, src, dat in self.extents():
+            if not src is None:
+                continue
+            if rs and rs[-1][0] + rs[-1][1] == offs:
+                rs[-1] = (rs[-1][0], rs[-1][1] + len(dat))
+            else:
+                rs.append((offs, len(dat)))
+        return rs
+
+# patch plan: pe edits of md5 pinned dlls, replayed without the assembler
+
+PLAN_FILE = 'vtmb_patch.plan'
+PLAN_MAGIC = b'VTMBPLAN'
+PLAN_VER = 1
+
+SECT_CHAR = {
+    'code': 0x20,
+    'idat': 0x40,
+    'udat': 0x80,
+    'ncch': 0x4000000,
+    'npag': 0x8000000,
+    'shar': 0x10000000,
+    'exec': 0x20000000,
+    'read': 0x40000000,
+    'writ': 0x80000000,
+}
+
+_PLAN_OPS = ['insert_sect', 'replace', 'shift', 'update_reloc']
+
+def _pack_str(v):
+    b = v.encode('utf-8')
+    return struct.pack('<H', len(b)) + b
+
+def pack_plan(dlls):
+    # dlls: [{'name', 'path', 'file', 'md5', 'dst_md5', 'ops'}]
+    rs = [struct.pack('<8sHH', PLAN_MAGIC, PLAN_VER, len(dlls))]
+    for dinfo in dlls:
+        ops = dinfo['ops']
+        rs.append(_pack_str(dinfo['name']))
+        rs.append(_pack_str(dinfo['path']))
+        rs.append(_pack_str(dinfo['file']))
+        rs.append(bytes.fromhex(dinfo['md5']))
+        rs.append(bytes.fromhex(dinfo['dst_md5']))
+        rs.append(struct.pack('<I', len(ops)))
+        for op, *args in ops:
+            rs.append(struct.pack('<B', _PLAN_OPS.index(op)))
+            if op == 'insert_sect':
+                idx, dlen, cfg = args
+                ch = 0
+                for k, v in cfg['char'].items():
+                    if v:
+                        ch |= SECT_CHAR[k]
+                rs.append(struct.pack('<II8sI', idx, dlen, cfg['name'].encode('utf-8'), ch))
+            elif op == 'replace':
+                addr, dst = args
+                rs.append(struct.pack('<II', addr, len(dst)))
+                rs.append(dst)
+            elif op == 'shift':
+                rs.append(struct.pack('<IIi', *args))
+            elif op == 'update_reloc':
+                r_st, r_len, reloc_offs = args
+                num = len(reloc_offs)
+                rs.append(struct.pack(f'<III{num}I', r_st, r_len, num, *reloc_offs))
+    raw = b''.join(rs)
+    return raw + _md5(raw).digest()
+
+def unpack_plan(raw):
+    raw = memoryview(raw)
+    if len(raw) < 0x1c or _md5(raw[:-0x10]).digest() != raw[-0x10:]:
+        raise ValueError(report('invalid plan checksum'))
+    magic, ver, num = struct.unpack_from('<8sHH', raw, 0)
+    if magic != PLAN_MAGIC:
+        raise ValueError(report('invalid plan file'))
+    if ver != PLAN_VER:
+        raise ValueError(report(f'unsupported plan version {ver}'))
+    pos = 0xc
+    def rd(fmt):
+        nonlocal pos
+        vs = struct.unpack_from(fmt, raw, pos)
+        pos += struct.calcsize(fmt)
+        return vs
+    def rd_str():
+        nonlocal pos
+        slen, = rd('<H')
+        pos += slen
+        return bytes(raw[pos - slen: pos]).decode('utf-8')
+    dlls = []
+    for _ in range(num):
+        dinfo = {
+            'name': rd_str(),
+            'path': rd_str(),
+            'file': rd_str(),
+        }
+        md5_src, md5_dst, nops = rd('<16s16sI')
+        dinfo['md5'] = md5_src.hex()
+        dinfo['dst_md5'] = md5_dst.hex()
+        ops = []
+        for _ in range(nops):
+            op = _PLAN_OPS[rd('<B')[0]]
+            if op == 'insert_sect':
+                idx, dlen, sname, ch = rd('<II8sI')
+                cfg = {
+                    'name': sname.rstrip(b'\0').decode('utf-8'),
+                    'char': {k: bool(ch & v) for k, v in SECT_CHAR.items()},
+                }
+                ops.append((op, idx, dlen, cfg))
+            elif op == 'replace':
+                addr, dlen = rd('<II')
+                pos += dlen
+                ops.append((op, addr, raw[pos - dlen: pos]))
+            elif op == 'shift':
+                ops.append((op, *rd('<IIi')))
+            elif op == 'update_reloc':
+                r_st, r_len, cnt = rd('<III')
+                ops.append((op, r_st, r_len, list(rd(f'<{cnt}I'))))
+        dinfo['ops'] = ops
+        dlls.append(dinfo)
+    if pos != len(raw) - 0x10:
+        raise ValueError(report('invalid plan size'))
+    return dlls
+
+def apply_plan(pe, ops):
+    pe.begin_layout()
+    for op, *args in ops:
+        getattr(pe, op)(*args)
+    pe.commit_layout()
+
+# binary delta from the pinned source to the patched output
+
+DELTA_MAGIC = b'VTMBDLTA'
+DELTA_VER = 1
+
+def make_delta(pe):
+    # [(src offset, length) or data] merged from repacked extents
+    ops = []
+    for offs, src, dat in pe.extents():
+        if src is None:
+            if ops and not isinstance(ops[-1], tuple):
+                ops[-1] += dat
+            else:
+                ops.append(bytearray(dat))
+            continue
+        dlen = len(dat)
+        if ops and isinstance(ops[-1], tuple) and sum(ops[-1]) == src:
+            ops[-1] = (ops[-1][0], ops[-1][1] + dlen)
+        else:
+            ops.append((src, dlen))
+    return ops
+
+def pack_delta(dinfo, ops):
+    rs = [struct.pack('<8sH', DELTA_MAGIC, DELTA_VER)]
+    rs.append(_pack_str(dinfo['name']))
+    rs.append(_pack_str(dinfo['path']))
+    rs.append(_pack_str(dinfo['file']))
+    rs.append(bytes.fromhex(dinfo['md5']))
+    rs.append(bytes.fromhex(dinfo['dst_md5']))
+    rs.append(struct.pack('<I', len(ops)))
+    for op in ops:
+        if isinstance(op, tuple):
+            rs.append(struct.pack('<BII', 0, *op))
+        else:
+            rs.append(struct.pack('<BI', 1, len(op)))
+            rs.append(op)
+    raw = b''.join(rs)
+    return raw + _md5(raw).digest()
+
+def unpack_delta(raw):
+    raw = memoryview(raw)
+    if len(raw) < 0x1a or _md5(raw[:-0x10]).digest() != raw[-0x10:]:
+        raise ValueError(report('invalid delta checksum'))
+    magic, ver = struct.unpack_from('<8sH', raw, 0)
+    if magic != DELTA_MAGIC:
+        raise ValueError(report('invalid delta file'))
+    if ver != DELTA_VER:
+        raise ValueError(report(f'unsupported delta version {ver}'))
+    pos = 0xa
+    def rd(fmt):
+        nonlocal pos
+        vs = struct.unpack_from(fmt, raw, pos)
+        pos += struct.calcsize(fmt)
+        return vs
+    def rd_str():
+        nonlocal pos
+        slen, = rd('<H')
+        pos += slen
+        return bytes(raw[pos - slen: pos]).decode('utf-8')
+    dinfo = {
+        'name': rd_str(),
+        'path': rd_str(),
+        'file': rd_str(),
+    }
+    md5_src, md5_dst, nops = rd('<16s16sI')
+    dinfo['md5'] = md5_src.hex()
+    dinfo['dst_md5'] = md5_dst.hex()
+    ops = []
+    for _ in range(nops):
+        typ, = rd('<B')
+        if typ == 0:
+            ops.append(rd('<II'))
+        elif typ == 1:
+            dlen, = rd('<I')
+            pos += dlen
+            ops.append(raw[pos - dlen: pos])
+        else:
+            raise ValueError(report(f'invalid delta op {typ}'))
+    if pos != len(raw) - 0x10:
+        raise ValueError(report('invalid delta size'))
+    return dinfo, ops
+
+def _delta_chunks(fd, ops, chunk):
+    for op in ops:
+        if not isinstance(op, tuple):
+            yield op
+            continue
+        src, dlen = op
+        fd.seek(src)
+        while dlen > 0:
+            dat = fd.read(min(dlen, chunk))
+            if not dat:
+                raise ValueError(report(f'delta copy out of source 0x{src:x}'))
+            dlen -= len(dat)
+            yield dat
+
+def apply_delta(fn_src, dinfo, ops, fn_dst, chunk = 0x100000):
+    fmd5 = hash_file(fn_src, chunk = chunk)['md5']
+    if fmd5 != dinfo['md5']:
+        raise ValueError(report(f'{fn_src} md5 unmatch: cur:{fmd5} dst:{dinfo["md5"]}'))
+    with open(fn_src, 'rb') as fd:
+        return save_file(fn_dst, _delta_chunks(fd, ops, chunk),
+            check = {'md5': dinfo['dst_md5']})
@@ -0,0 +1,108 @@
+#! python3
+# coding: utf-8
+
+# VtMB patch pre-flight checker
+# Copyright (C) 2022 Tring
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+
+# static interval tree: intervals sorted by start, each node keeps the max end of its span
+class c_interval_tree:
+
+    def __init__(self, ivs):
+        self.ivs = sorted(ivs, key = lambda v: (v[0], v[1]))
+        self.sts = [v[0] for v in self.ivs]
+        size = 1
+        while size < len(self.ivs):
+            size <<= 1
+        self.size = size
+        mx = [None] * (size * 2)
+        for i, v in enumerate(self.ivs):
+            mx[size + i] = v[1]
+        for i in range(size - 1, 0, -1):
+            l, r = mx[i * 2], mx[i * 2 + 1]
+            mx[i] = l if r is None else r if l is None else max(l, r)
+        self.mx = mx
+
+    def query(self, st, ed):
+        # intervals overlapping [st, ed), in start order
+        lim = bisect_left(self.sts, ed)
+        rs = []
+        stk = [(1, 0, self.size)]
+        while stk:
+            node, lo, hi = stk.pop()
+            mx = self.mx[node]
+            if lo >= lim or mx is None or mx <= st:
+                continue
+            if node >= self.size:
+                rs.append(self.ivs[lo])
+                continue
+            mid = (lo + hi) // 2
+            stk.append((node * 2 + 1, mid, hi))
+            stk.append((node * 2, lo, mid))
+        return rs
+
+def _patch_ranges(asm_patch):
+    writes = []
+    shifts = []
+    for idx, (addr, pinfo) in enumerate(asm_patch):
+        ptyp = pinfo['type']
+        if ptyp in ['asm', 'raw']:
+            blen = len(pinfo['byte'])
+            if blen:
+                writes.append((addr, addr + blen, idx, ptyp))
+            continue
+        finfo = getattr(pinfo.get('func'), 'patch_info', None)
+        if finfo is None:
+            continue
+        if finfo['type'] == 'copy' and finfo['len']:
+            writes.append((addr, addr + finfo['len'], idx, 'copy'))
+        elif finfo['type'] == 'shift' and finfo['len']:
+            shifts.append((addr, addr + finfo['len'], idx, finfo['shift']))
+    return writes, shifts
+
+def preflight(asm_patch):
+    # [(level, msg)]
+    # error: asm blocks running into each other, like a hook overflowing its slot
+    # warning: writes to bytes moved by a shift
+    # info: raw data overwritten by another patch, like the bytes forcing a sect extend
+    rs = []
+    writes, shifts = _patch_ranges(asm_patch)
+    wtree = c_interval_tree(writes)
+    for w_st, w_ed, w_idx, w_typ in wtree.ivs:
+        for o_st, o_ed, o_idx, o_typ in wtree.query(w_st, w_ed):
+            if (o_st, o_ed, o_idx) <= (w_st, w_ed, w_idx):
+                continue
+            lvl = 'error' if w_typ == o_typ == 'asm' else 'info'
+            if w_st < o_st and w_ed < o_ed:
+                rs.append((lvl, f'{w_typ} 0x{w_st:08X}/0x{w_ed:08X} overflows into'
+                    f' {o_typ} 0x{o_st:08X} by 0x{w_ed - o_st:X} bytes'))
+            else:
+                rs.append((lvl, f'{w_typ} 0x{w_st:08X}/0x{w_ed:08X} overlaps'
+                    f' {o_typ} 0x{o_st:08X}/0x{o_ed:08X}'))
+    for s_st, s_ed, s_idx, shft in shifts:
+        d_st = s_st + shft
+        d_ed = s_ed + shft
+        # bytes left behind, a write there fills the gap in the new layout
+        g_st, g_ed = (s_st, d_st) if shft > 0 else (d_ed, s_ed)
+        for w_st, w_ed, w_idx, w_typ in wtree.query(min(s_st, d_st), max(s_ed, d_ed)):
+            if w_idx < s_idx and w_st < s_ed and w_ed > s_st:
+                rs.append(('warning', f'{w_typ} 0x{w_st:08X}/0x{w_ed:08X} is moved'
+                    f' by later shift 0x{s_st:08X}/0x{s_ed:08X} (n:{shft:+#x})'))
+            elif w_idx > s_idx and w_st < d_ed and w_ed > d_st and not (
+                    w_st < g_ed and w_ed > g_st):
+                rs.append(('warning', f'{w_typ} 0x{w_st:08X}/0x{w_ed:08X} writes bytes moved'
+                    f' by shift 0x{s_st:08X}/0x{s_ed:08X} (n:{shft:+#x}), address may be stale'))
+    return rs
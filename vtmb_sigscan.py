@@ -0,0 +1,91 @@
+#! python3
+# coding: utf-8
+
+# VtMB patch site signature scanner
+# Copyright (C) 2022 Tring
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from vtmb_pe import report
+
+# signatures are hex bytes separated by spaces, ?? for a wildcard byte
+# like 'E8 ?? ?? ?? ?? 8B 44 24 08'
+
+def parse_sig(sig):
+    # [(offset, fixed bytes)], signature length
+    toks = sig.split()
+    frags = []
+    cur = None
+    for i, tok in enumerate(toks):
+        if tok in ['?', '??']:
+            cur = None
+            continue
+        if cur is None:
+            cur = (i, bytearray())
+            frags.append(cur)
+        cur[1].append(int(tok, 16))
+    if not frags:
+        raise ValueError(report(f'signature without fixed bytes: {sig}'))
+    return [(offs, bytes(byt)) for offs, byt in frags], len(toks)
+
+def format_sig(byt, wild = ()):
+    return ' '.join('??' if i in wild else f'{b:02X}' for i, b in enumerate(byt))
+
+class c_sig_scanner:
+
+    def __init__(self, sigs):
+        # sigs: {name: signature}
+        self.sigs = {}
+        for name, sig in sigs.items():
+            frags, slen = parse_sig(sig)
+            # the longest fixed run is searched, the rest is compared at each hit
+            anchor = max(frags, key = lambda v: len(v[1]))
+            self.sigs[name] = (frags, slen, anchor)
+
+    def _match(self, raw, st, frags):
+        for offs, byt in frags:
+            p = st + offs
+            if raw[p: p + len(byt)] != byt:
+                return False
+        return True
+
+    def scan(self, raw, ranges, limit = None):
+        # {name: [offset of each match]} in [(start, end)] ranges of raw
+        # raw is bytes or mmap, find runs in C over the whole range
+        rs = {}
+        for name, (frags, slen, (a_offs, a_byt)) in self.sigs.items():
+            hits = []
+            for r_st, r_ed in ranges:
+                i = raw.find(a_byt, r_st + a_offs, r_ed)
+                while i >= 0:
+                    st = i - a_offs
+                    if st + slen <= r_ed and self._match(raw, st, frags):
+                        hits.append(st)
+                        if limit and len(hits) >= limit:
+                            break
+                    i = raw.find(a_byt, i + 1, r_ed)
+                if limit and len(hits) >= limit:
+                    break
+            rs[name] = hits
+        return rs
+
+def unique_sig(raw, ranges, st, steps, wild = (), min_fixed = 8):
+    # shortest signature at st, grown by steps, that matches only once in ranges
+    for slen in steps:
+        if slen - sum(1 for i in wild if i < slen) < min_fixed:
+            continue
+        sig = format_sig(raw[st: st + slen], {i for i in wild if i < slen})
+        hits = c_sig_scanner({'': sig}).scan(raw, ranges, 2)['']
+        if hits == [st]:
+            return sig
+    return None
@@ -0,0 +1,332 @@
+#! python3
+# coding: utf-8
+
+# VtMB code index of dll code sections
+# Copyright (C) 2022 Tring
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of  MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os, os.path
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+from vtmb_pe import c_pe_file, hash_file, load_file, save_file, report
+
+XREF_MAGIC = b'VTMBXREF'
+XREF_VER = 1
+
+# call/jmp/jcc: direct branches, icall/ijmp: through an absolute memory slot,
+# imp: other reads of an import slot, like mov esi, [imp]; call esi
+XREF_KINDS = ['call', 'jmp', 'jcc', 'icall', 'ijmp', 'imp']
+
+def _iced():
+    # iced_x86 as loaded by the injector
+    import vtmb_inject
+    vtmb_inject.load_iced()
+    return vtmb_inject.X
+
+def pe_imports(pe):
+    # {rva of iat slot: 'dll!name'}
+    rs = {}
+    datdir_info = pe.tab_datdir[0x1]
+    mk = datdir_info['mark']
+    szv = datdir_info['size_v']
+    if not szv:
+        return rs
+    step = 0x8 if pe.flag_32plus else 0x4
+    sect_cache = {}
+    for i in range(0, szv - 0x14, 0x14):
+        addr_ilt = mk.U32(i)
+        addr_name = mk.U32(i + 0xc)
+        addr_iat = mk.U32(i + 0x10)
+        if not addr_iat:
+            break
+        sect_info, offs_sect = pe._get_sect_by_addr(addr_name)
+        dname, _ = sect_info['mark'].STRN(offs_sect)
+        for k, (_, _, ti_addr, ti_flg) in enumerate(
+                pe._iter_import_thunk(addr_ilt or addr_iat, sect_cache)):
+            if ti_flg:
+                fname = f'#{ti_addr & 0xffff}'
+            else:
+                sect_info, offs_sect = pe._get_sect_by_addr(ti_addr)
+                fname, _ = sect_info['mark'].STRN(offs_sect + 0x2)
+            rs[addr_iat + k * step] = f'{dname}!{fname}'
+    return rs
+
+# instruction starts are kept every ck_step instructions, queries decode from
+# the nearest one, xrefs are sorted by target with a permutation by source
+class c_code_index:
+
+    ck_step = 0x20
+
+    def __init__(self):
+        self.md5 = None
+        self.bitness = 32
+        self.sects = []
+        self.cks = array('I')
+        self.x_src = array('I')
+        self.x_dst = array('I')
+        self.x_kind = array('B')
+        self.x_by_src = array('I')
+        self.imports = {}
+
+    @staticmethod
+    def _code_sects(pe):
+        # (rva, offset, size) of code sections
+        return [(si['addr'], si['offs'], min(si['size'], si['size_v']) or si['size'])
+            for si in pe.tab_sect if si['char']['code']]
+
+    def build(self, pe, fmd5, bitness = 32):
+        X = _iced()
+        FC = X.FlowControl
+        fc_kinds = {
+            FC.CALL: 0,
+            FC.UNCONDITIONAL_BRANCH: 1,
+            FC.CONDITIONAL_BRANCH: 2,
+            FC.INDIRECT_CALL: 3,
+            FC.INDIRECT_BRANCH: 4,
+        }
+        near_ops = {X.OpKind.NEAR_BRANCH16, X.OpKind.NEAR_BRANCH32, X.OpKind.NEAR_BRANCH64}
+        op_mem = X.OpKind.MEMORY
+        r_none = X.Register.NONE
+        self.md5 = fmd5
+        self.bitness = bitness
+        self.imports = pe_imports(pe)
+        imps = self.imports
+        base = pe.addr_base
+        self.sects = self._code_sects(pe)
+        xrefs = []
+        cks = self.cks
+        ck_step = self.ck_step
+        size_img = pe.size_img
+        ins = X.Instruction()
+        for s_addr, s_offs, s_size in self.sects:
+            dec = X.Decoder(bitness, bytes(pe.raw[s_offs: s_offs + s_size]), ip = base + s_addr)
+            i = 0
+            while dec.can_decode:
+                dec.decode_out(ins)
+                if not i % ck_step:
+                    cks.append(ins.ip - base)
+                i += 1
+                kind = fc_kinds.get(ins.flow_control)
+                if kind is None:
+                    if ins.memory_base == r_none and ins.memory_index == r_none:
+                        dst = ins.memory_displacement - base
+                        if dst in imps:
+                            xrefs.append((dst, ins.ip - base, 5))
+                    continue
+                if kind < 3:
+                    if not ins.op0_kind in near_ops:
+                        continue
+                    dst = ins.near_branch_target - base
+                elif ins.op0_kind == op_mem and ins.memory_base == r_none and ins.memory_index == r_none:
+                    dst = ins.memory_displacement - base
+                else:
+                    continue
+                # data decoded as code may branch anywhere
+                if 0 <= dst < size_img:
+                    xrefs.append((dst, ins.ip - base, kind))
+        xrefs.sort()
+        self.x_dst = array('I', (v[0] for v in xrefs))
+        self.x_src = array('I', (v[1] for v in xrefs))
+        self.x_kind = array('B', (v[2] for v in xrefs))
+        self.x_by_src = array('I', sorted(range(len(xrefs)), key = self.x_src.__getitem__))
+        return self
+
+    def pack(self):
+        rs = [struct.pack('<8sH16sBI', XREF_MAGIC, XREF_VER,
+            bytes.fromhex(self.md5), self.bitness, len(self.sects))]
+        for sect in self.sects:
+            rs.append(struct.pack('<III', *sect))
+        for arr in (self.cks, self.x_dst, self.x_src, self.x_kind, self.x_by_src):
+            rs.append(struct.pack('<I', len(arr)))
+            rs.append(arr.tobytes())
+        imps = '\n'.join(f'{addr:x} {name}' for addr, name in self.imports.items()).encode('utf-8')
+        rs.append(struct.pack('<I', len(imps)))
+        rs.append(imps)
+        return b''.join(rs)
+
+    def unpack(self, raw):
+        raw = memoryview(raw)
+        magic, ver, fmd5, self.bitness, nsect = struct.unpack_from('<8sH16sBI', raw, 0)
+        if magic != XREF_MAGIC:
+            raise ValueError(report('invalid xref index file'))
+        if ver != XREF_VER:
+            raise ValueError(report(f'unsupported xref index version {ver}'))
+        self.md5 = fmd5.hex()
+        pos = struct.calcsize('<8sH16sBI')
+        self.sects = []
+        for i in range(nsect):
+            self.sects.append(struct.unpack_from('<III', raw, pos))
+            pos += 0xc
+        arrs = []
+        for typ in 'IIIBI':
+            cnt, = struct.unpack_from('<I', raw, pos)
+            pos += 0x4
+            arr = array(typ)
+            arr.frombytes(raw[pos: pos + cnt * arr.itemsize])
+            pos += cnt * arr.itemsize
+            arrs.append(arr)
+        self.cks, self.x_dst, self.x_src, self.x_kind, self.x_by_src = arrs
+        ilen, = struct.unpack_from('<I', raw, pos)
+        pos += 0x4
+        self.imports = {}
+        for line in bytes(raw[pos: pos + ilen]).decode('utf-8').splitlines():
+            addr, name = line.split(' ', 1)
+            self.imports[int(addr, 16)] = name
+        return self
+
+    def callers(self, addr, kinds = None):
+        # [(src rva, kind)] of xrefs to addr
+        st = bisect_left(self.x_dst, addr)
+        ed = bisect_right(self.x_dst, addr)
+        rs = []
+        for i in range(st, ed):
+            kind = XREF_KINDS[self.x_kind[i]]
+            if kinds is None or kind in kinds:
+                rs.append((self.x_src[i], kind))
+        return rs
+
+    def refs(self, st, ed = None):
+        # [(src rva, dst rva, kind)] of xrefs from instructions in [st, ed)
+        if ed is None:
+            ed = st + 1
+        x_src = self.x_src
+        by_src = self.x_by_src
+        lo, hi = 0, len(by_src)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if x_src[by_src[mid]] < st:
+                lo = mid + 1
+            else:
+                hi = mid
+        rs = []
+        for i in range(lo, len(by_src)):
+            xi = by_src[i]
+            if x_src[xi] >= ed:
+                break
+            rs.append((x_src[xi], self.x_dst[xi], XREF_KINDS[self.x_kind[xi]]))
+        return rs
+
+    def import_slots(self, name):
+        # iat slot rvas of imports matching 'func' or 'dll!func'
+        name = name.lower()
+        return [addr for addr, iname in self.imports.items()
+            if iname.lower() == name or iname.lower().split('!', 1)[1] == name]
+
+    def _sect_of(self, addr):
+        for s_addr, s_offs, s_size in self.sects:
+            if s_addr <= addr < s_addr + s_size:
+                return s_addr, s_offs, s_size
+        return None
+
+    def decode(self, pe, addr, count = 1):
+        # count instructions from the one covering addr
+        X = _iced()
+        sect = self._sect_of(addr)
+        if sect is None:
+            return []
+        s_addr, s_offs, s_size = sect
+        # the first instruction of each section is a check point
+        st = self.cks[bisect_right(self.cks, addr) - 1]
+        base = pe.addr_base
+        # at most 15 bytes for each instruction
+        ed = min(addr + (count + 1) * 15, s_addr + s_size)
+        dec = X.Decoder(self.bitness, bytes(pe.raw[s_offs + st - s_addr: s_offs + ed - s_addr]), ip = base + st)
+        rs = []
+        for ins in dec:
+            if ins.next_ip - base <= addr:
+                continue
+            rs.append(ins)
+            if len(rs) >= count:
+                break
+        return rs
+
+def index_path(cfg, fmd5):
+    return os.path.join(cfg.get('work', '.'), cfg.get('xref', 'xref'), fmd5 + '.xref')
+
+def load_index(cfg, fn, bitness = 32):
+    # (pe, index) of a dll, the index is built once for each md5
+    raw = load_file(fn, cfg.get('mmap', False))
+    pe = c_pe_file(raw)
+    fmd5 = hash_file(fn)['md5']
+    ifn = index_path(cfg, fmd5)
+    if os.path.exists(ifn):
+        try:
+            with open(ifn, 'rb') as fd:
+                idx = c_code_index().unpack(fd.read())
+            if idx.md5 == fmd5:
+                return pe, idx
+        except (ValueError, struct.error):
+            report(f'warning: invalid xref index {ifn}')
+    report(f'index {fn} md5:{fmd5}')
+    idx = c_code_index().build(pe, fmd5, bitness)
+    os.makedirs(os.path.dirname(ifn), exist_ok = True)
+    save_file(ifn, [idx.pack()], ())
+    report(f'index saved to {ifn}: {len(idx.x_dst)} xrefs, {len(idx.imports)} imports')
+    return pe, idx
+
+if __name__ == '__main__':
+    from vtmb_inject import PP_CFG, MOD_DLLS
+    def usage():
+        report('''python vtmb_xref.py <dll name or file> <query>
+    at <rva> [count]    instructions at rva
+    who <rva|import>    xrefs to rva or to an import like kernel32.dll!GetProcAddress
+    from <rva> [count]  xrefs from the instructions at rva''')
+        sys.exit()
+    if len(sys.argv) < 2:
+        usage()
+    name = sys.argv[1]
+    if name in MOD_DLLS:
+        sinfo = MOD_DLLS[name]
+        fn = os.path.join(PP_CFG['root'], sinfo['path'], sinfo['file'])
+        fn_b, fn_e = os.path.splitext(fn)
+        # the original code, patched dlls are indexed by their own md5 otherwise
+        if os.path.exists(fn_b + '_src' + fn_e):
+            fn = fn_b + '_src' + fn_e
+    else:
+        fn = name
+    pe, idx = load_index(PP_CFG, fn, PP_CFG['bitness'])
+    cmd = sys.argv[2] if len(sys.argv) > 2 else None
+    base = pe.addr_base
+    X = _iced()
+    fmt = X.Formatter(X.FormatterSyntax.NASM)
+    fmt.first_operand_char_index = 8
+    def ref_str(addr):
+        imp = idx.imports.get(addr)
+        return f'0x{addr:08X}' + (f' ({imp})' if imp else '')
+    if cmd == 'at' and len(sys.argv) > 3:
+        addr = int(sys.argv[3], 16)
+        cnt = int(sys.argv[4]) if len(sys.argv) > 4 else 16
+        for ins in idx.decode(pe, addr, cnt):
+            rva = ins.ip - base
+            xs = ', '.join(f'{k} {ref_str(d)}' for _, d, k in idx.refs(rva))
+            report(f'{rva:08X} {fmt.format(ins):40} {xs}')
+    elif cmd == 'who' and len(sys.argv) > 3:
+        try:
+            dsts = [int(sys.argv[3], 16)]
+        except ValueError:
+            dsts = idx.import_slots(sys.argv[3])
+        for dst in dsts:
+            for src, kind in idx.callers(dst):
+                report(f'{src:08X} {kind:5} {ref_str(dst)}')
+    elif cmd == 'from' and len(sys.argv) > 3:
+        addr = int(sys.argv[3], 16)
+        ins = idx.decode(pe, addr, int(sys.argv[4]) if len(sys.argv) > 4 else 1)
+        if ins:
+            for src, dst, kind in idx.refs(ins[0].ip - base, ins[-1].next_ip - base):
+                report(f'{src:08X} {kind:5} {ref_str(dst)}')
+    else:
+        usage()